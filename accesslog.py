@@ -0,0 +1,233 @@
+"""
+Módulo del registro de accesos del portal cautivo.
+Escribe eventos de acceso y autenticación como líneas JSON desde un hilo
+propio, para que el registro no añada latencia a las peticiones.
+"""
+
+import itertools
+import json
+import logging
+import os
+import queue
+import time
+from datetime import datetime, timezone
+from threading import Thread
+
+
+class AccessLog:
+    """
+    Registro estructurado de accesos con cola acotada y escritura en lotes.
+
+    Los hilos de petición solo encolan una tupla sin formatear; si la cola
+    está llena el evento se descarta y se cuenta, nunca se bloquea. Un
+    hilo escritor formatea los eventos como JSON, los escribe en lotes y
+    rota el fichero por tamaño o por antigüedad.
+
+    Los sondeos de conectividad, que son la mayor parte del tráfico, se
+    pueden muestrear: solo se registra uno de cada probe_sample_every.
+    """
+
+    def __init__(self, log_file="access.log", max_queue=10000, batch_size=512,
+                 flush_interval=1.0, max_bytes=10 * 1024 * 1024,
+                 rotate_interval=86400, backup_count=5, probe_sample_every=100,
+                 probe_paths=()):
+        """
+        Inicializa el registro de accesos.
+
+        Args:
+            log_file: Ruta del fichero de registro
+            max_queue: Eventos pendientes máximos antes de descartar
+            batch_size: Eventos máximos por escritura
+            flush_interval: Segundos entre comprobaciones de rotación
+                cuando no llegan eventos
+            max_bytes: Tamaño que provoca la rotación (0 para no rotar por tamaño)
+            rotate_interval: Segundos que provocan la rotación (0 para no
+                rotar por tiempo)
+            backup_count: Ficheros rotados que se conservan
+            probe_sample_every: Se registra uno de cada N sondeos (1 para todos)
+            probe_paths: Rutas consideradas sondeos de conectividad
+        """
+        self.log_file = log_file
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.probe_sample_every = max(1, probe_sample_every)
+        self.probe_paths = frozenset(probe_paths)
+        self.probe_counter = itertools.count()
+        self.file = None
+        self.opened_at = 0.0
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+        # Métricas. Los contadores de los hilos de petición son
+        # aproximados: se incrementan sin lock
+        self.enqueued = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.written = 0
+        self.batches = 0
+        self.rotations = 0
+
+    def start(self):
+        """Abre el fichero e inicia el hilo escritor."""
+        self._open()
+        self.thread = Thread(target=self._writer_loop, name="access-log", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Escribe los eventos pendientes y cierra el fichero."""
+        if self.thread:
+            # None señala el final; se espera si la cola está llena
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def access(self, client_ip, method, path, status, duration=None):
+        """
+        Registra una petición atendida.
+
+        Args:
+            client_ip: IP del cliente
+            method: Método HTTP
+            path: Ruta solicitada
+            status: Código de estado de la respuesta
+            duration: Segundos hasta el envío de la respuesta, si se conocen
+        """
+        if (self.probe_sample_every > 1 and path in self.probe_paths
+                and next(self.probe_counter) % self.probe_sample_every):
+            self.sampled_out += 1
+            return
+        self._enqueue(('access', time.time(), client_ip, method, path, status, duration))
+
+    def auth(self, event, client_ip, username=None, reason=None):
+        """
+        Registra un evento de autenticación.
+
+        Args:
+            event: 'login', 'login_failed', 'login_rejected' o 'logout'
+            client_ip: IP del cliente
+            username: Usuario implicado, si se conoce
+            reason: Motivo de un rechazo
+        """
+        self._enqueue(('auth', time.time(), client_ip, event, username, reason))
+
+    def metrics(self):
+        """Devuelve las métricas del registro."""
+        return {
+            'pending': self.queue.qsize(),
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out,
+            'written': self.written,
+            'batches': self.batches,
+            'rotations': self.rotations,
+        }
+
+    def _enqueue(self, event):
+        """Encola un evento sin bloquear; si no cabe, lo descarta."""
+        try:
+            self.queue.put_nowait(event)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+
+    @staticmethod
+    def _format(event):
+        """Convierte un evento encolado en una línea JSON."""
+        timestamp = datetime.fromtimestamp(event[1], timezone.utc).isoformat(timespec='milliseconds')
+        if event[0] == 'access':
+            _, _, client_ip, method, path, status, duration = event
+            record = {'ts': timestamp, 'type': 'access', 'ip': client_ip}
+            if method:
+                record['method'] = method
+            if path is not None:
+                record['path'] = path
+            record['status'] = status
+            if duration is not None:
+                record['ms'] = round(duration * 1000, 3)
+        else:
+            _, _, client_ip, auth_event, username, reason = event
+            record = {'ts': timestamp, 'type': 'auth', 'event': auth_event,
+                      'ip': client_ip, 'user': username}
+            if reason:
+                record['reason'] = reason
+        return json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+
+    def _writer_loop(self):
+        """Recoge lotes de la cola y los escribe."""
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                self._maybe_rotate()
+                continue
+            # Vaciar lo que ya esté en cola, hasta batch_size eventos
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [event for event in batch if event is not None]
+            self._write(batch)
+            self._maybe_rotate()
+        # Eventos encolados después de la señal de parada
+        remaining = []
+        while True:
+            try:
+                event = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if event is not None:
+                remaining.append(event)
+        self._write(remaining)
+
+    def _write(self, batch):
+        """Escribe un lote de eventos con una sola llamada."""
+        if not batch or self.file is None:
+            return
+        try:
+            self.file.write("\n".join(self._format(event) for event in batch) + "\n")
+            self.file.flush()
+            self.written += len(batch)
+            self.batches += 1
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Error escribiendo el registro de accesos: {e}")
+
+    def _open(self):
+        """Abre el fichero de registro para anexar."""
+        self.file = open(self.log_file, 'a', encoding='utf-8')
+        # La antigüedad se cuenta desde que se abre el fichero
+        self.opened_at = time.time()
+
+    def _maybe_rotate(self):
+        """Rota el fichero si superó el tamaño o la antigüedad máximos."""
+        if self.file is None:
+            return
+        too_big = self.max_bytes and self.file.tell() >= self.max_bytes
+        too_old = self.rotate_interval and time.time() - self.opened_at >= self.rotate_interval
+        if not (too_big or too_old) or self.file.tell() == 0:
+            return
+        try:
+            self.file.close()
+            # access.log.4 -> access.log.5, ..., access.log -> access.log.1
+            for index in range(self.backup_count - 1, 0, -1):
+                source = f"{self.log_file}.{index}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.log_file}.{index + 1}")
+            if self.backup_count > 0:
+                os.replace(self.log_file, f"{self.log_file}.1")
+            else:
+                os.remove(self.log_file)
+            self.rotations += 1
+        except OSError as e:
+            self.logger.error(f"Error rotando el registro de accesos: {e}")
+        self._open()
@@ -0,0 +1,317 @@
+"""
+Módulo de contabilidad de tráfico del portal cautivo.
+Lee en bloque los contadores del firewall, acumula los bytes de cada
+usuario y bloquea las sesiones de quien agota su cuota.
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+from threading import Condition, Lock, Thread
+
+
+class TrafficAccountant:
+    """
+    Contabilidad de tráfico por usuario a partir de contadores del kernel.
+
+    Cada pasada hace una única llamada al firewall que devuelve los bytes
+    de todas las IPs autorizadas, de modo que el número de comandos no
+    crece con las sesiones. Los totales se guardan en un diccionario
+    {usuario: bytes} con los nombres internados.
+
+    Con usage_file los totales se cargan al crear la contabilidad y se
+    reescriben tras cada pasada que los cambie, de modo que un reinicio no
+    devuelve la cuota a nadie. Quien termina una sesión debe llamar antes a
+    settle(): el contador de la IP desaparece con su regla y el tráfico
+    desde la última pasada se perdería.
+
+    Cada lectura periódica se entrega también a los oyentes registrados
+    con add_listener (p. ej. ActivityTracker), que así no vuelven a
+    consultar el firewall.
+    """
+
+    def __init__(self, firewall_manager, session_manager, firewall_queue=None,
+                 interval=10.0, default_quota=None, quotas=None, usage_file=None):
+        """
+        Inicializa la contabilidad.
+
+        Args:
+            firewall_manager: Instancia de FirewallManager
+            session_manager: Instancia de SessionManager
+            firewall_queue: FirewallWorkQueue opcional para los bloqueos
+            interval: Segundos entre lecturas de contadores
+            default_quota: Bytes permitidos por usuario (None sin límite)
+            quotas: Diccionario {usuario: bytes} con cuotas particulares
+            usage_file: Fichero JSON donde persistir los totales (None
+                para guardarlos solo en memoria)
+        """
+        self.firewall_manager = firewall_manager
+        self.session_manager = session_manager
+        self.firewall_queue = firewall_queue
+        self.interval = interval
+        self.default_quota = default_quota
+        self.quotas = quotas or {}
+        self.condition = Condition()
+        self.user_totals = {}  # {usuario: bytes}
+        self.last_counters = {}  # {ip: último valor leído del contador}
+        self.usage_file = usage_file
+        self.dirty = False  # Totales cambiados desde el último guardado
+        self.save_lock = Lock()  # Un solo guardado a la vez en usage_file
+        self.listeners = []
+        self.running = False
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+        # Métricas
+        self.polls = 0
+        self.failed_polls = 0
+        self.blocked_sessions = 0
+        self.settled_sessions = 0
+        self.last_poll_duration = 0.0
+
+        self._load()
+
+    def add_listener(self, listener):
+        """
+        Registra una función llamada con cada lectura de contadores.
+
+        Args:
+            listener: Función que recibe {ip: bytes} de todas las IPs
+                autorizadas
+        """
+        self.listeners.append(listener)
+
+    def start(self):
+        """Inicia el hilo de lectura periódica."""
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = Thread(target=self._poll_loop, name="traffic-accounting", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Detiene el hilo tras una última lectura."""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.poll()
+        self.save()
+
+    def quota_for(self, username):
+        """Devuelve la cuota en bytes de un usuario, o None si no tiene."""
+        return self.quotas.get(username, self.default_quota)
+
+    def is_over_quota(self, username):
+        """Indica si el usuario ya agotó su cuota."""
+        quota = self.quota_for(username)
+        return quota is not None and self.user_totals.get(username, 0) >= quota
+
+    def get_usage(self, username):
+        """Devuelve los bytes consumidos por un usuario."""
+        return self.user_totals.get(username, 0)
+
+    def reset_usage(self, username=None):
+        """Reinicia el consumo de un usuario, o de todos (nuevo periodo)."""
+        with self.condition:
+            if username is None:
+                self.user_totals.clear()
+            else:
+                self.user_totals.pop(username, None)
+            self.dirty = True
+        self.save()
+
+    def poll(self):
+        """
+        Lee los contadores, acumula el tráfico y aplica las cuotas.
+
+        Returns:
+            Lista de IPs bloqueadas por cuota, o None si la lectura falló
+        """
+        started = time.monotonic()
+        counters = self.firewall_manager.read_counters()
+        if counters is None:
+            with self.condition:
+                self.failed_polls += 1
+            return None
+
+        with self.condition:
+            over_quota = self._account(counters, counters,
+                                       self.session_manager.get_username_by_ip)
+            # Solo se recuerdan las IPs presentes en el firewall
+            self.last_counters = counters
+            self.polls += 1
+            self.last_poll_duration = time.monotonic() - started
+        self.save()
+        self._notify(counters)
+
+        # Se bloquean todas las sesiones del usuario, no solo las que
+        # generaron tráfico en esta pasada
+        blocked = []
+        if over_quota:
+            for ip in counters:
+                username = self.session_manager.get_username_by_ip(ip)
+                if username not in over_quota:
+                    continue
+                session = self.session_manager.end_session(ip)
+                if session is not None:
+                    self.logger.warning(f"Cuota de tráfico agotada para '{username}' en {ip}")
+                    self._block(ip, session.mac)
+                    blocked.append(ip)
+        if blocked:
+            with self.condition:
+                self.blocked_sessions += len(blocked)
+        return blocked
+
+    def settle(self, sessions):
+        """
+        Contabiliza el tráfico pendiente de sesiones que terminan.
+
+        Debe llamarse antes de retirar sus reglas del firewall, ya sin la
+        sesión en SessionManager; por eso se indica el usuario de cada IP.
+
+        Args:
+            sessions: Diccionario {ip: usuario} de las sesiones terminadas
+
+        Returns:
+            True si los contadores se pudieron leer
+        """
+        if not sessions:
+            return True
+        counters = self.firewall_manager.read_counters()
+        if counters is None:
+            with self.condition:
+                self.failed_polls += 1
+            return False
+
+        with self.condition:
+            # El valor leído queda como referencia: si la regla no llega a
+            # retirarse, la pasada siguiente no vuelve a contarlo
+            self._account(counters, sessions, sessions.get)
+            for ip in sessions:
+                if ip in counters:
+                    self.last_counters[ip] = counters[ip]
+            self.settled_sessions += len(sessions)
+        self.save()
+        return True
+
+    def save(self):
+        """Guarda los totales en usage_file si cambiaron."""
+        if self.usage_file is None:
+            return
+        # La escritura ocurre fuera de self.condition para no detener la
+        # contabilidad mientras dura el fsync
+        with self.save_lock:
+            with self.condition:
+                if not self.dirty:
+                    return
+                totals = dict(self.user_totals)
+                self.dirty = False
+
+            temp_file = self.usage_file + '.tmp'
+            try:
+                with open(temp_file, 'w') as f:
+                    json.dump(totals, f, separators=(',', ':'))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_file, self.usage_file)
+            except OSError as e:
+                self.logger.error(f"Error guardando el consumo de tráfico: {e}")
+                with self.condition:
+                    self.dirty = True
+
+    def metrics(self):
+        """Devuelve las métricas de la contabilidad."""
+        with self.condition:
+            return {
+                'polls': self.polls,
+                'failed_polls': self.failed_polls,
+                'tracked_ips': len(self.last_counters),
+                'tracked_users': len(self.user_totals),
+                'total_bytes': sum(self.user_totals.values()),
+                'blocked_sessions': self.blocked_sessions,
+                'settled_sessions': self.settled_sessions,
+                'last_poll_duration': self.last_poll_duration,
+            }
+
+    def _load(self):
+        """Carga los totales guardados en usage_file, si existe."""
+        if self.usage_file is None or not os.path.exists(self.usage_file):
+            return
+        try:
+            with open(self.usage_file, 'r') as f:
+                totals = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Error leyendo el consumo de tráfico: {e}")
+            return
+        self.user_totals = {sys.intern(username): int(total)
+                            for username, total in totals.items()}
+
+    def _account(self, counters, ips, username_of):
+        """
+        Suma a sus usuarios el tráfico de ips desde la última lectura.
+
+        Llamar con self.condition tomado.
+
+        Args:
+            counters: Diccionario {ip: contador} recién leído
+            ips: IPs que contabilizar
+            username_of: Función que devuelve el usuario de una IP o None
+
+        Returns:
+            Conjunto de usuarios que alcanzaron su cuota
+        """
+        over_quota = set()
+        for ip in ips:
+            current = counters.get(ip)
+            if current is None:
+                continue
+            previous = self.last_counters.get(ip, 0)
+            # Un contador menor que el anterior se reinició (la IP salió
+            # del set y volvió a entrar): todo lo contado es nuevo
+            delta = current - previous if current >= previous else current
+            if not delta:
+                continue
+            username = username_of(ip)
+            if username is None:
+                continue
+            total = self.user_totals.get(username, 0) + delta
+            self.user_totals[sys.intern(username)] = total
+            self.dirty = True
+            quota = self.quota_for(username)
+            if quota is not None and total >= quota:
+                over_quota.add(username)
+        return over_quota
+
+    def _notify(self, counters):
+        """Entrega una lectura de contadores a los oyentes."""
+        for listener in self.listeners:
+            try:
+                listener(counters)
+            except Exception as e:
+                self.logger.error(f"Error procesando contadores de tráfico: {e}")
+
+    def _block(self, ip_address, mac_address=None):
+        """Revoca el acceso de una IP, por la cola si la hay."""
+        if self.firewall_queue is not None:
+            self.firewall_queue.block_ip(ip_address, mac_address)
+        else:
+            self.firewall_manager.block_ip(ip_address, mac_address)
+
+    def _poll_loop(self):
+        """Lee los contadores cada interval segundos."""
+        while True:
+            with self.condition:
+                if self.running:
+                    self.condition.wait(self.interval)
+                if not self.running:
+                    return
+            try:
+                self.poll()
+            except Exception as e:
+                self.logger.error(f"Error en la contabilidad de tráfico: {e}")
@@ -0,0 +1,208 @@
+"""
+Módulo de detección de actividad del portal cautivo.
+Deduce qué clientes siguen usando la red a partir de instantáneas del
+kernel, para que las sesiones venzan por inactividad real y no por no
+haber vuelto a visitar el portal.
+"""
+
+import logging
+import time
+from threading import Condition, Thread
+
+from firewall import run_subprocess
+
+
+def parse_conntrack(output):
+    """
+    Resume la salida de "conntrack -L" por IP de origen.
+
+    Args:
+        output: Líneas como "tcp 6 431999 ESTABLISHED src=10.0.0.2
+            dst=1.1.1.1 ... packets=12 bytes=3400 src=1.1.1.1 ..."
+
+    Returns:
+        Diccionario {ip: paquetes de todas sus conexiones}. Sin contabilidad
+        en conntrack (nf_conntrack_acct) cuenta las conexiones
+    """
+    totals = {}
+    for line in output.split('\n'):
+        source = None
+        packets = 0
+        accounted = False
+        for field in line.split():
+            if field.startswith("src=") and source is None:
+                # La primera dirección es el origen en el sentido original
+                source = field[4:]
+            elif field.startswith("packets="):
+                packets += int(field[8:])
+                accounted = True
+        if source is None:
+            continue
+        totals[source] = totals.get(source, 0) + (packets if accounted else 1)
+    return totals
+
+
+class ActivityTracker:
+    """
+    Última actividad de red de cada cliente a partir de contadores del kernel.
+
+    Cada pasada lee en bloque una instantánea por IP (los contadores del
+    set del firewall o la tabla de conntrack) y considera activa toda IP
+    cuyo valor cambió desde la pasada anterior. Las IPs activas se
+    entregan juntas a SessionManager, que toma su lock una sola vez por
+    pasada. La última actividad queda así con una precisión de
+    interval segundos, que debe ser muy inferior al tiempo de sesión.
+
+    Con un TrafficAccountant los contadores no se leen aquí: cada lectura
+    de la contabilidad se recibe con record_snapshot, de modo que el
+    firewall se consulta una sola vez por intervalo de contabilidad.
+    """
+
+    def __init__(self, session_manager, firewall_manager=None, source="counters",
+                 interval=30.0, command_runner=None, traffic_accountant=None):
+        """
+        Inicializa el seguimiento de actividad.
+
+        Args:
+            session_manager: Instancia de SessionManager
+            firewall_manager: FirewallManager del que leer los contadores
+            source: 'counters' para los contadores del firewall o
+                'conntrack' para la tabla de conexiones del kernel
+            interval: Segundos entre instantáneas
+            command_runner: Función que ejecuta conntrack (sustituible en pruebas)
+            traffic_accountant: TrafficAccountant opcional cuyas lecturas de
+                contadores se reutilizan; interval no se usa con él
+        """
+        if source not in ("counters", "conntrack"):
+            raise ValueError(f"Origen de actividad desconocido: {source}")
+        if source == "counters" and firewall_manager is None and traffic_accountant is None:
+            raise ValueError("La actividad por contadores necesita un FirewallManager "
+                             "o un TrafficAccountant")
+        self.session_manager = session_manager
+        self.firewall_manager = firewall_manager
+        # Solo se usa con source 'counters'
+        self.traffic_accountant = traffic_accountant if source == "counters" else None
+        self.source = source
+        self.interval = interval
+        self.command_runner = command_runner or run_subprocess
+        self.condition = Condition()
+        self.last_snapshot = {}  # {ip: valor leído en la pasada anterior}
+        self.running = False
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+        # Métricas
+        self.polls = 0
+        self.failed_polls = 0
+        self.active_ips = 0
+        self.refreshed_sessions = 0
+        self.last_poll_duration = 0.0
+
+    def start(self):
+        """Toma la instantánea de referencia e inicia el hilo de lectura."""
+        if self.traffic_accountant is not None:
+            # Sin hilo propio: la primera lectura de la contabilidad sirve
+            # de referencia
+            with self.condition:
+                if self.running:
+                    return
+                self.running = True
+            if self.record_snapshot not in self.traffic_accountant.listeners:
+                self.traffic_accountant.add_listener(self.record_snapshot)
+            return
+        self.poll()
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = Thread(target=self._poll_loop, name="activity-tracker", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Detiene el hilo de lectura."""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def poll(self):
+        """
+        Lee una instantánea y actualiza la actividad de las sesiones.
+
+        Returns:
+            Número de sesiones cuya actividad se actualizó, o None si la
+            lectura falló
+        """
+        snapshot = self._read_snapshot()
+        if snapshot is None:
+            self.failed_polls += 1
+            return None
+        return self.record_snapshot(snapshot)
+
+    def record_snapshot(self, snapshot):
+        """
+        Actualiza la actividad de las sesiones a partir de una instantánea.
+
+        Args:
+            snapshot: Diccionario {ip: valor} leído del kernel
+
+        Returns:
+            Número de sesiones cuya actividad se actualizó
+        """
+        started = time.monotonic()
+        now = time.time()
+
+        # Una IP que aparece por primera vez solo sirve de referencia; un
+        # contador reiniciado (la IP salió del set y volvió) sí es actividad
+        previous = self.last_snapshot
+        active = [ip for ip, value in snapshot.items()
+                  if ip in previous and previous[ip] != value]
+        self.last_snapshot = snapshot
+
+        refreshed = self.session_manager.record_activity(active, now) if active else 0
+        self.polls += 1
+        self.active_ips = len(active)
+        self.refreshed_sessions += refreshed
+        self.last_poll_duration = time.monotonic() - started
+        return refreshed
+
+    def metrics(self):
+        """Devuelve las métricas del seguimiento de actividad."""
+        return {
+            'polls': self.polls,
+            'failed_polls': self.failed_polls,
+            'tracked_ips': len(self.last_snapshot),
+            'active_ips': self.active_ips,
+            'refreshed_sessions': self.refreshed_sessions,
+            'last_poll_duration': self.last_poll_duration,
+        }
+
+    def _read_snapshot(self):
+        """Lee {ip: valor} de la fuente configurada, o None si falla."""
+        if self.source == "counters":
+            return self.firewall_manager.read_counters()
+
+        try:
+            result = self.command_runner(["conntrack", "-L", "-f", "ipv4"])
+        except Exception as e:
+            self.logger.error(f"Error leyendo la tabla de conntrack: {e}")
+            return None
+        if result.returncode != 0:
+            self.logger.error(f"Error leyendo la tabla de conntrack: {result.stderr}")
+            return None
+        return parse_conntrack(result.stdout)
+
+    def _poll_loop(self):
+        """Lee una instantánea cada interval segundos."""
+        while True:
+            with self.condition:
+                if self.running:
+                    self.condition.wait(self.interval)
+                if not self.running:
+                    return
+            try:
+                self.poll()
+            except Exception as e:
+                self.logger.error(f"Error en el seguimiento de actividad: {e}")
@@ -0,0 +1,783 @@
+"""
+Benchmarks del portal cautivo.
+Levanta el servidor con un firewall simulado (sin root ni iptables) y
+mide el rendimiento de las rutas de petición.
+
+Uso:
+    python3 benchmark.py keepalive --requests 5000 --concurrency 16
+    python3 benchmark.py tls --requests 2000 --concurrency 16 [--cert portal.crt --key portal.key]
+    python3 benchmark.py sessions --requests 200000 --concurrency 8
+    python3 benchmark.py journal --clients 50000
+    python3 benchmark.py hashing --logins 200 --concurrency 8
+    python3 benchmark.py load --workload mixed --ips 2000 --output base.json
+    python3 benchmark.py load --compare base.json
+    python3 benchmark.py cluster --nodes 3 --clients 10000
+
+Con --output los resultados se guardan en JSON junto con el commit, y
+--compare los contrasta con una ejecución anterior y termina con error
+si alguna carga empeora más de --threshold.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from threading import Thread
+from urllib.parse import urlencode
+
+from users import PasswordHasher, UserManager
+from sessions import SessionManager
+from journal import SessionJournal
+from firewall import FirewallManager
+from cluster import SessionReplicator
+from server import CaptivePortalServer
+
+
+def fake_command_runner(command, input=None):
+    """
+    Simula la ejecución de un comando de firewall con éxito.
+
+    Args:
+        command: Comando que se habría ejecutado
+        input: Entrada estándar del comando
+
+    Returns:
+        CompletedProcess con código de retorno 0
+    """
+    return subprocess.CompletedProcess(command, 0, "", "")
+
+
+def start_portal_server(user_manager=None, **server_options):
+    """
+    Inicia un CaptivePortalServer en un puerto libre de localhost.
+
+    Args:
+        user_manager: UserManager a usar (por defecto uno en un directorio temporal)
+        server_options: Opciones adicionales para CaptivePortalServer
+
+    Returns:
+        Tupla (servidor, puerto)
+    """
+    if user_manager is None:
+        data_dir = tempfile.mkdtemp(prefix="portal-bench-")
+        user_manager = UserManager(
+            users_file=os.path.join(data_dir, "users.json"),
+            database_file=os.path.join(data_dir, "users.db")
+        )
+    server = CaptivePortalServer(
+        host='127.0.0.1',
+        port=0,
+        user_manager=user_manager,
+        session_manager=SessionManager(),
+        firewall_manager=FirewallManager(command_runner=fake_command_runner),
+        **server_options
+    )
+    server.start()
+    return server, server.server.server_address[1]
+
+
+def percentile(values, fraction):
+    """
+    Calcula un percentil de una lista de valores.
+
+    Args:
+        values: Lista de valores ordenada
+        fraction: Percentil entre 0 y 1
+
+    Returns:
+        Valor del percentil, o 0 si la lista está vacía
+    """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(len(values) * fraction))
+    return values[index]
+
+
+def run_clients(port, total_requests, concurrency, keep_alive, path='/'):
+    """
+    Lanza clientes HTTP concurrentes contra el portal.
+
+    Args:
+        port: Puerto del servidor
+        total_requests: Número total de peticiones
+        concurrency: Número de clientes simultáneos
+        keep_alive: Si los clientes reutilizan la conexión
+        path: Ruta solicitada
+
+    Returns:
+        Diccionario con las métricas de la ejecución
+    """
+    per_client = total_requests // concurrency
+    latencies = [[] for _ in range(concurrency)]
+    connections = [0] * concurrency
+    headers = {} if keep_alive else {'Connection': 'close'}
+
+    def client(index):
+        conn = None
+        for _ in range(per_client):
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+                connections[index] += 1
+            started = time.perf_counter()
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            latencies[index].append(time.perf_counter() - started)
+            if response.will_close:
+                conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    threads = [Thread(target=client, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    all_latencies = sorted(l for client_latencies in latencies for l in client_latencies)
+    return {
+        'requests': len(all_latencies),
+        'connections': sum(connections),
+        'elapsed': elapsed,
+        'requests_per_second': len(all_latencies) / elapsed,
+        'connections_per_second': sum(connections) / elapsed,
+        'p50_ms': percentile(all_latencies, 0.50) * 1000,
+        'p99_ms': percentile(all_latencies, 0.99) * 1000,
+    }
+
+
+def bench_keepalive(args):
+    """Compara el portal con y sin conexiones persistentes."""
+    # Todos los clientes salen de 127.0.0.1: el límite por IP no debe
+    # cerrar sus conexiones persistentes
+    server, port = start_portal_server(engine=args.engine, max_workers=args.concurrency,
+                                       max_connections_per_ip=args.concurrency * 4)
+    try:
+        results = {}
+        for keep_alive in (False, True):
+            label = 'keep-alive' if keep_alive else 'close'
+            results[label] = run_clients(port, args.requests, args.concurrency,
+                                         keep_alive, path=args.path)
+    finally:
+        server.stop()
+
+    print(f"Motor: {args.engine}, ruta: {args.path}, "
+          f"{args.requests} peticiones, {args.concurrency} clientes")
+    for label, result in results.items():
+        print(f"  {label:>10}: {result['requests_per_second']:8.0f} req/s  "
+              f"{result['connections_per_second']:8.0f} conn/s  "
+              f"p50 {result['p50_ms']:.2f} ms  p99 {result['p99_ms']:.2f} ms")
+    return results
+
+
+def run_tls_clients(port, total_handshakes, concurrency, resume):
+    """
+    Abre conexiones TLS concurrentes contra el portal, una petición por conexión.
+
+    Args:
+        port: Puerto HTTPS del servidor
+        total_handshakes: Número total de conexiones
+        concurrency: Número de clientes simultáneos
+        resume: Si cada cliente reanuda la sesión TLS de su conexión anterior
+
+    Returns:
+        Diccionario con las métricas de la ejecución
+    """
+    per_client = total_handshakes // concurrency
+    latencies = [[] for _ in range(concurrency)]
+    resumed = [0] * concurrency
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    request = b"GET /generate_204 HTTP/1.1\r\nHost: portal\r\nConnection: close\r\n\r\n"
+
+    def client(index):
+        session = None
+        for _ in range(per_client):
+            started = time.perf_counter()
+            sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+            with context.wrap_socket(sock, session=session) as conn:
+                conn.sendall(request)
+                # Leer hasta el cierre: con TLS 1.3 el ticket llega tras la negociación
+                while conn.recv(4096):
+                    pass
+                latencies[index].append(time.perf_counter() - started)
+                resumed[index] += conn.session_reused
+                if resume:
+                    session = conn.session
+
+    threads = [Thread(target=client, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    all_latencies = sorted(l for client_latencies in latencies for l in client_latencies)
+    return {
+        'handshakes': len(all_latencies),
+        'resumed': sum(resumed),
+        'elapsed': elapsed,
+        'handshakes_per_second': len(all_latencies) / elapsed,
+        'p50_ms': percentile(all_latencies, 0.50) * 1000,
+        'p99_ms': percentile(all_latencies, 0.99) * 1000,
+    }
+
+
+def bench_tls(args):
+    """Mide negociaciones TLS por segundo, con y sin reanudación de sesión."""
+    cert_file, key_file = args.cert, args.key
+    if cert_file is None:
+        # Certificado autofirmado desechable (ECDSA P-256, como uno típico de ACME)
+        cert_dir = tempfile.mkdtemp(prefix="portal-bench-")
+        cert_file = os.path.join(cert_dir, "portal.crt")
+        key_file = os.path.join(cert_dir, "portal.key")
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt",
+             "ec_paramgen_curve:prime256v1", "-nodes", "-days", "1", "-subj", "/CN=portal",
+             "-keyout", key_file, "-out", cert_file],
+            check=True, capture_output=True
+        )
+
+    # Todos los clientes salen de 127.0.0.1: el límite por IP no debe cortar
+    # conexiones que el servidor aún no ha terminado de liberar
+    server, port = start_portal_server(engine=args.engine, max_workers=args.concurrency,
+                                       max_connections_per_ip=args.concurrency * 4,
+                                       tls_port=0, tls_cert_file=cert_file,
+                                       tls_key_file=key_file)
+    tls_port = server.tls_server.server_address[1]
+    try:
+        results = {
+            'full': run_tls_clients(tls_port, args.requests, args.concurrency, resume=False),
+            'resumed': run_tls_clients(tls_port, args.requests, args.concurrency, resume=True),
+        }
+        # El puerto HTTP solo devuelve la redirección precalculada
+        results['redirect'] = run_clients(port, args.requests, args.concurrency,
+                                          keep_alive=False)
+    finally:
+        server.stop()
+
+    print(f"Motor: {args.engine}, {args.requests} conexiones, {args.concurrency} clientes, "
+          f"certificado {cert_file}")
+    for label in ('full', 'resumed'):
+        result = results[label]
+        print(f"  {label:>10}: {result['handshakes_per_second']:8.0f} handshakes/s  "
+              f"reanudadas {result['resumed']:>6}  "
+              f"p50 {result['p50_ms']:.2f} ms  p99 {result['p99_ms']:.2f} ms")
+    redirect = results['redirect']
+    print(f"  {'redirect':>10}: {redirect['requests_per_second']:8.0f} req/s  "
+          f"p50 {redirect['p50_ms']:.2f} ms  p99 {redirect['p99_ms']:.2f} ms")
+    return results
+
+
+def run_session_workers(session_manager, threads, operations, ips):
+    """
+    Ejecuta una mezcla de operaciones sobre SessionManager en varios hilos.
+
+    El 90% son consultas is_authenticated y el resto altas y bajas de sesión.
+
+    Args:
+        session_manager: Instancia de SessionManager
+        threads: Número de hilos
+        operations: Operaciones por hilo
+        ips: Lista de IPs de clientes simulados
+
+    Returns:
+        Operaciones por segundo
+    """
+    def worker(seed):
+        rng = random.Random(seed)
+        for _ in range(operations):
+            ip = rng.choice(ips)
+            roll = rng.random()
+            if roll < 0.90:
+                session_manager.is_authenticated(ip)
+            elif roll < 0.95:
+                session_manager.create_session(ip, 'usuario')
+            else:
+                session_manager.end_session(ip)
+
+    workers = [Thread(target=worker, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return threads * operations / (time.perf_counter() - started)
+
+
+def bench_sessions(args):
+    """Mide el rendimiento de SessionManager con distinto número de hilos."""
+    ips = [f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}" for i in range(args.clients)]
+    operations = max(1, args.requests // args.concurrency)
+    results = {}
+
+    print(f"{args.clients} clientes, {operations} operaciones por hilo")
+    for threads in sorted({1, 2, 4, args.concurrency}):
+        session_manager = SessionManager()
+        for ip in ips[::2]:
+            session_manager.create_session(ip, 'usuario')
+        ops = run_session_workers(session_manager, threads, operations, ips)
+        results[f"threads={threads}"] = ops
+        print(f"  hilos={threads:>2}: {ops:10.0f} ops/s")
+    return results
+
+
+def bench_journal(args):
+    """Mide el tiempo de reinicio con --clients sesiones en el journal."""
+    journal_file = os.path.join(tempfile.mkdtemp(prefix="portal-bench-"), "sessions.journal")
+    ips = [f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}" for i in range(args.clients)]
+
+    # Poblar el journal como lo haría un portal en marcha
+    journal = SessionJournal(journal_file=journal_file)
+    session_manager = SessionManager(journal=journal)
+    journal.start(session_manager.get_all_sessions)
+    started = time.perf_counter()
+    for ip in ips:
+        session_manager.create_session(ip, f"usuario{hash(ip) % 1000}")
+    for ip in ips[::10]:
+        session_manager.end_session(ip)
+    journal.stop()
+    populate = time.perf_counter() - started
+
+    # Reinicio: reproducir, reconstruir la tabla y generar el lote de firewall
+    started = time.perf_counter()
+    journal = SessionJournal(journal_file=journal_file)
+    records = journal.replay()
+    replayed = time.perf_counter()
+    session_manager = SessionManager(journal=journal)
+    restored_ips = session_manager.restore_sessions(records)
+    restored = time.perf_counter()
+    firewall_manager = FirewallManager(command_runner=fake_command_runner)
+    with firewall_manager.transaction() as tx:
+        for ip in restored_ips:
+            tx.allow_ip(ip)
+    applied = time.perf_counter()
+
+    results = {
+        'sessions': len(restored_ips),
+        'populate_s': populate,
+        'replay_ms': (replayed - started) * 1000,
+        'restore_ms': (restored - replayed) * 1000,
+        'firewall_batch_ms': (applied - restored) * 1000,
+        'total_ms': (applied - started) * 1000,
+    }
+    print(f"Sesiones restauradas: {results['sessions']} "
+          f"(journal poblado en {populate:.2f} s)")
+    print(f"  replay {results['replay_ms']:.0f} ms, tabla {results['restore_ms']:.0f} ms, "
+          f"lote firewall {results['firewall_batch_ms']:.0f} ms, "
+          f"total {results['total_ms']:.0f} ms")
+    return results
+
+
+def bench_hashing(args):
+    """Mide logins por segundo con distintos esquemas y costes de hash."""
+    configurations = [
+        ('pbkdf2_sha256', 100000),
+        ('pbkdf2_sha256', 600000),
+        ('scrypt', 2 ** 13),
+        ('scrypt', 2 ** 14),
+        ('scrypt', 2 ** 15),
+    ]
+    logins_per_thread = max(1, args.logins // args.concurrency)
+    results = {}
+
+    print(f"{args.concurrency} clientes, {logins_per_thread * args.concurrency} logins, "
+          f"{os.cpu_count()} núcleos")
+    for scheme, cost in configurations:
+        data_dir = tempfile.mkdtemp(prefix="portal-bench-")
+        user_manager = UserManager(
+            users_file=os.path.join(data_dir, "users.json"),
+            database_file=os.path.join(data_dir, "users.db"),
+            hasher=PasswordHasher(scheme, cost)
+        )
+
+        def client():
+            for _ in range(logins_per_thread):
+                user_manager.authenticate('admin', 'admin123')
+
+        threads = [Thread(target=client) for _ in range(args.concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        rate = logins_per_thread * args.concurrency / (time.perf_counter() - started)
+        results[f"{scheme}:{cost}"] = rate
+        print(f"  {scheme:>14} coste={cost:<7}: {rate:8.1f} logins/s")
+    return results
+
+
+# Cargas de bench_load: peso relativo de cada tipo de operación
+WORKLOADS = {
+    'probes': {'probe': 90, 'page': 10},
+    'logins': {'login': 60, 'failed_login': 30, 'logout': 10},
+    'mixed': {'probe': 55, 'page': 10, 'login': 15, 'failed_login': 10, 'logout': 10},
+}
+
+# Usuarios de prueba creados para bench_load
+LOAD_USERS = [(f"bench{i}", f"clave{i}") for i in range(100)]
+
+PROBE_PATHS = ['/generate_204', '/hotspot-detect.html', '/connecttest.txt', '/success.txt']
+
+
+def memory_usage_mb():
+    """
+    Devuelve la memoria residente actual y el pico del proceso en MB.
+
+    Returns:
+        Tupla (actual, pico)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576
+    except OSError:
+        current = peak
+    return current, peak
+
+
+def client_ips(count):
+    """
+    Genera direcciones de loopback para simular clientes distintos.
+
+    En Linux toda la red 127.0.0.0/8 es local, así que cada cliente puede
+    conectar desde su propia IP de origen.
+    """
+    return [f"127.{1 + i // 65536 % 254}.{i // 256 % 256}.{1 + i % 254}" for i in range(count)]
+
+
+def build_operation(operation, rng):
+    """
+    Construye la petición HTTP de una operación de carga.
+
+    Returns:
+        Tupla (método, ruta, cuerpo)
+    """
+    if operation == 'probe':
+        return 'GET', rng.choice(PROBE_PATHS), None
+    if operation == 'page':
+        return 'GET', '/', None
+    if operation == 'logout':
+        return 'POST', '/logout', ''
+    username, password = rng.choice(LOAD_USERS)
+    if operation == 'failed_login':
+        password += 'x'
+    return 'POST', '/login', urlencode({'username': username, 'password': password})
+
+
+def run_workload(port, weights, total_requests, concurrency, ips, seed):
+    """
+    Lanza una mezcla de operaciones desde muchas IPs de cliente.
+
+    Cada petición usa una conexión nueva, como los sondeos de los
+    dispositivos al unirse a la red.
+
+    Args:
+        port: Puerto del servidor
+        weights: Diccionario {operación: peso}
+        total_requests: Número total de peticiones
+        concurrency: Número de clientes simultáneos
+        ips: IPs de origen de los clientes simulados
+        seed: Semilla para que la mezcla sea reproducible
+
+    Returns:
+        Diccionario con las métricas de la carga
+    """
+    operations = list(weights)
+    cumulative_weights = []
+    total_weight = 0
+    for operation in operations:
+        total_weight += weights[operation]
+        cumulative_weights.append(total_weight)
+    per_client = total_requests // concurrency
+    latencies = [{} for _ in range(concurrency)]
+    errors = [0] * concurrency
+    headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Connection': 'close'}
+
+    def client(index):
+        rng = random.Random(seed + index)
+        own_ips = ips[index::concurrency] or ips
+        for _ in range(per_client):
+            operation = rng.choices(operations, cum_weights=cumulative_weights)[0]
+            method, path, body = build_operation(operation, rng)
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30,
+                                              source_address=(rng.choice(own_ips), 0))
+            started = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                if response.status >= 400:
+                    errors[index] += 1
+            except OSError:
+                errors[index] += 1
+            finally:
+                conn.close()
+            latencies[index].setdefault(operation, []).append(time.perf_counter() - started)
+
+    threads = [Thread(target=client, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    by_operation = {}
+    for client_latencies in latencies:
+        for operation, values in client_latencies.items():
+            by_operation.setdefault(operation, []).extend(values)
+    all_latencies = sorted(l for values in by_operation.values() for l in values)
+    operation_stats = {}
+    for operation, values in sorted(by_operation.items()):
+        values.sort()
+        operation_stats[operation] = {
+            'requests': len(values),
+            'p50_ms': percentile(values, 0.50) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000,
+        }
+    return {
+        'requests': len(all_latencies),
+        'errors': sum(errors),
+        'elapsed': elapsed,
+        'requests_per_second': len(all_latencies) / elapsed,
+        'p50_ms': percentile(all_latencies, 0.50) * 1000,
+        'p99_ms': percentile(all_latencies, 0.99) * 1000,
+        'operations': operation_stats,
+    }
+
+
+def bench_load(args):
+    """Mide rendimiento, latencias y memoria de cargas realistas."""
+    workloads = sorted(WORKLOADS) if args.workload == 'all' else [args.workload]
+    ips = client_ips(args.ips)
+
+    # Hash barato: se mide el servidor, no el coste de scrypt (ver hashing)
+    data_dir = tempfile.mkdtemp(prefix="portal-bench-")
+    user_manager = UserManager(
+        users_file=os.path.join(data_dir, "users.json"),
+        database_file=os.path.join(data_dir, "users.db"),
+        hasher=PasswordHasher('pbkdf2_sha256', 1000)
+    )
+    user_manager.import_users(LOAD_USERS)
+
+    results = {}
+    print(f"Motor: {args.engine}, {args.requests} peticiones por carga, "
+          f"{args.concurrency} clientes, {len(ips)} IPs")
+    for name in workloads:
+        memory_before, _ = memory_usage_mb()
+        # Sin límites de ritmo: se mide el camino de la petición
+        server, port = start_portal_server(
+            user_manager=user_manager, engine=args.engine, max_workers=args.concurrency,
+            ip_rate=None, username_rate=None)
+        try:
+            result = run_workload(port, WORKLOADS[name], args.requests,
+                                  args.concurrency, ips, args.seed)
+            result['sessions'] = server.session_manager.get_session_count()
+        finally:
+            server.stop()
+        memory_after, memory_peak = memory_usage_mb()
+        result['rss_mb'] = memory_after
+        result['rss_delta_mb'] = memory_after - memory_before
+        result['peak_rss_mb'] = memory_peak
+        results[name] = result
+
+        print(f"  {name:>8}: {result['requests_per_second']:8.0f} req/s  "
+              f"p50 {result['p50_ms']:.2f} ms  p99 {result['p99_ms']:.2f} ms  "
+              f"errores {result['errors']}  RSS {memory_after:.1f} MB "
+              f"({result['rss_delta_mb']:+.1f})")
+        for operation, stats in result['operations'].items():
+            print(f"      {operation:>13}: {stats['requests']:6d}  "
+                  f"p50 {stats['p50_ms']:.2f} ms  p99 {stats['p99_ms']:.2f} ms")
+    return results
+
+
+def git_commit():
+    """Devuelve el commit actual del repositorio, o None fuera de git."""
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def save_results(path, benchmark, args, results):
+    """Guarda los resultados con los datos necesarios para compararlos."""
+    document = {
+        'benchmark': benchmark,
+        'commit': git_commit(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'arguments': vars(args),
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+    print(f"Resultados guardados en {path}")
+
+
+def compare_results(path, results, threshold):
+    """
+    Compara los resultados de bench_load con una ejecución guardada.
+
+    Args:
+        path: Fichero JSON guardado con --output
+        results: Resultados de la ejecución actual
+        threshold: Fracción de empeoramiento tolerada
+
+    Returns:
+        True si ninguna carga empeoró más del umbral
+    """
+    with open(path) as f:
+        baseline = json.load(f)
+    print(f"Comparación con {path} (commit {baseline.get('commit')}):")
+    ok = True
+    for name, result in results.items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            continue
+        for key, higher_is_better in (('requests_per_second', True), ('p99_ms', False)):
+            before, after = previous[key], result[key]
+            change = (after - before) / before if before else 0.0
+            regression = -change if higher_is_better else change
+            flag = "REGRESIÓN" if regression > threshold else ""
+            if flag:
+                ok = False
+            print(f"  {name:>8} {key:>20}: {before:10.2f} -> {after:10.2f} "
+                  f"({change:+.1%}) {flag}")
+    return ok
+
+
+def wait_until(condition, timeout=60.0):
+    """Espera a que condition() sea cierta; devuelve los segundos esperados."""
+    started = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - started > timeout:
+            raise RuntimeError("Tiempo de espera agotado")
+        time.sleep(0.001)
+    return time.perf_counter() - started
+
+
+def bench_cluster(args):
+    """Mide lo que tardan --clients altas y bajas en llegar a --nodes nodos."""
+    # Reservar puertos libres de localhost para todos los nodos
+    ports = []
+    for _ in range(args.nodes):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            ports.append(sock.getsockname()[1])
+
+    nodes = []
+    for index, port in enumerate(ports):
+        peers = [('127.0.0.1', other) for other in ports if other != port]
+        replicator = SessionReplicator(
+            node_id=f"nodo{index}", secret="benchmark", host='127.0.0.1', port=port,
+            peers=peers, firewall_manager=FirewallManager(command_runner=fake_command_runner)
+        )
+        session_manager = SessionManager(replicator=replicator)
+        replicator.start(session_manager)
+        nodes.append((replicator, session_manager))
+
+    try:
+        wait_until(lambda: all(r.metrics()['connected_peers'] == args.nodes - 1
+                               for r, _ in nodes))
+        ips = [f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}" for i in range(args.clients)]
+        origin = nodes[0][1]
+        others = [session_manager for _, session_manager in nodes[1:]]
+
+        started = time.perf_counter()
+        for ip in ips:
+            origin.create_session(ip, f"usuario{hash(ip) % 1000}")
+        created = time.perf_counter() - started
+        create_converged = created + wait_until(
+            lambda: all(m.get_session_count() == args.clients for m in others))
+
+        started = time.perf_counter()
+        for ip in ips:
+            origin.end_session(ip)
+        ended = time.perf_counter() - started
+        end_converged = ended + wait_until(
+            lambda: all(m.get_session_count() == 0 for m in others))
+
+        metrics = [replicator.metrics() for replicator, _ in nodes]
+    finally:
+        for replicator, _ in nodes:
+            replicator.stop()
+
+    results = {
+        'nodes': args.nodes,
+        'sessions': args.clients,
+        'create_ms': create_converged * 1000,
+        'end_ms': end_converged * 1000,
+        'events_per_s': 2 * args.clients / (create_converged + end_converged),
+        'batches': metrics[0]['sent_batches'],
+        'firewall_batches': sum(m['firewall_batches'] for m in metrics[1:]),
+    }
+    print(f"Nodos: {args.nodes}, sesiones: {args.clients}")
+    print(f"  altas replicadas en {results['create_ms']:.0f} ms, "
+          f"bajas en {results['end_ms']:.0f} ms "
+          f"({results['events_per_s']:.0f} eventos/s)")
+    print(f"  lotes enviados {results['batches']}, "
+          f"lotes de firewall aplicados {results['firewall_batches']}")
+    return results
+
+
+BENCHMARKS = {
+    'keepalive': bench_keepalive,
+    'tls': bench_tls,
+    'sessions': bench_sessions,
+    'journal': bench_journal,
+    'hashing': bench_hashing,
+    'load': bench_load,
+    'cluster': bench_cluster,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks del portal cautivo")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--engine', default='threadpool')
+    parser.add_argument('--path', default='/')
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--workload', choices=['all'] + sorted(WORKLOADS), default='all')
+    parser.add_argument('--ips', type=int, default=2000)
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--cert')
+    parser.add_argument('--key')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--threshold', type=float, default=0.10)
+    args = parser.parse_args()
+    results = BENCHMARKS[args.benchmark](args)
+
+    if args.output:
+        save_results(args.output, args.benchmark, args, results)
+    if args.compare and args.benchmark == 'load':
+        if not compare_results(args.compare, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
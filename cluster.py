@@ -0,0 +1,417 @@
+"""
+Módulo de replicación de sesiones entre nodos del portal cautivo.
+Varios portales detrás de la misma red comparten la tabla de sesiones:
+cada alta, baja y vencimiento se envía a los demás nodos, de modo que un
+cliente que cambia de punto de acceso no vuelve a iniciar sesión.
+"""
+
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import os
+import socket
+import socketserver
+import time
+from threading import BoundedSemaphore, Condition, Lock, Thread
+
+
+# Eventos por mensaje: acota el tamaño de cada línea incluso en la
+# instantánea inicial, que se envía en varios mensajes
+MAX_BATCH_EVENTS = 100
+
+# Tamaño máximo de una línea recibida; se lee con este límite antes de
+# comprobar la firma, así que una conexión ajena no puede agotar la memoria
+MAX_MESSAGE_BYTES = 1024 * 1024
+
+
+class ReplicationHandler(socketserver.StreamRequestHandler):
+    """Recibe los lotes de eventos de un nodo: una línea firmada por lote."""
+
+    def handle(self):
+        replicator = self.server.replicator
+        peer = self.client_address[0]
+        if not replicator.connection_slots.acquire(blocking=False):
+            replicator.logger.warning(f"Conexión de replicación rechazada desde {peer}: "
+                                      f"demasiadas conexiones")
+            return
+        try:
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            while True:
+                line = self.rfile.readline(MAX_MESSAGE_BYTES + 1)
+                if not line:
+                    return
+                if not line.endswith(b"\n"):
+                    # Línea demasiado larga o cortada: se cierra sin leer más
+                    replicator.rejected_messages += 1
+                    replicator.logger.warning(f"Mensaje de replicación demasiado largo "
+                                              f"desde {peer}")
+                    return
+                message = replicator.decode(line)
+                if message is None:
+                    replicator.logger.warning(f"Mensaje de replicación no válido desde {peer}")
+                    return
+                replicator.receive(message)
+        finally:
+            replicator.connection_slots.release()
+
+
+class ReplicationServer(socketserver.ThreadingTCPServer):
+    """Servidor TCP que acepta las conexiones de los demás nodos."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def verify_request(self, request, client_address):
+        """Solo se aceptan conexiones desde las direcciones de los nodos."""
+        if client_address[0] in self.replicator.peer_addresses:
+            return True
+        self.replicator.logger.warning(
+            f"Conexión de replicación rechazada desde {client_address[0]}")
+        return False
+
+
+class PeerLink:
+    """
+    Conexión saliente hacia un nodo.
+
+    Los eventos se acumulan en memoria y un hilo los envía en lotes, un
+    lote por escritura. Al (re)conectar se envía primero una instantánea
+    completa, que cubre lo que se perdiera mientras el nodo no estaba
+    disponible.
+    """
+
+    def __init__(self, replicator, host, port):
+        self.replicator = replicator
+        self.host = host
+        self.port = port
+        self.condition = Condition()
+        self.pending = []
+        self.running = False
+        self.connected = False
+        self.thread = None
+
+        # Métricas
+        self.sent_events = 0
+        self.sent_batches = 0
+        self.connects = 0
+
+    def start(self):
+        with self.condition:
+            self.running = True
+        self.thread = Thread(target=self._send_loop, name=f"cluster-{self.host}:{self.port}",
+                             daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def enqueue(self, event):
+        with self.condition:
+            # Sin conexión los eventos se descartan: la instantánea del
+            # siguiente intento de conexión ya los incluye
+            if self.connected:
+                self.pending.append(event)
+                self.condition.notify()
+
+    def _send_loop(self):
+        replicator = self.replicator
+        while True:
+            with self.condition:
+                if not self.running:
+                    return
+            try:
+                conn = socket.create_connection((self.host, self.port),
+                                                timeout=replicator.connect_timeout)
+            except OSError:
+                with self.condition:
+                    if self.running:
+                        self.condition.wait(replicator.reconnect_interval)
+                continue
+
+            try:
+                with conn:
+                    # Los eventos posteriores a la instantánea se encolan
+                    with self.condition:
+                        self.connected = True
+                        self.pending = []
+                    self.connects += 1
+                    replicator.logger.info(f"Conectado al nodo {self.host}:{self.port}")
+                    self._send(conn, replicator.session_manager.replication_snapshot())
+                    while True:
+                        with self.condition:
+                            while self.running and not self.pending:
+                                self.condition.wait()
+                            batch = self.pending
+                            self.pending = []
+                            running = self.running
+                        if batch:
+                            self._send(conn, batch)
+                        if not running:
+                            return
+            except OSError as e:
+                replicator.logger.warning(f"Conexión con el nodo {self.host}:{self.port} "
+                                          f"perdida: {e}")
+            finally:
+                with self.condition:
+                    self.connected = False
+                    self.pending = []
+
+    def _send(self, conn, events):
+        for start in range(0, len(events), MAX_BATCH_EVENTS):
+            conn.sendall(self.replicator.encode(events[start:start + MAX_BATCH_EVENTS]))
+            self.sent_batches += 1
+        self.sent_events += len(events)
+
+
+class SessionReplicator:
+    """
+    Replica la tabla de sesiones entre los nodos de un clúster.
+
+    SessionManager entrega cada evento local (alta, baja, vencimiento)
+    con una versión (instante, nodo); los eventos se envían a todos los
+    nodos por TCP y cada nodo aplica los remotos solo si son más recientes
+    que la última versión conocida de esa IP. Cada nodo sigue leyendo su
+    propia tabla en memoria, así que is_authenticated no sale del proceso.
+
+    Los cambios de firewall que provoca cada lote recibido se aplican
+    juntos. Los mensajes se firman con HMAC-SHA256 y una clave compartida,
+    y llevan dentro de la firma el arranque del emisor, un número de
+    secuencia y la hora de envío: un mensaje repetido o antiguo se
+    rechaza. Solo se aceptan conexiones de las direcciones de los nodos.
+    """
+
+    def __init__(self, node_id, secret, host, port=7400, peers=(),
+                 firewall_manager=None, firewall_queue=None, reconnect_interval=2.0,
+                 connect_timeout=5.0, tombstone_ttl=3600, max_message_age=60.0):
+        """
+        Inicializa el replicador.
+
+        Args:
+            node_id: Identificador único del nodo
+            secret: Clave compartida por todos los nodos
+            host: Dirección de este nodo en la red del clúster (no se admite
+                una dirección comodín: la red de clientes no debe alcanzarlo)
+            port: Puerto de replicación
+            peers: Lista de (host, puerto) de los demás nodos
+            firewall_manager: FirewallManager que aplica los eventos remotos
+            firewall_queue: FirewallWorkQueue opcional para esos cambios
+            reconnect_interval: Segundos entre intentos de conexión a un nodo
+            connect_timeout: Segundos máximos de conexión y de escritura
+            tombstone_ttl: Segundos que se recuerda la baja de una IP
+            max_message_age: Segundos tras los que un mensaje se considera
+                antiguo (los relojes de los nodos deben estar sincronizados)
+        """
+        if not secret:
+            raise ValueError("La replicación de sesiones necesita una clave compartida")
+        if host in (None, "", "0.0.0.0", "::"):
+            raise ValueError("La replicación de sesiones debe escuchar en la dirección "
+                             "del nodo en la red del clúster")
+        self.node_id = node_id
+        self.key = secret.encode() if isinstance(secret, str) else secret
+        self.host = host
+        self.port = port
+        self.firewall_manager = firewall_manager
+        self.firewall_queue = firewall_queue
+        self.reconnect_interval = reconnect_interval
+        self.connect_timeout = connect_timeout
+        self.tombstone_ttl = tombstone_ttl
+        self.max_message_age = max_message_age
+        self.links = [PeerLink(self, peer_host, peer_port) for peer_host, peer_port in peers]
+        self.peer_addresses = {socket.gethostbyname(peer_host) for peer_host, _ in peers}
+        # Una conexión por nodo, más una de reserva por reconexión
+        self.connection_slots = BoundedSemaphore(max(1, 2 * len(self.links)))
+
+        # Protección frente a repeticiones: cada arranque firma sus mensajes
+        # con un identificador aleatorio y una secuencia creciente
+        self.boot_id = os.urandom(8).hex()
+        self.sequence = itertools.count(1)
+        self.sequence_lock = Lock()
+        self.last_sequences = {}  # {(nodo, arranque): (secuencia, hora de envío)}
+        self.session_manager = None
+        self.traffic_accountant = None
+        self.server = None
+        self.server_thread = None
+        self.condition = Condition()
+        self.running = False
+        self.maintenance_thread = None
+        self.logger = logging.getLogger(__name__)
+
+        # Métricas
+        self.received_events = 0
+        self.applied_events = 0
+        self.rejected_messages = 0
+        self.firewall_batches = 0
+
+    def start(self, session_manager, traffic_accountant=None):
+        """
+        Empieza a escuchar a los demás nodos y a enviarles eventos.
+
+        Args:
+            session_manager: SessionManager creado con este replicador
+            traffic_accountant: TrafficAccountant opcional que contabilizar
+                antes de retirar las reglas de las sesiones terminadas
+        """
+        self.session_manager = session_manager
+        self.traffic_accountant = traffic_accountant
+        self.server = ReplicationServer((self.host, self.port), ReplicationHandler)
+        self.server.replicator = self
+        self.server_thread = Thread(target=self.server.serve_forever, name="cluster-server",
+                                    daemon=True)
+        self.server_thread.start()
+        for link in self.links:
+            link.start()
+        with self.condition:
+            self.running = True
+        self.maintenance_thread = Thread(target=self._maintenance_loop,
+                                         name="cluster-maintenance", daemon=True)
+        self.maintenance_thread.start()
+        self.logger.info(f"Replicación de sesiones del nodo '{self.node_id}' en "
+                         f"{self.host}:{self.port} con {len(self.links)} nodos")
+
+    def stop(self):
+        """Envía los eventos pendientes y cierra las conexiones."""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.maintenance_thread:
+            self.maintenance_thread.join()
+            self.maintenance_thread = None
+        for link in self.links:
+            link.stop()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def publish(self, event):
+        """
+        Envía un evento local a todos los nodos (llamado por SessionManager).
+
+        Args:
+            event: Diccionario del evento (ver SessionManager.replication_event)
+        """
+        for link in self.links:
+            link.enqueue(event)
+
+    def encode(self, events):
+        """Serializa un lote de eventos como una línea firmada."""
+        body = json.dumps({'node': self.node_id, 'boot': self.boot_id,
+                           'seq': next(self.sequence), 'sent': time.time(),
+                           'events': events},
+                          separators=(',', ':')).encode()
+        signature = hmac.new(self.key, body, hashlib.sha256).hexdigest().encode()
+        return signature + b" " + body + b"\n"
+
+    def decode(self, line):
+        """Verifica y deserializa una línea; None si no es válida."""
+        signature, _, body = line.rstrip(b"\n").partition(b" ")
+        expected = hmac.new(self.key, body, hashlib.sha256).hexdigest().encode()
+        if not hmac.compare_digest(signature, expected):
+            self.rejected_messages += 1
+            return None
+        try:
+            message = json.loads(body)
+        except ValueError:
+            self.rejected_messages += 1
+            return None
+        if not self._accept_sequence(message):
+            self.rejected_messages += 1
+            return None
+        return message
+
+    def _accept_sequence(self, message):
+        """Rechaza mensajes antiguos o ya recibidos (repeticiones)."""
+        now = time.time()
+        sent = message.get('sent', 0)
+        if abs(now - sent) > self.max_message_age:
+            return False
+        key = (message.get('node'), message.get('boot'))
+        sequence = message.get('seq', 0)
+        with self.sequence_lock:
+            last = self.last_sequences.get(key)
+            if last is not None and sequence <= last[0]:
+                return False
+            self.last_sequences[key] = (sequence, sent)
+            # Los arranques sin mensajes recientes ya no pueden repetirse
+            if len(self.last_sequences) > 4 * len(self.links) + 4:
+                limit = now - self.max_message_age
+                for stale in [k for k, (_, t) in self.last_sequences.items() if t < limit]:
+                    del self.last_sequences[stale]
+        return True
+
+    def receive(self, message):
+        """
+        Aplica un lote de eventos de otro nodo.
+
+        Los cambios de firewall de todo el lote se aplican de una vez.
+
+        Args:
+            message: Mensaje decodificado con 'node' y 'events'
+        """
+        if message.get('node') == self.node_id:
+            return
+        operations = []
+        ended = {}  # {ip: usuario} de las sesiones terminadas
+        applied = 0
+        for event in message.get('events', []):
+            change = self.session_manager.apply_replicated(event)
+            if change is None:
+                continue
+            applied += 1
+            ip_address, previous, current = change
+            if current is None:
+                operations.append(("block", ip_address, previous.mac))
+                ended[ip_address] = previous.username
+            elif previous is None:
+                operations.append(("allow", ip_address, current.mac))
+            elif previous.mac != current.mac:
+                operations.append(("unbind", ip_address, previous.mac))
+                operations.append(("allow", ip_address, current.mac))
+        self.received_events += len(message.get('events', []))
+        self.applied_events += applied
+
+        # Las bajas remotas retiran reglas locales: su tráfico desde la
+        # última lectura se cuenta antes
+        if self.traffic_accountant is not None:
+            self.traffic_accountant.settle(ended)
+
+        if operations:
+            self.firewall_batches += 1
+            if self.firewall_queue is not None:
+                for action, ip_address, mac_address in operations:
+                    self.firewall_queue.submit(action, ip_address, mac_address)
+            elif self.firewall_manager is not None:
+                self.firewall_manager.apply_batch(operations)
+
+    def metrics(self):
+        """Devuelve las métricas de la replicación."""
+        return {
+            'peers': len(self.links),
+            'connected_peers': sum(1 for link in self.links if link.connected),
+            'sent_events': sum(link.sent_events for link in self.links),
+            'sent_batches': sum(link.sent_batches for link in self.links),
+            'received_events': self.received_events,
+            'applied_events': self.applied_events,
+            'rejected_messages': self.rejected_messages,
+            'firewall_batches': self.firewall_batches,
+        }
+
+    def _maintenance_loop(self):
+        """Olvida periódicamente las bajas antiguas."""
+        while True:
+            with self.condition:
+                if self.running:
+                    self.condition.wait(self.tombstone_ttl / 4)
+                if not self.running:
+                    return
+            try:
+                self.session_manager.prune_tombstones(self.tombstone_ttl)
+            except Exception as e:
+                self.logger.error(f"Error limpiando versiones de sesiones: {e}")
@@ -1,127 +1,934 @@
+import json
 import subprocess
 import logging
-from threading import Lock
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Condition, Lock, Thread
+
+
+def run_subprocess(command, input=None):
+
+    return subprocess.run(
+        command,
+        input=input,
+        capture_output=True,
+        text=True,
+        check=False
+    )
+
+
+# Backend clásico: una regla FORWARD por cada IP autenticada. El kernel
+# recorre la cadena entera por paquete, así que el coste crece con el
+# número de usuarios.
+class IptablesBackend:
+
+    name = "iptables"
+
+    def __init__(self, interface, bind_macs=False):
+
+        self.interface = interface
+        # Con bind_macs cada autorización exige además la MAC del cliente
+        self.bind_macs = bind_macs
+
+    def setup_commands(self):
+
+        return [
+            ["sysctl", "-w", "net.ipv4.ip_forward=1"],
+            ["iptables", "-A", "INPUT", "-i", "lo", "-j", "ACCEPT"],
+            # Permitir conexiones establecidas y relacionadas
+            ["iptables", "-A", "FORWARD", "-m", "state",
+             "--state", "ESTABLISHED,RELATED", "-j", "ACCEPT"],
+            # Bloquear todo el forwarding por defecto (política DROP)
+            ["iptables", "-P", "FORWARD", "DROP"],
+            # Habilitar NAT para las conexiones autorizadas
+            ["iptables", "-t", "nat", "-A", "POSTROUTING",
+             "-o", self.interface, "-j", "MASQUERADE"],
+        ]
+
+    @staticmethod
+    def _rule(ip_address, mac_address):
+
+        rule = ["-s", ip_address]
+        if mac_address:
+            rule.extend(["-m", "mac", "--mac-source", mac_address])
+        return rule + ["-j", "ACCEPT"]
+
+    @staticmethod
+    def _parse_rule(parts):
+
+        # parts son los campos de la regla tras "-A FORWARD"; devuelve
+        # (ip, mac) si es una regla de cliente o None
+        if parts[:1] != ["-s"] or parts[-2:] != ["-j", "ACCEPT"]:
+            return None
+        if len(parts) == 4:
+            mac = None
+        elif len(parts) == 8 and parts[2:5] == ["-m", "mac", "--mac-source"]:
+            mac = parts[5].lower()
+        else:
+            return None
+        ip = parts[1]
+        if ip.endswith("/32"):
+            ip = ip[:-3]
+        return ip, mac
+
+    def allow_commands(self, ip_address, mac_address=None):
+
+        return [["iptables", "-A", "FORWARD"] + self._rule(ip_address, mac_address)]
+
+    def block_commands(self, ip_address, mac_address=None):
+
+        return [["iptables", "-D", "FORWARD"] + self._rule(ip_address, mac_address)]
+
+    def batch_command(self, operations):
+
+        # Todas las operaciones se aplican de forma atómica en un solo
+        # iptables-restore; si una falla no se aplica ninguna. Retirar un
+        # vínculo ("unbind") es borrar su regla, igual que bloquear
+        lines = ["*filter"]
+        for action, ip_address, mac_address in operations:
+            flag = "-A" if action == "allow" else "-D"
+            lines.append(" ".join([flag, "FORWARD"] + self._rule(ip_address, mac_address)))
+        lines.append("COMMIT")
+        return ["iptables-restore", "--noflush"], "\n".join(lines) + "\n"
+
+    def teardown_commands(self):
+
+        return [
+            # Establecer políticas por defecto a ACCEPT
+            ["iptables", "-P", "INPUT", "ACCEPT"],
+            ["iptables", "-P", "FORWARD", "ACCEPT"],
+            ["iptables", "-P", "OUTPUT", "ACCEPT"],
+            # Limpiar todas las reglas
+            ["iptables", "-F"],
+            ["iptables", "-X"],
+            # Limpiar reglas de NAT
+            ["iptables", "-t", "nat", "-F"],
+            ["iptables", "-t", "nat", "-X"],
+            ["sysctl", "-w", "net.ipv4.ip_forward=0"],
+        ]
+
+    def list_command(self):
+
+        # Formato de iptables-save: estable y con una regla por línea
+        return ["iptables-save", "-t", "filter"]
+
+    def parse_allowed(self, output):
+
+        # Devuelve {(ip, mac): número de reglas}; más de una regla por par
+        # indica duplicados (p. ej. dos -A tras un doble login)
+        allowed = {}
+        for line in output.split('\n'):
+            parts = line.split()
+            if parts[:2] != ["-A", "FORWARD"]:
+                continue
+            key = self._parse_rule(parts[2:])
+            if key is not None:
+                allowed[key] = allowed.get(key, 0) + 1
+        return allowed
+
+    def counters_command(self):
+
+        return ["iptables-save", "-c", "-t", "filter"]
+
+    def parse_counters(self, output):
+
+        # Contadores [paquetes:bytes] de la regla de cada IP. La regla de
+        # conexiones establecidas va antes, así que solo cuentan los paquetes
+        # que abren conexión: para contabilidad completa usar ipset o nftables
+        counters = {}
+        for line in output.split('\n'):
+            parts = line.split()
+            if parts[1:3] != ["-A", "FORWARD"] or not parts[0].startswith("["):
+                continue
+            key = self._parse_rule(parts[3:])
+            if key is not None:
+                ip = key[0]
+                counters[ip] = counters.get(ip, 0) + int(parts[0].strip("[]").split(":")[1])
+        return counters
+
+
+def combine_bindings(allowed_ips, bindings):
+
+    # Une las IPs autorizadas de un set con sus vínculos {ip: [macs]} en
+    # {(ip, mac): 1}. Una IP sin vínculo figura como (ip, None); los
+    # vínculos de IPs que ya no están autorizadas no dan acceso y se ignoran
+    allowed = {}
+    for ip in allowed_ips:
+        for mac in bindings.get(ip) or [None]:
+            allowed[(ip, mac)] = 1
+    return allowed
+
+
+# Backend con ipset: una única regla FORWARD que consulta un set hash:ip.
+# El match por paquete es O(1) y autorizar o revocar una IP solo añade o
+# elimina un miembro del set.
+class IpsetBackend(IptablesBackend):
+
+    name = "ipset"
+
+    def __init__(self, interface, set_name="portal_allowed", max_elements=65536,
+                 bind_macs=False):
+
+        super().__init__(interface, bind_macs)
+        self.set_name = set_name
+        # Con bind_macs, pares ip,mac autorizados a enviar tráfico
+        self.mac_set_name = f"{set_name}_mac"
+        self.max_elements = max_elements
+
+    def setup_commands(self):
+
+        commands = super().setup_commands()
+        # Cada miembro lleva contadores de paquetes y bytes (ver parse_counters)
+        commands.insert(1, [
+            "ipset", "create", self.set_name, "hash:ip",
+            "maxelem", str(self.max_elements), "counters", "-exist"
+        ])
+        # Descartar miembros que hayan quedado de una ejecución anterior
+        commands.insert(2, ["ipset", "flush", self.set_name])
+        uplink = ["-m", "set", "--match-set", self.set_name, "src"]
+        if self.bind_macs:
+            commands.insert(3, [
+                "ipset", "create", self.mac_set_name, "hash:ip,mac",
+                "maxelem", str(self.max_elements), "-exist"
+            ])
+            commands.insert(4, ["ipset", "flush", self.mac_set_name])
+            # El par ip,mac se consulta primero: el set de IPs, que lleva los
+            # contadores, solo se consulta si la MAC es la del vínculo
+            uplink = ["-m", "set", "--match-set", self.mac_set_name, "src,src"] + uplink
+        # Ambas reglas van antes de la de conexiones establecidas para que
+        # todo el tráfico de un cliente pase por exactamente una consulta
+        # al set: la subida en la primera y la bajada en la segunda
+        commands.extend([
+            ["iptables", "-I", "FORWARD", "1"] + uplink + ["-j", "ACCEPT"],
+            ["iptables", "-I", "FORWARD", "2", "-m", "state",
+             "--state", "ESTABLISHED,RELATED", "-m", "set",
+             "--match-set", self.set_name, "dst", "-j", "ACCEPT"],
+        ])
+        return commands
+
+    def allow_commands(self, ip_address, mac_address=None):
+
+        commands = [["ipset", "add", self.set_name, ip_address, "-exist"]]
+        if mac_address:
+            commands.append(["ipset", "add", self.mac_set_name,
+                             f"{ip_address},{mac_address}", "-exist"])
+        return commands
+
+    def block_commands(self, ip_address, mac_address=None):
+
+        commands = [["ipset", "del", self.set_name, ip_address, "-exist"]]
+        if mac_address:
+            commands.insert(0, ["ipset", "del", self.mac_set_name,
+                                f"{ip_address},{mac_address}", "-exist"])
+        return commands
+
+    def batch_command(self, operations):
+
+        # "unbind" solo retira el vínculo: la IP sigue autorizada para el
+        # dispositivo que la tiene ahora
+        lines = []
+        for action, ip_address, mac_address in operations:
+            if action == "allow":
+                lines.append(f"add {self.set_name} {ip_address}")
+                if mac_address:
+                    lines.append(f"add {self.mac_set_name} {ip_address},{mac_address}")
+                continue
+            if mac_address:
+                lines.append(f"del {self.mac_set_name} {ip_address},{mac_address}")
+            if action == "block":
+                lines.append(f"del {self.set_name} {ip_address}")
+        return ["ipset", "restore", "-exist"], "\n".join(lines) + "\n"
+
+    def teardown_commands(self):
+
+        # El set solo puede destruirse cuando ninguna regla lo referencia
+        commands = super().teardown_commands()
+        commands.insert(-1, ["ipset", "destroy", self.set_name])
+        if self.bind_macs:
+            commands.insert(-1, ["ipset", "destroy", self.mac_set_name])
+        return commands
+
+    def list_command(self):
+
+        if self.bind_macs:
+            # Ambos sets en una sola llamada
+            return ["ipset", "list", "-o", "save"]
+        return ["ipset", "list", self.set_name, "-o", "save"]
+
+    def parse_allowed(self, output):
+
+        allowed_ips = []
+        bindings = {}
+        for line in output.split('\n'):
+            parts = line.split()
+            if len(parts) < 3 or parts[0] != 'add':
+                continue
+            if parts[1] == self.set_name:
+                allowed_ips.append(parts[2])
+            elif self.bind_macs and parts[1] == self.mac_set_name:
+                ip, _, mac = parts[2].partition(',')
+                bindings.setdefault(ip, []).append(mac.lower())
+        return combine_bindings(allowed_ips, bindings)
+
+    def counters_command(self):
+
+        return ["ipset", "list", self.set_name, "-o", "save"]
+
+    def parse_counters(self, output):
+
+        # Líneas "add SET IP packets N bytes M"
+        counters = {}
+        for line in output.split('\n'):
+            parts = line.split()
+            if len(parts) >= 3 and parts[0] == 'add' and parts[1] == self.set_name:
+                try:
+                    counters[parts[2]] = int(parts[parts.index("bytes") + 1])
+                except (ValueError, IndexError):
+                    counters[parts[2]] = 0
+        return counters
+
+
+# Backend nftables: tabla propia con un set de direcciones y cadenas con
+# política DROP, sin tocar las reglas iptables del sistema.
+class NftablesBackend:
+
+    name = "nftables"
+
+    def __init__(self, interface, table="captive_portal", set_name="allowed",
+                 max_elements=65536, bind_macs=False):
+
+        self.interface = interface
+        self.table = table
+        self.nat_table = f"{table}_nat"
+        self.set_name = set_name
+        # Con bind_macs, pares ip . mac autorizados a enviar tráfico
+        self.bind_macs = bind_macs
+        self.mac_set_name = f"{set_name}_mac"
+        self.max_elements = max_elements
+
+    def setup_commands(self):
+
+        uplink = ["ip", "saddr", f"@{self.set_name}"]
+        if self.bind_macs:
+            # El par se consulta primero: el contador de la IP solo avanza
+            # si la MAC es la del vínculo
+            uplink = ["ip", "saddr", ".", "ether", "saddr", f"@{self.mac_set_name}"] + uplink
+        commands = [
+            ["sysctl", "-w", "net.ipv4.ip_forward=1"],
+            ["nft", "add", "table", "inet", self.table],
+            # Cada elemento lleva su contador (ver parse_counters)
+            ["nft", "add", "set", "inet", self.table, self.set_name,
+             f"{{ type ipv4_addr; size {self.max_elements}; counter; }}"],
+            ["nft", "add", "chain", "inet", self.table, "forward",
+             "{ type filter hook forward priority 0; policy drop; }"],
+            # Subida y bajada de los clientes autorizados pasan por una única
+            # consulta al set antes de la regla general de establecidas
+            ["nft", "add", "rule", "inet", self.table, "forward"] + uplink + ["accept"],
+            ["nft", "add", "rule", "inet", self.table, "forward",
+             "ct", "state", "established,related",
+             "ip", "daddr", f"@{self.set_name}", "accept"],
+            ["nft", "add", "rule", "inet", self.table, "forward",
+             "ct", "state", "established,related", "accept"],
+            ["nft", "add", "table", "ip", self.nat_table],
+            ["nft", "add", "chain", "ip", self.nat_table, "postrouting",
+             "{ type nat hook postrouting priority 100; }"],
+            ["nft", "add", "rule", "ip", self.nat_table, "postrouting",
+             "oifname", self.interface, "masquerade"],
+        ]
+        if self.bind_macs:
+            commands.insert(3, ["nft", "add", "set", "inet", self.table, self.mac_set_name,
+                                f"{{ type ipv4_addr . ether_addr; size {self.max_elements}; }}"])
+        return commands
+
+    def allow_commands(self, ip_address, mac_address=None):
+
+        commands = [["nft", "add", "element", "inet", self.table, self.set_name,
+                     f"{{ {ip_address} }}"]]
+        if mac_address:
+            commands.append(["nft", "add", "element", "inet", self.table, self.mac_set_name,
+                             f"{{ {ip_address} . {mac_address} }}"])
+        return commands
+
+    def block_commands(self, ip_address, mac_address=None):
+
+        commands = [["nft", "delete", "element", "inet", self.table, self.set_name,
+                     f"{{ {ip_address} }}"]]
+        if mac_address:
+            commands.insert(0, ["nft", "delete", "element", "inet", self.table,
+                                self.mac_set_name, f"{{ {ip_address} . {mac_address} }}"])
+        return commands
+
+    def batch_command(self, operations):
+
+        # nft -f aplica el fichero completo como una única transacción
+        lines = []
+        for action, ip_address, mac_address in operations:
+            elements = []
+            if mac_address:
+                elements.append(f"element inet {self.table} {self.mac_set_name} "
+                                f"{{ {ip_address} . {mac_address} }}")
+            if action != "unbind":
+                elements.append(f"element inet {self.table} {self.set_name} "
+                                f"{{ {ip_address} }}")
+            for element in elements:
+                lines.append(f"add {element}")
+                if action != "allow":
+                    # Añadir antes de borrar hace el borrado idempotente: delete
+                    # de un elemento inexistente abortaría toda la transacción
+                    lines.append(f"delete {element}")
+        return ["nft", "-f", "-"], "\n".join(lines) + "\n"
+
+    def teardown_commands(self):
+
+        return [
+            ["nft", "delete", "table", "inet", self.table],
+            ["nft", "delete", "table", "ip", self.nat_table],
+            ["sysctl", "-w", "net.ipv4.ip_forward=0"],
+        ]
+
+    def list_command(self):
+
+        if self.bind_macs:
+            # La tabla completa incluye ambos sets
+            return ["nft", "-j", "list", "table", "inet", self.table]
+        return self.counters_command()
+
+    def parse_allowed(self, output):
+
+        allowed_ips = []
+        bindings = {}
+        for item in json.loads(output).get("nftables", []):
+            nft_set = item.get("set")
+            if not nft_set:
+                continue
+            for elem in nft_set.get("elem", []):
+                # Los elementos con contadores llegan como {"elem": {"val": ...}}
+                # y los pares como {"concat": [ip, mac]}
+                if isinstance(elem, dict) and "elem" in elem:
+                    elem = elem["elem"].get("val")
+                if nft_set.get("name") == self.set_name and isinstance(elem, str):
+                    allowed_ips.append(elem)
+                elif (nft_set.get("name") == self.mac_set_name and isinstance(elem, dict)
+                      and len(elem.get("concat", ())) == 2):
+                    ip, mac = elem["concat"]
+                    bindings.setdefault(ip, []).append(mac.lower())
+        return combine_bindings(allowed_ips, bindings)
+
+    def counters_command(self):
+
+        return ["nft", "-j", "list", "set", "inet", self.table, self.set_name]
+
+    def parse_counters(self, output):
+
+        # Elementos {"elem": {"val": IP, "counter": {"packets": N, "bytes": M}}}
+        counters = {}
+        for item in json.loads(output).get("nftables", []):
+            for elem in item.get("set", {}).get("elem", []):
+                if isinstance(elem, dict):
+                    elem = elem.get("elem", {})
+                    ip = elem.get("val")
+                    if isinstance(ip, str):
+                        counters[ip] = elem.get("counter", {}).get("bytes", 0)
+                elif isinstance(elem, str):
+                    counters[elem] = 0
+        return counters
+
+
+FIREWALL_BACKENDS = {
+    "iptables": IptablesBackend,
+    "ipset": IpsetBackend,
+    "nftables": NftablesBackend,
+}
+
+
+# Agrupa operaciones allow/block para aplicarlas con una sola invocación.
+# Usado como context manager confirma los cambios al salir del bloque.
+class FirewallTransaction:
+
+    def __init__(self, manager):
+
+        self.manager = manager
+        self.operations = []
+        self.success = None
+
+    def allow_ip(self, ip_address, mac_address=None):
+
+        self.operations.append(("allow", ip_address, mac_address))
+
+    def block_ip(self, ip_address, mac_address=None):
+
+        self.operations.append(("block", ip_address, mac_address))
+
+    def unbind_ip(self, ip_address, mac_address):
+
+        # Retira el vínculo de una MAC sin revocar la IP
+        self.operations.append(("unbind", ip_address, mac_address))
+
+    def commit(self):
+
+        self.success = self.manager.apply_batch(self.operations)
+        self.operations = []
+        return self.success
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+
+        # Si el bloque lanzó una excepción no se aplica nada
+        if exc_type is None:
+            self.commit()
+        return False
+
 
 class FirewallManager:
-     
-    
-    def __init__(self, interface="eth0"):
-         
+
+
+    def __init__(self, interface="eth0", backend="ipset", command_runner=None,
+                 metrics=None, bind_macs=False):
+
+        if backend not in FIREWALL_BACKENDS:
+            raise ValueError(f"Backend de firewall desconocido: {backend}")
+
         self.interface = interface
+        # Con bind_macs las reglas exigen el par (IP, MAC) de cada sesión;
+        # sin él las MAC recibidas se ignoran
+        self.bind_macs = bind_macs
+        self.backend = FIREWALL_BACKENDS[backend](interface, bind_macs=bind_macs)
+        # Permite sustituir la ejecución de binarios (p. ej. en pruebas sin root)
+        self.command_runner = command_runner or run_subprocess
+        # PortalMetrics opcional donde registrar latencia y fallos (ver metrics.py)
+        self.metrics = metrics
         self.lock = Lock()
         self.logger = logging.getLogger(__name__)
-    
-    def _run_command(self, command):
-        
+
+    def _run_command(self, command, input=None):
+
+        started = time.perf_counter()
+        success = False
         try:
-            result = subprocess.run(
-                command,
-                capture_output=True,
-                text=True,
-                check=False
-            )
+            result = self.command_runner(command, input=input)
             if result.returncode != 0:
                 self.logger.error(f"Error ejecutando comando: {' '.join(command)}")
                 self.logger.error(f"Error: {result.stderr}")
                 return False
+            success = True
             return True
         except Exception as e:
             self.logger.error(f"Excepción al ejecutar comando: {e}")
             return False
-    
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_firewall_command(
+                    command[0], time.perf_counter() - started, success)
+
+    def _run_commands(self, commands):
+
+        success = True
+        for command in commands:
+            success = self._run_command(command) and success
+        return success
+
     def setup_initial_rules(self):
-         
+
         with self.lock:
-            # Permitir tráfico local
-            self._run_command(["sysctl", "-w", "net.ipv4.ip_forward=1"])
-            self._run_command(["iptables", "-A", "INPUT", "-i", "lo", "-j", "ACCEPT"])
-            
-            # Permitir conexiones establecidas y relacionadas
-            self._run_command([
-                "iptables", "-A", "FORWARD", "-m", "state",
-                "--state", "ESTABLISHED,RELATED", "-j", "ACCEPT"
-            ])
-            
-            # Bloquear todo el forwarding por defecto (política DROP)
-            self._run_command(["iptables", "-P", "FORWARD", "DROP"])
-            
-            # Habilitar NAT para las conexiones autorizadas
-            self._run_command([
-                "iptables", "-t", "nat", "-A", "POSTROUTING",
-                "-o", self.interface, "-j", "MASQUERADE"
-            ])
-            
-            self.logger.info("Reglas iniciales de firewall configuradas")
-    
-    def allow_ip(self, ip_address):
-         
+            self._run_commands(self.backend.setup_commands())
+            self.logger.info(f"Reglas iniciales de firewall configuradas ({self.backend.name})")
+
+    def _binding(self, mac_address):
+
+        return mac_address if self.bind_macs else None
+
+    def allow_ip(self, ip_address, mac_address=None):
+
+        mac_address = self._binding(mac_address)
         with self.lock:
             # Permitir forwarding desde esta IP
-            success = self._run_command([
-                "iptables", "-A", "FORWARD",
-                "-s", ip_address, "-j", "ACCEPT"
-            ])
-            
-            #  "iptables", "-I", "FORWARD", "1",
-            #     "-s", ip_address, "-j", "ACCEPT"
+            success = self._run_commands(self.backend.allow_commands(ip_address, mac_address))
+
             if success:
-                self.logger.info(f"IP permitida: {ip_address}")
-            
+                self.logger.info(f"IP permitida: {ip_address}"
+                                 + (f" ({mac_address})" if mac_address else ""))
+
             return success
 
-    def block_ip(self, ip_address):
-         
+    def block_ip(self, ip_address, mac_address=None):
+
+        mac_address = self._binding(mac_address)
         with self.lock:
-            # Eliminar regla que permite forwarding desde esta IP
-            success = self._run_command([
-                "iptables", "-D", "FORWARD",
-                "-s", ip_address, "-j", "ACCEPT"
-            ])
-            
+            # Eliminar el permiso de forwarding desde esta IP
+            success = self._run_commands(self.backend.block_commands(ip_address, mac_address))
+
             if success:
                 self.logger.info(f"IP bloqueada: {ip_address}")
-            
+
             return success
-    
+
+    def transaction(self):
+
+        return FirewallTransaction(self)
+
+    def apply_batch(self, operations):
+
+        if not operations:
+            return True
+
+        # Las retiradas van antes que las altas: retirar el vínculo anterior
+        # de una IP no debe anular el nuevo que llega en el mismo lote
+        operations = sorted(
+            ((action, ip, self._binding(mac)) for action, ip, mac in operations),
+            key=lambda operation: operation[0] == "allow"
+        )
+        command, script = self.backend.batch_command(operations)
+        with self.lock:
+            success = self._run_command(command, input=script)
+            if not success and len(operations) > 1:
+                # El lote es atómico: una sola operación imposible (p. ej.
+                # borrar una regla que ya no existe) lo anularía entero. Se
+                # reintenta operación a operación para no perder las demás
+                self.logger.warning("Lote de firewall rechazado; aplicando operaciones por separado")
+                results = [self._run_command(*self.backend.batch_command([operation]))
+                           for operation in operations]
+                success = all(results)
+
+        allowed = sum(1 for operation in operations if operation[0] == "allow")
+        if success:
+            self.logger.info(
+                f"Lote de firewall aplicado: {allowed} permitidas, "
+                f"{len(operations) - allowed} bloqueadas"
+            )
+        return success
+
     def clear_rules(self):
-         
+
         with self.lock:
-            # Establecer políticas por defecto a ACCEPT
-            self._run_command(["iptables", "-P", "INPUT", "ACCEPT"])
-            self._run_command(["iptables", "-P", "FORWARD", "ACCEPT"])
-            self._run_command(["iptables", "-P", "OUTPUT", "ACCEPT"])
-            
-            # Limpiar todas las reglas
-            print("La pinga")
-            self._run_command(["iptables", "-F"])
-            self._run_command(["iptables", "-X"])
-            
-            # Limpiar reglas de NAT
-            self._run_command(["iptables", "-t", "nat", "-F"])
-            self._run_command(["iptables", "-t", "nat", "-X"])
-            self._run_command(["sysctl", "-w", "net.ipv4.ip_forward=0"])
+            self._run_commands(self.backend.teardown_commands())
             self.logger.info("Reglas de firewall limpiadas")
-    
-    def list_allowed_ips(self):
-         
+
+    def read_allowed_state(self):
+
+        # Lee el estado del kernel de una sola vez: {(ip, mac): número de
+        # reglas}, con mac None si la regla no exige MAC, o None si no se
+        # pudo leer
         try:
-            result = subprocess.run(
-                ["iptables", "-L", "FORWARD", "-n", "-v"],
-                capture_output=True,
-                text=True,
-                check=False
-            )
-            
-            allowed_ips = []
-            for line in result.stdout.split('\n'):
-                if 'ACCEPT' in line and 'state ESTABLISHED,RELATED' not in line:
-                    parts = line.split()
-                    if len(parts) > 7:
-                        ip = parts[7]
-                        if ip != '0.0.0.0/0' and ip != 'anywhere':
-                            allowed_ips.append(ip)
-            
-            return allowed_ips
+            result = self.command_runner(self.backend.list_command())
+            if result.returncode != 0:
+                self.logger.error(f"Error leyendo el estado del firewall: {result.stderr}")
+                return None
+            return self.backend.parse_allowed(result.stdout)
         except Exception as e:
-            self.logger.error(f"Error listando IPs permitidas: {e}")
-            return []
\ No newline at end of file
+            self.logger.error(f"Error leyendo el estado del firewall: {e}")
+            return None
+
+    def read_counters(self):
+
+        # Bytes acumulados por IP autorizada con una sola llamada, o None
+        # si no se pudieron leer
+        try:
+            result = self.command_runner(self.backend.counters_command())
+            if result.returncode != 0:
+                self.logger.error(f"Error leyendo contadores del firewall: {result.stderr}")
+                return None
+            return self.backend.parse_counters(result.stdout)
+        except Exception as e:
+            self.logger.error(f"Error leyendo contadores del firewall: {e}")
+            return None
+
+    def list_allowed_ips(self):
+
+        allowed = self.read_allowed_state()
+        return list(dict.fromkeys(ip for ip, _ in allowed)) if allowed else []
+
+
+
+# Cola de operaciones de firewall con un hilo aplicador dedicado. Las
+# operaciones pendientes sobre el mismo par (IP, MAC) se fusionan (solo
+# cuenta la última, que siempre se aplica) y todo lo acumulado se aplica en un único lote, fuera del camino de las
+# peticiones HTTP.
+class FirewallWorkQueue:
+
+    def __init__(self, firewall_manager):
+
+        self.firewall_manager = firewall_manager
+        # {(ip, mac): [acción, [futures], instante de encolado]}
+        self.pending = OrderedDict()
+        self.condition = Condition()
+        self.running = False
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+        # Métricas
+        self.submitted = 0
+        self.coalesced = 0
+        self.applied = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_apply_latency = 0.0
+        self.max_apply_latency = 0.0
+        self.total_apply_latency = 0.0
+        self.max_queue_wait = 0.0
+
+    def start(self):
+
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = Thread(target=self._apply_loop, name="firewall-queue", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+
+        # Las operaciones pendientes se aplican antes de terminar
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def allow_ip(self, ip_address, mac_address=None):
+
+        return self.submit("allow", ip_address, mac_address)
+
+    def block_ip(self, ip_address, mac_address=None):
+
+        return self.submit("block", ip_address, mac_address)
+
+    def unbind_ip(self, ip_address, mac_address):
+
+        return self.submit("unbind", ip_address, mac_address)
+
+    def submit(self, action, ip_address, mac_address=None):
+
+        future = Future()
+        # Sin vinculación todas las operaciones de una IP comparten entrada
+        key = (ip_address, mac_address if self.firewall_manager.bind_macs else None)
+        with self.condition:
+            self.submitted += 1
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [action, [future], time.monotonic()]
+            else:
+                # Duplicada o que anula a la anterior: gana la última
+                self.coalesced += 1
+                entry[0] = action
+                entry[1].append(future)
+            self.condition.notify()
+        return future
+
+    def depth(self):
+
+        with self.condition:
+            return len(self.pending)
+
+    def pending_ips(self):
+
+        with self.condition:
+            return {ip for ip, _ in self.pending}
+
+    def metrics(self):
+
+        with self.condition:
+            return {
+                "depth": len(self.pending),
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "applied": self.applied,
+                "failed": self.failed,
+                "batches": self.batches,
+                "last_apply_latency": self.last_apply_latency,
+                "max_apply_latency": self.max_apply_latency,
+                "avg_apply_latency": (self.total_apply_latency / self.batches
+                                      if self.batches else 0.0),
+                "max_queue_wait": self.max_queue_wait,
+            }
+
+    def _apply_loop(self):
+
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                batch = self.pending
+                self.pending = OrderedDict()
+
+            started = time.monotonic()
+            operations = [(entry[0], ip, mac) for (ip, mac), entry in batch.items()]
+            try:
+                success = self.firewall_manager.apply_batch(operations)
+            except Exception as e:
+                self.logger.error(f"Error aplicando lote de firewall: {e}")
+                success = False
+            finished = time.monotonic()
+
+            with self.condition:
+                latency = finished - started
+                self.batches += 1
+                self.last_apply_latency = latency
+                self.max_apply_latency = max(self.max_apply_latency, latency)
+                self.total_apply_latency += latency
+                self.max_queue_wait = max(
+                    self.max_queue_wait,
+                    max(started - entry[2] for entry in batch.values())
+                )
+                if success:
+                    self.applied += len(operations)
+                else:
+                    self.failed += len(operations)
+
+            for entry in batch.values():
+                for future in entry[1]:
+                    future.set_result(success)
+
+
+# Compara el estado real del kernel con la tabla de sesiones y corrige la
+# deriva: sesiones sin regla, reglas sin sesión (o de otra MAC) y reglas
+# duplicadas. Con vinculación de MAC se comparan pares (IP, MAC).
+# Cada pasada lee el kernel una vez, calcula la diferencia en O(n) y
+# aplica solo los cambios necesarios en un único lote.
+class FirewallReconciler:
+
+    def __init__(self, firewall_manager, session_manager, firewall_queue=None,
+                 interval=60.0):
+
+        self.firewall_manager = firewall_manager
+        self.session_manager = session_manager
+        # Las IPs con operaciones en cola se dejan a la cola
+        self.firewall_queue = firewall_queue
+        self.interval = interval
+        self.condition = Condition()
+        self.running = False
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+        # Métricas
+        self.passes = 0
+        self.failed_passes = 0
+        self.total_missing = 0
+        self.total_stale = 0
+        self.total_duplicates = 0
+        self.last_report = None
+
+    def start(self):
+
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = Thread(target=self._reconcile_loop, name="firewall-reconciler",
+                             daemon=True)
+        self.thread.start()
+
+    def stop(self):
+
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    # Con dry_run solo se calcula la diferencia: no se toca el kernel ni
+    # las métricas, para poder consultarla desde status()
+    def reconcile(self, dry_run=False):
+
+        started = time.monotonic()
+
+        # El kernel se lee antes que las sesiones: una regla añadida tras un
+        # login siempre tiene ya su sesión en la tabla
+        kernel = self.firewall_manager.read_allowed_state()
+        if kernel is None:
+            if not dry_run:
+                with self.condition:
+                    self.failed_passes += 1
+            return None
+        bindings = self.session_manager.get_session_bindings()
+        if not self.firewall_manager.bind_macs:
+            bindings = dict.fromkeys(bindings)
+        sessions = set(bindings.items())
+        pending = self.firewall_queue.pending_ips() if self.firewall_queue else set()
+
+        missing = [key for key in sessions if key not in kernel and key[0] not in pending]
+        stale = [key for key in kernel if key not in sessions and key[0] not in pending]
+        duplicates = {key: count - 1 for key, count in kernel.items()
+                      if count > 1 and key in sessions}
+
+        # Cada "block" elimina una regla: las IPs sin sesión pierden todas
+        # las suyas y las duplicadas se quedan con una. Si la IP tiene sesión
+        # con otra MAC solo se retira el vínculo antiguo
+        operations = [("allow", ip, mac) for ip, mac in missing]
+        for ip, mac in stale:
+            action = "unbind" if ip in bindings else "block"
+            operations.extend([(action, ip, mac)] * kernel[(ip, mac)])
+        for (ip, mac), extra in duplicates.items():
+            operations.extend([("block", ip, mac)] * extra)
+
+        if dry_run:
+            return {
+                "kernel": len(kernel),
+                "sessions": len(sessions),
+                "missing": len(missing),
+                "stale": len(stale),
+                "duplicates": sum(duplicates.values()),
+                "operations": len(operations),
+                "success": None,
+                "duration": time.monotonic() - started,
+            }
+        success = self.firewall_manager.apply_batch(operations)
+
+        report = {
+            "kernel": len(kernel),
+            "sessions": len(sessions),
+            "missing": len(missing),
+            "stale": len(stale),
+            "duplicates": sum(duplicates.values()),
+            "operations": len(operations),
+            "success": success,
+            "duration": time.monotonic() - started,
+        }
+        with self.condition:
+            self.passes += 1
+            if not success:
+                self.failed_passes += 1
+            self.total_missing += report["missing"]
+            self.total_stale += report["stale"]
+            self.total_duplicates += report["duplicates"]
+            self.last_report = report
+
+        if operations:
+            self.logger.warning(
+                f"Deriva de firewall corregida: {report['missing']} sin regla, "
+                f"{report['stale']} sin sesión, {report['duplicates']} duplicadas "
+                f"({report['duration'] * 1000:.0f} ms)"
+            )
+        return report
+
+    def metrics(self):
+
+        with self.condition:
+            return {
+                "passes": self.passes,
+                "failed_passes": self.failed_passes,
+                "total_missing": self.total_missing,
+                "total_stale": self.total_stale,
+                "total_duplicates": self.total_duplicates,
+                "last_report": self.last_report,
+            }
+
+    def _reconcile_loop(self):
+
+        while True:
+            with self.condition:
+                if self.running:
+                    self.condition.wait(self.interval)
+                if not self.running:
+                    return
+            try:
+                self.reconcile()
+            except Exception as e:
+                self.logger.error(f"Error reconciliando el firewall: {e}")
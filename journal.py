@@ -0,0 +1,234 @@
+"""
+Módulo del journal de sesiones del portal cautivo.
+Persiste las altas y bajas de sesión en un fichero de solo anexado para
+reconstruir la tabla de sesiones tras un reinicio.
+"""
+
+import json
+import logging
+import os
+import time
+from threading import Condition, Lock, Thread
+
+
+class SessionJournal:
+    """
+    Journal de sesiones con escritura en lotes y compactación periódica.
+
+    Los eventos se acumulan en memoria y un hilo escritor los vuelca al
+    fichero, con un único fsync por lote. La compactación reescribe el
+    fichero con una instantánea de las sesiones vivas, lo que además
+    refresca su última actividad.
+
+    Anotar un evento solo toma el lock del buffer, y la escritura en disco
+    ocurre fuera de él (con io_lock), así que las altas y bajas de sesión
+    nunca esperan a un fsync ni a una compactación.
+
+    Un volcado fallido no pierde eventos: sus líneas vuelven al buffer y
+    la siguiente compactación reescribe el fichero entero, descartando
+    lo que quedara a medio escribir.
+    """
+
+    def __init__(self, journal_file="sessions.journal", sync_interval=1.0,
+                 compact_interval=60.0, compact_min_records=10000):
+        """
+        Inicializa el journal.
+
+        Args:
+            journal_file: Ruta al fichero del journal
+            sync_interval: Segundos máximos entre volcados a disco
+            compact_interval: Segundos entre compactaciones
+            compact_min_records: Registros anexados que fuerzan una compactación
+        """
+        self.journal_file = journal_file
+        self.sync_interval = sync_interval
+        self.compact_interval = compact_interval
+        self.compact_min_records = compact_min_records
+        self.condition = Condition()
+        self.io_lock = Lock()
+        self.buffer = []
+        self.records_since_compaction = 0
+        self.snapshot_source = None
+        self.file = None
+        self.thread = None
+        self.running = False
+        self.logger = logging.getLogger(__name__)
+
+        # Métricas
+        self.failed_flushes = 0
+
+    def replay(self):
+        """
+        Lee el journal y reconstruye el estado de las sesiones.
+
+        Returns:
+            Diccionario {ip: (usuario, hora de login, última actividad, mac)}
+        """
+        sessions = {}
+        if not os.path.exists(self.journal_file):
+            return sessions
+
+        with open(self.journal_file, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Última línea truncada por una caída a mitad de escritura
+                    self.logger.warning("Registro de journal corrupto ignorado")
+                    continue
+                if record['op'] == 'c':
+                    sessions[record['ip']] = (record['u'], record['l'], record['a'],
+                                              record.get('m'))
+                else:
+                    sessions.pop(record['ip'], None)
+        return sessions
+
+    def start(self, snapshot_source):
+        """
+        Abre el journal para escritura e inicia el hilo escritor.
+
+        Args:
+            snapshot_source: Función que devuelve las sesiones vivas como
+                {ip: SessionInfo}, usada en las compactaciones
+        """
+        self.snapshot_source = snapshot_source
+        # Compactar al arrancar descarta el historial ya reproducido
+        self._compact()
+        self.running = True
+        self.thread = Thread(target=self._writer_loop, name="session-journal", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Vuelca los eventos pendientes, compacta y cierra el journal."""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        # Sin start() no hay instantánea: compactar dejaría el journal vacío
+        if self.snapshot_source is None:
+            return
+        self._compact()
+        with self.io_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def record_create(self, ip_address, username, login_time, last_activity,
+                      mac_address=None):
+        """Registra el alta de una sesión."""
+        record = {'op': 'c', 'ip': ip_address, 'u': username,
+                  'l': login_time, 'a': last_activity}
+        if mac_address is not None:
+            record['m'] = mac_address
+        self._append(record)
+
+    def record_end(self, ip_addresses):
+        """Registra la baja de una o varias sesiones."""
+        for ip_address in ip_addresses:
+            self._append({'op': 'e', 'ip': ip_address})
+
+    def _append(self, record):
+        """Añade un registro al buffer del siguiente lote."""
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.condition:
+            self.buffer.append(line)
+
+    def _writer_loop(self):
+        """Vuelca lotes periódicamente y compacta cuando corresponde."""
+        last_compaction = time.monotonic()
+        while True:
+            with self.condition:
+                if self.running:
+                    self.condition.wait(self.sync_interval)
+                if not self.running:
+                    return
+
+            self._flush()
+
+            now = time.monotonic()
+            if (now - last_compaction >= self.compact_interval
+                    or self.records_since_compaction >= self.compact_min_records):
+                self._compact()
+                last_compaction = now
+
+    def _take_buffer(self):
+        """Retira el buffer pendiente; es lo único hecho con el lock del buffer."""
+        with self.condition:
+            lines = self.buffer
+            self.buffer = []
+            return lines
+
+    def _restore_buffer(self, lines):
+        """Devuelve al buffer, por delante, líneas que no se pudieron escribir."""
+        with self.condition:
+            self.buffer = lines + self.buffer
+
+    def _flush(self):
+        """Escribe el buffer en el fichero con un único fsync."""
+        with self.io_lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        """Como _flush(); llamar con io_lock tomado."""
+        if self.file is None:
+            return
+        lines = self._take_buffer()
+        if not lines:
+            return
+        try:
+            self.file.write(''.join(lines))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.records_since_compaction += len(lines)
+        except OSError as e:
+            self.logger.error(f"Error escribiendo el journal de sesiones: {e}")
+            self.failed_flushes += 1
+            self._restore_buffer(lines)
+            # El fichero puede acabar en una línea cortada: no se anexa más
+            # en él hasta que la compactación lo reescriba
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+            self.records_since_compaction = self.compact_min_records
+
+    def _compact(self):
+        """Reescribe el journal con una instantánea de las sesiones vivas."""
+        with self.io_lock:
+            # La instantánea se toma sin el lock del buffer: las sesiones
+            # anotan sus eventos mientras tienen tomado su propio lock
+            self._flush_locked()
+            sessions = self.snapshot_source() if self.snapshot_source else {}
+
+            # Los eventos anotados durante la instantánea se reescriben tras
+            # ella: volver a aplicarlos en orden deja cada IP en su último
+            # estado. Los posteriores quedan en el buffer para el fichero nuevo
+            pending = self._take_buffer()
+            lines = []
+            for ip, info in sessions.items():
+                record = {'op': 'c', 'ip': ip, 'u': info.username,
+                          'l': info.login_time, 'a': info.last_activity}
+                if info.mac is not None:
+                    record['m'] = info.mac
+                lines.append(json.dumps(record, separators=(',', ':')) + '\n')
+            lines.extend(pending)
+
+            temp_file = self.journal_file + '.tmp'
+            try:
+                with open(temp_file, 'w') as f:
+                    f.write(''.join(lines))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_file, self.journal_file)
+            except OSError as e:
+                self.logger.error(f"Error compactando el journal de sesiones: {e}")
+                self._restore_buffer(pending)
+                return
+
+            if self.file is not None:
+                self.file.close()
+            self.file = open(self.journal_file, 'a')
+            self.records_since_compaction = 0
@@ -5,14 +5,33 @@ import time
 from threading import Thread
 
 from users import UserManager
-from sessions import SessionManager
-from firewall import FirewallManager
-from server import CaptivePortalServer
+from sessions import SessionManager, format_timestamp
+from journal import SessionJournal
+from accounting import TrafficAccountant
+from activity import ActivityTracker
+from shaping import TrafficShaper
+from metrics import MetricsServer, PortalMetrics
+from accesslog import AccessLog
+from neighbors import NeighborCache, SessionRoaming
+from cluster import SessionReplicator
+from firewall import FirewallManager, FirewallReconciler, FirewallWorkQueue
+from server import PROBE_RESPONSES, CaptivePortalServer
 
 class CaptivePortal:
      
     
-    def __init__(self, interface="eth0", port=80, session_timeout=3600):
+    def __init__(self, interface="eth0", port=80, session_timeout=3600,
+                 server_engine="threadpool", max_workers=32,
+                 firewall_backend="ipset", journal_file="sessions.journal",
+                 reconcile_interval=60, accounting_interval=10, default_quota=None,
+                 usage_file="traffic_usage.json",
+                 shaping_interface=None, shaping_uplink_rate="100mbit",
+                 shaping_tiers=None, user_tiers=None, admin_port=9100,
+                 access_log_file="access.log", bind_macs=False, neighbor_interface=None,
+                 neighbor_refresh_interval=30, cluster_node_id=None, cluster_host=None,
+                 cluster_port=7400, cluster_peers=(), cluster_secret=None,
+                 activity_source="counters", activity_interval=30, tls_port=None,
+                 tls_cert_file=None, tls_key_file=None):
          
         self.interface = interface
         self.port = port
@@ -27,27 +46,180 @@ class CaptivePortal:
         # Inicializar componentes
         self.logger.info("Inicializando componentes del portal cautivo...")
         
+        self.metrics = PortalMetrics()
         self.user_manager = UserManager()
-        self.session_manager = SessionManager(session_timeout=session_timeout)
-        self.firewall_manager = FirewallManager(interface=interface)
+        self.session_journal = SessionJournal(journal_file=journal_file)
+        
+        # Control de ancho de banda opcional en la interfaz de la red local
+        self.traffic_shaper = None
+        if shaping_interface:
+            self.traffic_shaper = TrafficShaper(
+                interface=shaping_interface,
+                uplink_rate=shaping_uplink_rate,
+                tiers=shaping_tiers,
+                user_tiers=user_tiers
+            )
+        
+        self.firewall_manager = FirewallManager(
+            interface=interface,
+            backend=firewall_backend,
+            metrics=self.metrics,
+            bind_macs=bind_macs
+        )
+        self.firewall_queue = FirewallWorkQueue(self.firewall_manager)
+        
+        # Replicación opcional de las sesiones con otros nodos del portal
+        self.session_replicator = None
+        if cluster_node_id:
+            self.session_replicator = SessionReplicator(
+                node_id=cluster_node_id,
+                secret=cluster_secret,
+                host=cluster_host,
+                port=cluster_port,
+                peers=cluster_peers,
+                firewall_manager=self.firewall_manager,
+                firewall_queue=self.firewall_queue
+            )
+        
+        self.session_manager = SessionManager(
+            session_timeout=session_timeout,
+            journal=self.session_journal,
+            shaper=self.traffic_shaper,
+            metrics=self.metrics,
+            replicator=self.session_replicator
+        )
+        self.firewall_reconciler = FirewallReconciler(
+            self.firewall_manager,
+            self.session_manager,
+            firewall_queue=self.firewall_queue,
+            interval=reconcile_interval
+        )
+        self.traffic_accountant = TrafficAccountant(
+            self.firewall_manager,
+            self.session_manager,
+            firewall_queue=self.firewall_queue,
+            interval=accounting_interval,
+            default_quota=default_quota,
+            usage_file=usage_file
+        )
+        
+        # Actividad de red leída del kernel: las sesiones vencen cuando el
+        # cliente deja de usar la red, no cuando deja de visitar el portal
+        # Con "counters" se reutilizan las lecturas de la contabilidad, así
+        # que el firewall se consulta una sola vez cada accounting_interval
+        self.activity_tracker = None
+        if activity_source:
+            self.activity_tracker = ActivityTracker(
+                self.session_manager,
+                firewall_manager=self.firewall_manager,
+                source=activity_source,
+                interval=activity_interval,
+                traffic_accountant=self.traffic_accountant
+            )
+        
+        # Vinculación de sesiones al par (IP, MAC) con la tabla de vecinos en
+        # memoria; los dispositivos que cambian de IP conservan su sesión
+        self.neighbor_cache = None
+        self.session_roaming = None
+        if bind_macs:
+            self.neighbor_cache = NeighborCache(
+                interface=neighbor_interface,
+                refresh_interval=neighbor_refresh_interval
+            )
+            self.session_roaming = SessionRoaming(
+                self.session_manager,
+                self.firewall_manager,
+                firewall_queue=self.firewall_queue,
+                traffic_accountant=self.traffic_accountant
+            )
+            self.neighbor_cache.add_listener(self.session_roaming.neighbors_changed)
+        
+        # Registro de accesos escrito fuera de los hilos de petición
+        self.access_log = None
+        if access_log_file:
+            self.access_log = AccessLog(log_file=access_log_file, probe_paths=PROBE_RESPONSES)
         
         self.server = CaptivePortalServer(
             host='192.168.137.1',
             port=port,
             user_manager=self.user_manager,
             session_manager=self.session_manager,
-            firewall_manager=self.firewall_manager
+            firewall_manager=self.firewall_manager,
+            firewall_queue=self.firewall_queue,
+            traffic_accountant=self.traffic_accountant,
+            metrics=self.metrics,
+            access_log=self.access_log,
+            neighbor_cache=self.neighbor_cache,
+            session_roaming=self.session_roaming,
+            tls_port=tls_port,
+            tls_cert_file=tls_cert_file,
+            tls_key_file=tls_key_file,
+            engine=server_engine,
+            max_workers=max_workers
         )
         
+        # Métricas en un puerto de administración aparte (solo local)
+        self.metrics_server = MetricsServer(self.metrics, port=admin_port) if admin_port else None
+        self._register_gauges()
+        
         # Hilo para limpieza de sesiones
         self.cleanup_thread = None
         self.running = False
 
+    def _register_gauges(self):
+        
+        # Valores de estado calculados solo cuando se consultan las métricas
+        gauges = [
+            ("portal_sessions", "Sesiones activas",
+             self.session_manager.get_session_count),
+            ("portal_firewall_queue_depth", "Operaciones de firewall pendientes",
+             self.firewall_queue.depth),
+            ("portal_firewall_drift_total", "Reglas corregidas por la reconciliación",
+             lambda: sum(v for k, v in self.firewall_reconciler.metrics().items()
+                         if k.startswith("total_"))),
+            ("portal_traffic_bytes_total", "Bytes contabilizados a los usuarios",
+             lambda: self.traffic_accountant.metrics()["total_bytes"]),
+            ("portal_http_connections", "Conexiones HTTP abiertas",
+             lambda: self.server.connection_limiter.metrics()["open"]),
+            ("portal_journal_failed_flushes_total",
+             "Volcados del journal de sesiones fallidos y reintentados",
+             lambda: self.session_journal.failed_flushes),
+        ]
+        if self.access_log:
+            gauges.append(("portal_access_log_dropped_total",
+                           "Eventos descartados por la cola del registro de accesos",
+                           lambda: self.access_log.dropped))
+        if self.neighbor_cache:
+            gauges.append(("portal_neighbor_entries", "Entradas de la tabla de vecinos",
+                           lambda: len(self.neighbor_cache.table)))
+            gauges.append(("portal_roamed_sessions_total",
+                           "Sesiones trasladadas a la nueva IP de su dispositivo",
+                           lambda: self.session_roaming.roamed))
+        if self.activity_tracker:
+            gauges.append(("portal_active_clients",
+                           "Clientes con tráfico en la última lectura de actividad",
+                           lambda: self.activity_tracker.active_ips))
+        if self.session_replicator:
+            gauges.append(("portal_cluster_connected_peers", "Nodos del clúster conectados",
+                           lambda: self.session_replicator.metrics()["connected_peers"]))
+            gauges.append(("portal_cluster_applied_events_total",
+                           "Eventos de sesión de otros nodos aplicados",
+                           lambda: self.session_replicator.applied_events))
+        if self.traffic_shaper:
+            gauges.append(("portal_shaped_clients", "Clientes con clase de ancho de banda",
+                           lambda: self.traffic_shaper.metrics()["classes"]))
+        for name, help_text, function in gauges:
+            self.metrics.add_gauge(name, help_text, function)
+
     def setup(self):
          
         self.logger.info("Configurando reglas de firewall...")
         self.firewall_manager.setup_initial_rules()
         self.logger.info("Firewall configurado correctamente")
+        
+        if self.traffic_shaper:
+            self.traffic_shaper.setup()
+            self.traffic_shaper.start()
     
     def start(self):
          
@@ -58,8 +230,36 @@ class CaptivePortal:
         # Configurar firewall
         self.setup()
         
+        # Recuperar las sesiones del journal antes de aceptar peticiones
+        self.restore_sessions()
+        
+        # Iniciar cola de operaciones de firewall
+        self.firewall_queue.start()
+        
+        # Iniciar reconciliación periódica del firewall con las sesiones
+        self.firewall_reconciler.start()
+        
+        # Iniciar contabilidad de tráfico y cuotas
+        self.traffic_accountant.start()
+        
+        # Iniciar seguimiento de la actividad de red de los clientes
+        if self.activity_tracker:
+            self.activity_tracker.start()
+        
+        # Sincronizar las sesiones con los demás nodos
+        if self.session_replicator:
+            self.session_replicator.start(self.session_manager, self.traffic_accountant)
+        
+        # Leer la tabla de vecinos antes de atender logins
+        if self.neighbor_cache:
+            self.neighbor_cache.start()
+        
         # Iniciar servidor HTTP
+        if self.access_log:
+            self.access_log.start()
         self.server.start()
+        if self.metrics_server:
+            self.metrics_server.start()
         
         # Iniciar hilo de limpieza de sesiones
         self.running = True
@@ -68,7 +268,7 @@ class CaptivePortal:
         
         self.logger.info(f"Portal cautivo activo en puerto {self.port}")
         self.logger.info(f"Interfaz de red: {self.interface}")
-        self.logger.info(f"Usuarios registrados: {len(self.user_manager.list_users())}")
+        self.logger.info(f"Usuarios registrados: {self.user_manager.count_users()}")
         self.logger.info("=" * 60)
         self.logger.info("Presiona Ctrl+C para detener el servidor")
         self.logger.info("=" * 60)
@@ -79,31 +279,84 @@ class CaptivePortal:
         
         # Detener servidor HTTP
         self.server.stop()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        if self.access_log:
+            self.access_log.stop()
+        if self.neighbor_cache:
+            self.neighbor_cache.stop()
+        if self.session_replicator:
+            self.session_replicator.stop()
         
         # Detener hilo de limpieza
         self.running = False
+        self.session_manager.wake_expiry_waiters()
+        
+        # Detener la reconciliación y la contabilidad y aplicar las
+        # operaciones pendientes
+        self.firewall_reconciler.stop()
+        self.traffic_accountant.stop()
+        if self.activity_tracker:
+            self.activity_tracker.stop()
+        self.firewall_queue.stop()
+        
+        # Persistir las sesiones: sobreviven al reinicio aunque se revoquen
+        # ahora en el firewall
+        self.session_journal.stop()
         
         # Bloquear todas las IPs autenticadas
         self.logger.info("Revocando accesos...")
-        for ip in list(self.session_manager.sessions.keys()):
-            self.firewall_manager.block_ip(ip)
+        with self.firewall_manager.transaction() as tx:
+            for ip, mac in self.session_manager.get_session_bindings().items():
+                tx.block_ip(ip, mac)
         
         # Limpiar reglas de firewall
         self.logger.info("Limpiando reglas de firewall...")
         self.firewall_manager.clear_rules()
         
+        # Retirar el control de ancho de banda
+        if self.traffic_shaper:
+            self.traffic_shaper.stop()
+            self.traffic_shaper.teardown()
+        
         self.logger.info("Portal cautivo detenido correctamente")
     
+    def restore_sessions(self):
+        
+        started = time.monotonic()
+        
+        records = self.session_journal.replay()
+        restored_ips = self.session_manager.restore_sessions(records)
+        
+        # Reaplicar todo el estado del firewall en un único lote
+        with self.firewall_manager.transaction() as tx:
+            for ip, mac in restored_ips.items():
+                tx.allow_ip(ip, mac)
+        
+        self.session_journal.start(self.session_manager.get_all_sessions)
+        
+        elapsed = time.monotonic() - started
+        self.logger.info(f"Sesiones restauradas: {len(restored_ips)} en {elapsed * 1000:.0f} ms")
+        return restored_ips
+    
     def _cleanup_sessions_loop(self):
          
         while self.running:
-            time.sleep(60)  # Verificar cada minuto
+            # Dormir exactamente hasta el próximo vencimiento de sesión
+            self.session_manager.wait_for_expiry()
+            if not self.running:
+                break
             
-            expired_ips = self.session_manager.cleanup_expired_sessions()
+            expired = self.session_manager.cleanup_expired_sessions()
             
-            for ip in expired_ips:
+            # Última lectura de contadores antes de que desaparezcan las reglas
+            self.traffic_accountant.settle(
+                {ip: session.username for ip, session in expired.items()})
+            
+            # La cola agrupa todos los bloqueos en un único lote
+            for ip, session in expired.items():
                 self.logger.info(f"Sesión expirada para IP: {ip}")
-                self.firewall_manager.block_ip(ip)
+                self.firewall_queue.block_ip(ip, session.mac)
     
     def status(self):
         
@@ -116,7 +369,9 @@ class CaptivePortal:
         self.logger.info(f"Sesiones activas: {len(sessions)}")
         
         for ip, info in sessions.items():
-            self.logger.info(f"  - {ip}: {info['username']} (login: {info['login_time']})")
+            usage = self.traffic_accountant.get_usage(info.username)
+            self.logger.info(f"  - {ip}: {info.username} (login: {format_timestamp(info.login_time)}, "
+                             f"tráfico: {usage / 1048576:.1f} MB)")
         
         # Usuarios registrados
         users = self.user_manager.list_users()
@@ -130,6 +385,30 @@ class CaptivePortal:
         for ip in allowed_ips:
             self.logger.info(f"  - {ip}")
         
+        # Cola de firewall
+        queue_metrics = self.firewall_queue.metrics()
+        self.logger.info(
+            f"\nCola de firewall: {queue_metrics['depth']} pendientes, "
+            f"{queue_metrics['batches']} lotes, "
+            f"latencia media {queue_metrics['avg_apply_latency'] * 1000:.1f} ms"
+        )
+        
+        # Deriva entre el firewall y las sesiones, sin corregirla: el estado
+        # solo lee, la corrección es cosa de la reconciliación periódica
+        report = self.firewall_reconciler.reconcile(dry_run=True)
+        if report is not None:
+            self.logger.info(
+                f"Deriva actual: {report['kernel']} reglas, {report['sessions']} sesiones, "
+                f"{report['missing']} sin regla, {report['stale']} sin sesión, "
+                f"{report['duplicates']} duplicadas ({report['duration'] * 1000:.1f} ms)"
+            )
+        last_report = self.firewall_reconciler.metrics()["last_report"]
+        if last_report is not None:
+            self.logger.info(
+                f"Última reconciliación: {last_report['operations']} cambios, "
+                f"{'correcta' if last_report['success'] else 'con errores'}"
+            )
+        
         self.logger.info("=" * 60 + "\n")
 
 
@@ -149,6 +428,34 @@ if __name__ == "__main__":
         INTERFACE = "eth0"  # Cambiar según tu interfaz de red
         PORT = 80          # Puerto HTTP (requiere privilegios de root)
         SESSION_TIMEOUT = 3600  # 1 hora
+        SERVER_ENGINE = "threadpool"  # "threadpool" o "asyncio"
+        MAX_WORKERS = 32   # Peticiones atendidas simultáneamente
+        FIREWALL_BACKEND = "ipset"  # "ipset", "nftables" o "iptables"
+        RECONCILE_INTERVAL = 60  # Segundos entre comprobaciones del firewall
+        ACCOUNTING_INTERVAL = 10  # Segundos entre lecturas de contadores
+        DEFAULT_QUOTA = None  # Bytes por usuario, p. ej. 1024 ** 3; None sin límite
+        USAGE_FILE = "traffic_usage.json"  # Consumo por usuario; None para no persistirlo
+        SHAPING_INTERFACE = None  # Interfaz de la red local, p. ej. "wlan0"; None sin límite
+        SHAPING_UPLINK_RATE = "100mbit"  # Capacidad total a repartir
+        SHAPING_TIERS = {  # Nivel: (tasa garantizada, techo)
+            "default": ("2mbit", "10mbit"),
+            "premium": ("10mbit", "50mbit"),
+        }
+        USER_TIERS = {"admin": "premium"}
+        ADMIN_PORT = 9100  # Puerto local de métricas (/metrics); None para desactivarlo
+        ACCESS_LOG_FILE = "access.log"  # Registro JSON de accesos; None para usar el log general
+        BIND_MACS = True  # Vincular cada sesión a la MAC del dispositivo
+        NEIGHBOR_INTERFACE = None  # Interfaz de la red local, p. ej. "wlan0"; None para todas
+        ACTIVITY_SOURCE = "counters"  # "counters", "conntrack" o None (solo peticiones al portal)
+        ACTIVITY_INTERVAL = 30  # Segundos entre lecturas de conntrack ("counters" usa ACCOUNTING_INTERVAL)
+        TLS_PORT = None  # Puerto HTTPS del portal, p. ej. 443; None para servir solo HTTP
+        TLS_CERT_FILE = "portal.crt"  # Certificado válido para el nombre del portal
+        TLS_KEY_FILE = "portal.key"
+        CLUSTER_NODE_ID = None  # Nombre de este nodo, p. ej. "ap1"; None sin replicación
+        CLUSTER_HOST = None  # Dirección de este nodo en la red del clúster, p. ej. "10.10.0.1"
+        CLUSTER_PORT = 7400  # Puerto de replicación de sesiones
+        CLUSTER_PEERS = []  # Demás nodos en la red del clúster, p. ej. [("10.10.0.2", 7400)]
+        CLUSTER_SECRET = None  # Clave compartida por todos los nodos
         
         # Verificar si se ejecuta como root (necesario para iptables)
         import os
@@ -165,7 +472,32 @@ if __name__ == "__main__":
         portal = CaptivePortal(
             interface=INTERFACE,
             port=PORT,
-            session_timeout=SESSION_TIMEOUT
+            session_timeout=SESSION_TIMEOUT,
+            server_engine=SERVER_ENGINE,
+            max_workers=MAX_WORKERS,
+            firewall_backend=FIREWALL_BACKEND,
+            reconcile_interval=RECONCILE_INTERVAL,
+            accounting_interval=ACCOUNTING_INTERVAL,
+            default_quota=DEFAULT_QUOTA,
+            usage_file=USAGE_FILE,
+            shaping_interface=SHAPING_INTERFACE,
+            shaping_uplink_rate=SHAPING_UPLINK_RATE,
+            shaping_tiers=SHAPING_TIERS,
+            user_tiers=USER_TIERS,
+            admin_port=ADMIN_PORT,
+            access_log_file=ACCESS_LOG_FILE,
+            bind_macs=BIND_MACS,
+            neighbor_interface=NEIGHBOR_INTERFACE,
+            cluster_node_id=CLUSTER_NODE_ID,
+            cluster_host=CLUSTER_HOST,
+            cluster_port=CLUSTER_PORT,
+            cluster_peers=CLUSTER_PEERS,
+            cluster_secret=CLUSTER_SECRET,
+            activity_source=ACTIVITY_SOURCE,
+            activity_interval=ACTIVITY_INTERVAL,
+            tls_port=TLS_PORT,
+            tls_cert_file=TLS_CERT_FILE,
+            tls_key_file=TLS_KEY_FILE
         )
         
         portal.start()
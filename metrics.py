@@ -0,0 +1,305 @@
+"""
+Módulo de métricas del portal cautivo.
+Recoge contadores e histogramas de las rutas críticas y los expone en
+formato de texto de Prometheus en un puerto de administración aparte.
+"""
+
+import bisect
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread, local
+
+
+# Límites de los histogramas de latencia, en segundos
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Límites del histograma de retraso de vencimiento de sesiones, en segundos
+EXPIRY_LAG_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+
+class ThreadShards:
+    """
+    Almacén de valores con un diccionario por hilo.
+
+    Cada hilo actualiza solo su diccionario, así que registrar un valor no
+    toma ningún lock; el lock solo se usa la primera vez que un hilo
+    registra algo y al sumar los diccionarios en cada lectura.
+    """
+
+    def __init__(self):
+        self.local = local()
+        self.shards = []
+        self.lock = Lock()
+
+    def get(self):
+        """Devuelve el diccionario del hilo actual."""
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = {}
+            with self.lock:
+                self.shards.append(shard)
+            self.local.shard = shard
+            return shard
+
+    def snapshot(self):
+        """Devuelve una copia de los diccionarios de todos los hilos."""
+        with self.lock:
+            shards = list(self.shards)
+        # dict() de un diccionario es atómico con el GIL
+        return [dict(shard) for shard in shards]
+
+
+def format_labels(names, values):
+    """Formatea etiquetas como {nombre="valor",...}."""
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """Contador monótono con etiquetas."""
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = ThreadShards()
+
+    def inc(self, labels=(), amount=1):
+        """Incrementa el contador de una combinación de etiquetas."""
+        shard = self.values.get()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def collect(self):
+        """Devuelve {etiquetas: valor} sumando todos los hilos."""
+        totals = {}
+        for shard in self.values.snapshot():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def render(self):
+        """Devuelve las líneas de exposición del contador."""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """Histograma de valores con etiquetas y límites fijos."""
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.values = ThreadShards()
+
+    def observe(self, value, labels=()):
+        """Registra una observación."""
+        shard = self.values.get()
+        entry = shard.get(labels)
+        if entry is None:
+            # Un contador por límite más el de +Inf, la suma y el total
+            entry = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def collect(self):
+        """Devuelve {etiquetas: [contadores..., suma, total]} de todos los hilos."""
+        totals = {}
+        for shard in self.values.snapshot():
+            for labels, entry in shard.items():
+                current = totals.get(labels)
+                if current is None:
+                    totals[labels] = list(entry)
+                else:
+                    totals[labels] = [a + b for a, b in zip(current, entry)]
+        return totals
+
+    def render(self):
+        """Devuelve las líneas de exposición del histograma."""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        label_names = self.label_names + ("le",)
+        for labels, entry in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), entry):
+                cumulative += count
+                lines.append(f"{self.name}_bucket"
+                             f"{format_labels(label_names, labels + (bound,))} {cumulative}")
+            label_text = format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {entry[-2]}")
+            lines.append(f"{self.name}_count{label_text} {entry[-1]}")
+        return lines
+
+
+class Gauge:
+    """Valor instantáneo calculado al exponer las métricas."""
+
+    def __init__(self, name, help_text, function):
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+
+    def render(self):
+        """Devuelve las líneas de exposición del valor."""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        try:
+            lines.append(f"{self.name} {self.function()}")
+        except Exception as e:
+            logging.error(f"Error calculando la métrica {self.name}: {e}")
+        return lines
+
+
+class PortalMetrics:
+    """
+    Métricas del portal cautivo.
+
+    Los componentes reciben esta instancia y registran sus valores con los
+    métodos observe_*; los valores de estado (sesiones, colas) se añaden
+    con add_gauge y se calculan solo cuando se consultan.
+    """
+
+    def __init__(self):
+        self.requests = Counter(
+            "portal_http_requests_total", "Peticiones HTTP atendidas", ("method", "path"))
+        self.request_duration = Histogram(
+            "portal_http_request_duration_seconds", "Duración del manejo de peticiones HTTP",
+            ("method", "path"))
+        self.logins = Counter(
+            "portal_logins_total", "Intentos de login por resultado", ("result",))
+        self.authenticate_duration = Histogram(
+            "portal_authenticate_duration_seconds", "Duración de UserManager.authenticate")
+        self.firewall_commands = Counter(
+            "portal_firewall_commands_total", "Comandos de firewall ejecutados", ("command",))
+        self.firewall_failures = Counter(
+            "portal_firewall_command_failures_total", "Comandos de firewall fallidos",
+            ("command",))
+        self.firewall_duration = Histogram(
+            "portal_firewall_command_duration_seconds", "Duración de los comandos de firewall",
+            ("command",))
+        self.expiry_lag = Histogram(
+            "portal_session_expiry_lag_seconds",
+            "Retraso entre el vencimiento de una sesión y su eliminación",
+            buckets=EXPIRY_LAG_BUCKETS)
+        self.tls_handshakes = Counter(
+            "portal_tls_handshakes_total", "Negociaciones TLS por resultado", ("result",))
+        self.tls_handshake_duration = Histogram(
+            "portal_tls_handshake_duration_seconds", "Duración de las negociaciones TLS",
+            ("result",))
+        self.gauges = []
+
+    def add_gauge(self, name, help_text, function):
+        """Registra un valor instantáneo calculado por function()."""
+        self.gauges.append(Gauge(name, help_text, function))
+
+    def observe_request(self, method, path, duration):
+        """Registra una petición HTTP atendida."""
+        labels = (method, path)
+        self.requests.inc(labels)
+        self.request_duration.observe(duration, labels)
+
+    def observe_login(self, result):
+        """Registra el resultado de un intento de login."""
+        self.logins.inc((result,))
+
+    def observe_authenticate(self, duration):
+        """Registra la duración de una autenticación."""
+        self.authenticate_duration.observe(duration)
+
+    def observe_firewall_command(self, command, duration, success):
+        """Registra la ejecución de un comando de firewall."""
+        labels = (command,)
+        self.firewall_commands.inc(labels)
+        self.firewall_duration.observe(duration, labels)
+        if not success:
+            self.firewall_failures.inc(labels)
+
+    def observe_expiry_lag(self, lag):
+        """Registra el retraso con el que se eliminó una sesión vencida."""
+        self.expiry_lag.observe(lag)
+
+    def observe_tls_handshake(self, result, duration):
+        """Registra una negociación TLS ('full', 'resumed' o 'failed')."""
+        labels = (result,)
+        self.tls_handshakes.inc(labels)
+        self.tls_handshake_duration.observe(duration, labels)
+
+    def render(self):
+        """
+        Genera la exposición en formato de texto de Prometheus.
+
+        Returns:
+            Bytes UTF-8 de la exposición
+        """
+        lines = []
+        for metric in (self.requests, self.request_duration, self.logins,
+                       self.authenticate_duration, self.firewall_commands,
+                       self.firewall_failures, self.firewall_duration, self.expiry_lag,
+                       self.tls_handshakes, self.tls_handshake_duration):
+            lines.extend(metric.render())
+        for gauge in self.gauges:
+            lines.extend(gauge.render())
+        return ("\n".join(lines) + "\n").encode('utf-8')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Manejador del puerto de administración: solo sirve /metrics."""
+
+    def do_GET(self):
+        """Devuelve la exposición de métricas."""
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.portal_metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Las consultas de métricas no se registran en el log."""
+
+
+class MetricsServer:
+    """Servidor HTTP de administración que expone las métricas."""
+
+    def __init__(self, portal_metrics, host='127.0.0.1', port=9100):
+        """
+        Inicializa el servidor de métricas.
+
+        Args:
+            portal_metrics: Instancia de PortalMetrics
+            host: Dirección en la que escuchar (por defecto solo local)
+            port: Puerto de administración
+        """
+        self.portal_metrics = portal_metrics
+        self.host = host
+        self.port = port
+        self.server = None
+        self.server_thread = None
+
+    def start(self):
+        """Inicia el servidor de métricas."""
+        self.server = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.portal_metrics = self.portal_metrics
+        self.server_thread = Thread(target=self.server.serve_forever,
+                                    name="metrics-server", daemon=True)
+        self.server_thread.start()
+        logging.info(f"Métricas disponibles en http://{self.host}:{self.port}/metrics")
+
+    def stop(self):
+        """Detiene el servidor de métricas."""
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,426 @@
+"""
+Módulo de la tabla de vecinos del portal cautivo.
+Mantiene en memoria la correspondencia IP -> MAC de la red local para
+vincular cada sesión al dispositivo que la abrió.
+"""
+
+import logging
+import subprocess
+import time
+from threading import Condition, Lock, Thread
+
+from firewall import run_subprocess
+
+
+# Entradas de /proc/net/arp aún sin resolver
+INCOMPLETE_MAC = "00:00:00:00:00:00"
+
+
+def parse_neighbor_line(line):
+    """
+    Interpreta una línea de "ip neigh show" o "ip monitor neigh".
+
+    Args:
+        line: Línea como "10.0.0.2 dev wlan0 lladdr aa:bb:cc:dd:ee:ff REACHABLE",
+            opcionalmente precedida de "Deleted"
+
+    Returns:
+        Tupla (ip, dispositivo, mac, borrada); mac es None si la entrada no
+        está resuelta. None si la línea no describe un vecino
+    """
+    parts = line.split()
+    deleted = bool(parts) and parts[0] == "Deleted"
+    if deleted:
+        parts = parts[1:]
+    if len(parts) < 3 or parts[1] != "dev" or ":" in parts[0]:
+        return None
+    mac = None
+    if "lladdr" in parts:
+        index = parts.index("lladdr") + 1
+        if index < len(parts):
+            mac = parts[index].lower()
+    return parts[0], parts[2], mac, deleted
+
+
+class NeighborCache:
+    """
+    Caché de la tabla ARP del kernel.
+
+    La tabla completa se relee en bloque cada refresh_interval segundos y,
+    entre relecturas, los cambios llegan uno a uno desde "ip monitor neigh".
+    Las consultas de los hilos de petición son una búsqueda en un
+    diccionario, sin lock ni llamadas al sistema. Una IP desconocida se
+    responde con la tabla actual y despierta al hilo de relectura, que
+    adelanta la siguiente relectura (como mucho una cada
+    miss_refresh_interval segundos); quien no puede seguir sin la MAC
+    (p. ej. un login) puede esperarla con el timeout de lookup.
+
+    Los cambios de MAC (una IP nueva o reasignada a otro dispositivo) se
+    notifican a los oyentes registrados con add_listener.
+    """
+
+    def __init__(self, interface=None, refresh_interval=30.0, miss_refresh_interval=1.0,
+                 source="proc", monitor=True, arp_file="/proc/net/arp",
+                 command_runner=None):
+        """
+        Inicializa la caché.
+
+        Args:
+            interface: Interfaz de la red local (None para todas)
+            refresh_interval: Segundos entre relecturas completas
+            miss_refresh_interval: Segundos mínimos entre relecturas
+                provocadas por IPs desconocidas
+            source: 'proc' para leer arp_file o 'ip' para "ip neigh show"
+            monitor: Si se siguen los cambios con "ip monitor neigh"
+            arp_file: Ruta de la tabla ARP del kernel
+            command_runner: Función que ejecuta ip (sustituible en pruebas)
+        """
+        if source not in ("proc", "ip"):
+            raise ValueError(f"Origen de la tabla de vecinos desconocido: {source}")
+        self.interface = interface
+        self.refresh_interval = refresh_interval
+        self.miss_refresh_interval = miss_refresh_interval
+        self.source = source
+        self.monitor = monitor
+        self.arp_file = arp_file
+        self.command_runner = command_runner or run_subprocess
+        self.table = {}  # {ip: mac}; se reemplaza entero en cada relectura
+        self.listeners = []
+        self.write_lock = Lock()
+        self.refresh_lock = Lock()
+        self.condition = Condition()
+        self.last_refresh = 0.0
+        self.refresh_requested = False
+        self.generation = 0  # Relecturas terminadas, para quien espera una
+        self.running = False
+        self.thread = None
+        self.monitor_process = None
+        self.monitor_thread = None
+        self.logger = logging.getLogger(__name__)
+
+        # Métricas
+        self.refreshes = 0
+        self.failed_refreshes = 0
+        self.updates = 0
+        self.misses = 0
+        self.last_refresh_duration = 0.0
+
+    def add_listener(self, listener):
+        """
+        Registra una función llamada con los cambios de la tabla.
+
+        Args:
+            listener: Función que recibe {ip: (mac anterior, mac nueva)}
+        """
+        self.listeners.append(listener)
+
+    def start(self):
+        """Lee la tabla e inicia la relectura periódica y el seguimiento."""
+        self.refresh()
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = Thread(target=self._refresh_loop, name="neighbor-cache", daemon=True)
+        self.thread.start()
+        if self.monitor:
+            self._start_monitor()
+
+    def stop(self):
+        """Detiene la relectura periódica y el seguimiento de cambios."""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.monitor_process is not None:
+            self.monitor_process.terminate()
+        if self.monitor_thread:
+            self.monitor_thread.join()
+            self.monitor_thread = None
+        if self.monitor_process is not None:
+            self.monitor_process.wait()
+            self.monitor_process = None
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def lookup(self, ip_address, timeout=0.0):
+        """
+        Devuelve la MAC de una IP de la red local.
+
+        Args:
+            ip_address: IP del cliente
+            timeout: Segundos máximos que esperar a la relectura pedida si
+                la IP es desconocida (0 para responder con la tabla actual)
+
+        Returns:
+            MAC en minúsculas, o None si el kernel no la conoce
+        """
+        mac = self.table.get(ip_address)
+        if mac is not None:
+            return mac
+        self.misses += 1
+        # El cliente acaba de enviar un paquete, así que el kernel ya debería
+        # conocerlo aunque la caché aún no: se pide la relectura al hilo de
+        # fondo en lugar de hacerla en el hilo de la petición
+        with self.condition:
+            if not self.refresh_requested:
+                self.refresh_requested = True
+                self.condition.notify_all()
+            if timeout <= 0 or not self.running:
+                return None
+            deadline = time.monotonic() + timeout
+            generation = self.generation
+            while self.generation == generation and ip_address not in self.table:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+        return self.table.get(ip_address)
+
+    def refresh(self):
+        """
+        Relee la tabla completa del kernel.
+
+        Returns:
+            Diccionario {ip: (mac anterior, mac nueva)} con las entradas
+            nuevas o cambiadas, o None si la lectura falló
+        """
+        with self.refresh_lock:
+            return self._refresh()
+
+    def metrics(self):
+        """Devuelve las métricas de la caché."""
+        return {
+            'entries': len(self.table),
+            'refreshes': self.refreshes,
+            'failed_refreshes': self.failed_refreshes,
+            'updates': self.updates,
+            'misses': self.misses,
+            'last_refresh_duration': self.last_refresh_duration,
+        }
+
+    def _refresh(self):
+        """Relee la tabla; llamar con refresh_lock tomado."""
+        started = time.monotonic()
+        self.last_refresh = started
+        table = self._read_table()
+        if table is None:
+            self.failed_refreshes += 1
+            self._wake_waiters()
+            return None
+
+        with self.write_lock:
+            previous = self.table
+            changes = {ip: (previous.get(ip), mac) for ip, mac in table.items()
+                       if previous.get(ip) != mac}
+            self.table = table
+        self.refreshes += 1
+        self.last_refresh_duration = time.monotonic() - started
+        self._wake_waiters()
+        self._notify(changes)
+        return changes
+
+    def _wake_waiters(self):
+        """Avisa a las consultas que esperan una relectura de que terminó una."""
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def _read_table(self):
+        """Lee la tabla de vecinos como {ip: mac}, o None si falla."""
+        table = {}
+        if self.source == "proc":
+            try:
+                with open(self.arp_file) as f:
+                    lines = f.read().split('\n')[1:]
+            except OSError as e:
+                self.logger.error(f"Error leyendo la tabla ARP: {e}")
+                return None
+            # IP, tipo, flags, MAC, máscara, dispositivo
+            for line in lines:
+                parts = line.split()
+                if len(parts) < 6 or parts[3] == INCOMPLETE_MAC:
+                    continue
+                if self.interface and parts[5] != self.interface:
+                    continue
+                table[parts[0]] = parts[3].lower()
+            return table
+
+        try:
+            result = self.command_runner(["ip", "-4", "neigh", "show"])
+        except Exception as e:
+            self.logger.error(f"Error leyendo la tabla de vecinos: {e}")
+            return None
+        if result.returncode != 0:
+            self.logger.error(f"Error leyendo la tabla de vecinos: {result.stderr}")
+            return None
+        for line in result.stdout.split('\n'):
+            neighbor = parse_neighbor_line(line)
+            if neighbor is None or neighbor[2] is None:
+                continue
+            if self.interface and neighbor[1] != self.interface:
+                continue
+            table[neighbor[0]] = neighbor[2]
+        return table
+
+    def _apply_update(self, line):
+        """Aplica un cambio recibido de "ip monitor neigh"."""
+        neighbor = parse_neighbor_line(line)
+        if neighbor is None:
+            return
+        ip, device, mac, deleted = neighbor
+        if self.interface and device != self.interface:
+            return
+        with self.write_lock:
+            previous = self.table.get(ip)
+            if deleted or mac is None:
+                # Una entrada que caduca no termina la sesión: se olvida y
+                # la siguiente consulta la vuelve a leer del kernel
+                if deleted:
+                    self.table.pop(ip, None)
+                return
+            if previous == mac:
+                return
+            self.table[ip] = mac
+        self.updates += 1
+        if previous is None:
+            # Puede ser la IP que espera una consulta
+            with self.condition:
+                self.condition.notify_all()
+        self._notify({ip: (previous, mac)})
+
+    def _notify(self, changes):
+        """Llama a los oyentes con los cambios de la tabla."""
+        if not changes:
+            return
+        for listener in self.listeners:
+            try:
+                listener(changes)
+            except Exception as e:
+                self.logger.error(f"Error procesando cambios de vecinos: {e}")
+
+    def _start_monitor(self):
+        """Lanza "ip monitor neigh" y el hilo que lee sus cambios."""
+        try:
+            self.monitor_process = subprocess.Popen(
+                ["ip", "-4", "monitor", "neigh"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True
+            )
+        except OSError as e:
+            self.logger.warning(f"Sin seguimiento de vecinos, solo relectura periódica: {e}")
+            return
+        self.monitor_thread = Thread(target=self._monitor_loop, name="neighbor-monitor",
+                                     daemon=True)
+        self.monitor_thread.start()
+
+    def _monitor_loop(self):
+        """Aplica los cambios de la tabla a medida que el kernel los anuncia."""
+        for line in self.monitor_process.stdout:
+            try:
+                self._apply_update(line)
+            except Exception as e:
+                self.logger.error(f"Error aplicando cambio de vecinos: {e}")
+        if self.running:
+            self.logger.warning("El seguimiento de vecinos terminó; solo relectura periódica")
+
+    def _refresh_loop(self):
+        """Relee la tabla cada refresh_interval segundos, o antes si una consulta lo pide."""
+        while True:
+            with self.condition:
+                while self.running:
+                    interval = (self.miss_refresh_interval if self.refresh_requested
+                                else self.refresh_interval)
+                    remaining = self.last_refresh + interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                if not self.running:
+                    return
+                self.refresh_requested = False
+            try:
+                self.refresh()
+            except Exception as e:
+                self.logger.error(f"Error releyendo la tabla de vecinos: {e}")
+
+
+class SessionRoaming:
+    """
+    Traslada las sesiones de los dispositivos que cambian de IP.
+
+    Cuando un dispositivo con sesión aparece en otra IP (renovación de
+    DHCP, cambio de punto de acceso) la sesión se mueve a la IP nueva y se
+    actualiza el firewall, sin volver a pedir credenciales. Si la IP nueva
+    tenía la sesión de otro dispositivo, este ya no la usa y su vínculo se
+    retira.
+    """
+
+    def __init__(self, session_manager, firewall_manager, firewall_queue=None,
+                 traffic_accountant=None):
+        """
+        Inicializa el traslado de sesiones.
+
+        Args:
+            session_manager: Instancia de SessionManager
+            firewall_manager: Instancia de FirewallManager
+            firewall_queue: FirewallWorkQueue opcional para los cambios
+            traffic_accountant: TrafficAccountant opcional que contabilizar
+                antes de retirar las reglas de las IPs abandonadas
+        """
+        self.session_manager = session_manager
+        self.firewall_manager = firewall_manager
+        self.firewall_queue = firewall_queue
+        self.traffic_accountant = traffic_accountant
+        self.logger = logging.getLogger(__name__)
+
+        # Métricas
+        self.roamed = 0
+
+    def neighbors_changed(self, changes):
+        """Oyente de NeighborCache: traslada las sesiones afectadas."""
+        for ip_address, (_, mac_address) in changes.items():
+            self.roam(ip_address, mac_address)
+
+    def roam(self, ip_address, mac_address):
+        """
+        Traslada a ip_address la sesión del dispositivo mac_address.
+
+        Args:
+            ip_address: IP en la que aparece el dispositivo
+            mac_address: MAC del dispositivo
+
+        Returns:
+            True si la sesión se trasladó
+        """
+        previous_ip = self.session_manager.find_ip_by_mac(mac_address)
+        if previous_ip is None or previous_ip == ip_address:
+            return False
+        displaced_mac = self.session_manager.get_mac_by_ip(ip_address)
+        if self.traffic_accountant is not None:
+            # Los contadores de la IP abandonada desaparecen con su regla, y
+            # los de la IP nueva pasan a ser del dispositivo que llega
+            owners = {previous_ip: self.session_manager.get_username_by_ip(previous_ip),
+                      ip_address: self.session_manager.get_username_by_ip(ip_address)}
+            self.traffic_accountant.settle(
+                {ip: username for ip, username in owners.items() if username is not None})
+        if not self.session_manager.move_session(previous_ip, ip_address, mac_address):
+            return False
+
+        operations = [("block", previous_ip, mac_address)]
+        if displaced_mac is not None and displaced_mac != mac_address:
+            operations.append(("unbind", ip_address, displaced_mac))
+        operations.append(("allow", ip_address, mac_address))
+        if self.firewall_queue is not None:
+            for action, ip, mac in operations:
+                self.firewall_queue.submit(action, ip, mac)
+        else:
+            self.firewall_manager.apply_batch(operations)
+
+        self.roamed += 1
+        self.logger.info(f"Sesión de {mac_address} trasladada de {previous_ip} a {ip_address}")
+        return True
+
+    def metrics(self):
+        """Devuelve las métricas del traslado de sesiones."""
+        return {'roamed': self.roamed}
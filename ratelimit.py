@@ -0,0 +1,122 @@
+"""
+Módulo de limitación de peticiones del portal cautivo.
+Limita el ritmo de peticiones por clave (IP o usuario) y las conexiones
+simultáneas por IP sin que la memoria crezca con el número de clientes.
+"""
+
+import time
+from array import array
+from threading import Lock
+
+
+class TokenBucketTable:
+    """
+    Tabla de tamaño fijo de buckets de tokens.
+
+    Cada clave se asigna a una ranura por su hash, así que la memoria no
+    depende de cuántas IPs o usuarios distintos aparezcan. Dos claves que
+    comparten ranura comparten límite; con el hash aleatorio por proceso de
+    Python un atacante no puede elegir a qué ranura cae una clave.
+    """
+
+    def __init__(self, rate, burst, slots=65536):
+        """
+        Inicializa la tabla.
+
+        Args:
+            rate: Tokens repuestos por segundo
+            burst: Capacidad máxima de cada bucket
+            slots: Número de ranuras de la tabla
+        """
+        self.rate = rate
+        self.burst = burst
+        self.slots = slots
+        # Dos arrays de doubles: 16 bytes por ranura en total
+        self.tokens = array('d', [burst]) * slots
+        self.updated = array('d', [0.0]) * slots
+        self.lock = Lock()
+        self.allowed = 0
+        self.rejected = 0
+
+    def consume(self, key):
+        """
+        Consume un token del bucket de una clave.
+
+        Args:
+            key: IP, nombre de usuario o cualquier clave con hash
+
+        Returns:
+            True si había token disponible, False si se supera el límite
+        """
+        index = hash(key) % self.slots
+        now = time.monotonic()
+        with self.lock:
+            tokens = min(self.burst,
+                         self.tokens[index] + (now - self.updated[index]) * self.rate)
+            self.updated[index] = now
+            if tokens < 1:
+                self.tokens[index] = tokens
+                self.rejected += 1
+                return False
+            self.tokens[index] = tokens - 1
+            self.allowed += 1
+            return True
+
+    def metrics(self):
+        """Devuelve los contadores de peticiones admitidas y rechazadas."""
+        return {'allowed': self.allowed, 'rejected': self.rejected}
+
+
+class ConnectionLimiter:
+    """
+    Límite de conexiones simultáneas, en total y por IP.
+
+    Solo guarda las IPs con conexiones abiertas, de modo que su tamaño está
+    acotado por max_connections.
+    """
+
+    def __init__(self, max_connections=1024, max_per_ip=8):
+        """
+        Inicializa el limitador.
+
+        Args:
+            max_connections: Conexiones abiertas máximas en total
+            max_per_ip: Conexiones abiertas máximas de una misma IP
+        """
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.connections = {}  # {ip: conexiones abiertas}
+        self.total = 0
+        self.lock = Lock()
+        self.rejected = 0
+
+    def acquire(self, ip_address):
+        """
+        Reserva una conexión para la IP.
+
+        Returns:
+            True si se admite, False si se supera algún límite
+        """
+        with self.lock:
+            current = self.connections.get(ip_address, 0)
+            if self.total >= self.max_connections or current >= self.max_per_ip:
+                self.rejected += 1
+                return False
+            self.connections[ip_address] = current + 1
+            self.total += 1
+            return True
+
+    def release(self, ip_address):
+        """Libera una conexión reservada con acquire()."""
+        with self.lock:
+            current = self.connections.get(ip_address, 0)
+            if current <= 1:
+                self.connections.pop(ip_address, None)
+            else:
+                self.connections[ip_address] = current - 1
+            self.total -= 1
+
+    def metrics(self):
+        """Devuelve las conexiones abiertas y las rechazadas."""
+        return {'open': self.total, 'clients': len(self.connections),
+                'rejected': self.rejected}
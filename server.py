@@ -5,53 +5,25 @@ Maneja las peticiones HTTP y el endpoint de login.
 
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from urllib.parse import parse_qs, urlparse
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import namedtuple
+import asyncio
+import functools
+from html import escape
 import json
 import logging
-from threading import Thread
+import select
+import socket
+import ssl
+import time
+from threading import BoundedSemaphore, Event, Thread
 
+from ratelimit import ConnectionLimiter, TokenBucketTable
 
-class CaptivePortalHandler(BaseHTTPRequestHandler):
-    """Manejador de peticiones HTTP para el portal cautivo."""
-    
-    def log_message(self, format, *args):
-        """Sobrescribe el método de logging por defecto."""
-        logging.info(f"{self.address_string()} - {format % args}")
-    
-    def _set_headers(self, content_type='text/html', status_code=200):
-        """
-        Establece las cabeceras HTTP de la respuesta.
-        
-        Args:
-            content_type: Tipo de contenido MIME
-            status_code: Código de estado HTTP
-        """
-        self.send_response(status_code)
-        self.send_header('Content-type', content_type)
-        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-        self.send_header('Pragma', 'no-cache')
-        self.send_header('Expires', '0')
-        self.end_headers()
-    
-    def _get_client_ip(self):
-        """
-        Obtiene la dirección IP del cliente.
-        
-        Returns:
-            Dirección IP del cliente
-        """
-        return self.client_address[0]
-    
-    def _get_login_page(self, message=""):
-        """
-        Genera la página HTML de login.
-        
-        Args:
-            message: Mensaje a mostrar al usuario
-            
-        Returns:
-            Código HTML de la página de login
-        """
-        html = f"""
+
+# Plantillas HTML de las páginas del portal. Los marcadores {message} y
+# {username} se sustituyen por fragmentos ya escapados.
+LOGIN_PAGE_HTML = """
 <!DOCTYPE html>
 <html lang="es">
 <head>
@@ -59,12 +31,12 @@ class CaptivePortalHandler(BaseHTTPRequestHandler):
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Portal Cautivo - Iniciar Sesión</title>
     <style>
-        * {{
+        * {
             margin: 0;
             padding: 0;
             box-sizing: border-box;
-        }}
-        body {{
+        }
+        body {
             font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
             background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
             display: flex;
@@ -72,50 +44,50 @@ class CaptivePortalHandler(BaseHTTPRequestHandler):
             align-items: center;
             min-height: 100vh;
             padding: 20px;
-        }}
-        .container {{
+        }
+        .container {
             background: white;
             padding: 40px;
             border-radius: 10px;
             box-shadow: 0 10px 25px rgba(0,0,0,0.2);
             max-width: 400px;
             width: 100%;
-        }}
-        h1 {{
+        }
+        h1 {
             color: #333;
             margin-bottom: 10px;
             text-align: center;
-        }}
-        .subtitle {{
+        }
+        .subtitle {
             color: #666;
             text-align: center;
             margin-bottom: 30px;
             font-size: 14px;
-        }}
-        .form-group {{
+        }
+        .form-group {
             margin-bottom: 20px;
-        }}
-        label {{
+        }
+        label {
             display: block;
             color: #555;
             margin-bottom: 5px;
             font-weight: 500;
-        }}
+        }
         input[type="text"],
-        input[type="password"] {{
+        input[type="password"] {
             width: 100%;
             padding: 12px;
             border: 2px solid #e0e0e0;
             border-radius: 5px;
             font-size: 14px;
             transition: border-color 0.3s;
-        }}
+        }
         input[type="text"]:focus,
-        input[type="password"]:focus {{
+        input[type="password"]:focus {
             outline: none;
             border-color: #667eea;
-        }}
-        button {{
+        }
+        button {
             width: 100%;
             padding: 12px;
             background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
@@ -126,36 +98,36 @@ class CaptivePortalHandler(BaseHTTPRequestHandler):
             font-weight: 600;
             cursor: pointer;
             transition: transform 0.2s;
-        }}
-        button:hover {{
+        }
+        button:hover {
             transform: translateY(-2px);
-        }}
-        button:active {{
+        }
+        button:active {
             transform: translateY(0);
-        }}
-        .message {{
+        }
+        .message {
             padding: 10px;
             margin-bottom: 20px;
             border-radius: 5px;
             text-align: center;
-        }}
-        .error {{
+        }
+        .error {
             background: #fee;
             color: #c33;
             border: 1px solid #fcc;
-        }}
-        .success {{
+        }
+        .success {
             background: #efe;
             color: #3c3;
             border: 1px solid #cfc;
-        }}
-        .info {{
+        }
+        .info {
             background: #def;
             color: #36c;
             border: 1px solid #bcf;
             margin-top: 20px;
             font-size: 12px;
-        }}
+        }
     </style>
 </head>
 <body>
@@ -163,7 +135,7 @@ class CaptivePortalHandler(BaseHTTPRequestHandler):
         <h1>🔒 Portal Cautivo</h1>
         <p class="subtitle">Inicia sesión para acceder a la red</p>
         
-        {"<div class='message error'>" + message + "</div>" if message else ""}
+        {message}
         
         <form method="POST" action="/login">
             <div class="form-group">
@@ -189,19 +161,8 @@ class CaptivePortalHandler(BaseHTTPRequestHandler):
 </body>
 </html>
         """
-        return html
-    
-    def _get_success_page(self, username):
-        """
-        Genera la página HTML de éxito tras el login.
-        
-        Args:
-            username: Nombre del usuario autenticado
-            
-        Returns:
-            Código HTML de la página de éxito
-        """
-        html = f"""
+
+SUCCESS_PAGE_HTML = """
     <!DOCTYPE html>
     <html lang="es">
     <head>
@@ -209,12 +170,12 @@ class CaptivePortalHandler(BaseHTTPRequestHandler):
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
         <title>Portal Cautivo - Acceso Concedido</title>
         <style>
-            * {{
+            * {
                 margin: 0;
                 padding: 0;
                 box-sizing: border-box;
-            }}
-            body {{
+            }
+            body {
                 font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
                 background: linear-gradient(135deg, #11998e 0%, #38ef7d 100%);
                 display: flex;
@@ -222,8 +183,8 @@ class CaptivePortalHandler(BaseHTTPRequestHandler):
                 align-items: center;
                 min-height: 100vh;
                 padding: 20px;
-            }}
-            .container {{
+            }
+            .container {
                 background: white;
                 padding: 40px;
                 border-radius: 10px;
@@ -231,27 +192,27 @@ class CaptivePortalHandler(BaseHTTPRequestHandler):
                 max-width: 500px;
                 width: 100%;
                 text-align: center;
-            }}
-            h1 {{
+            }
+            h1 {
                 color: #333;
                 margin-bottom: 10px;
-            }}
-            .success-icon {{
+            }
+            .success-icon {
                 font-size: 64px;
                 margin-bottom: 20px;
-            }}
-            .username {{
+            }
+            .username {
                 color: #11998e;
                 font-weight: 600;
                 font-size: 20px;
                 margin-bottom: 20px;
-            }}
-            .message {{
+            }
+            .message {
                 color: #666;
                 margin-bottom: 30px;
                 line-height: 1.6;
-            }}
-            .button {{
+            }
+            .button {
                 display: inline-block;
                 padding: 12px 30px;
                 background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
@@ -263,25 +224,25 @@ class CaptivePortalHandler(BaseHTTPRequestHandler):
                 border: none;
                 cursor: pointer;
                 font-size: 16px;
-            }}
-            .button:hover {{
+            }
+            .button:hover {
                 transform: translateY(-2px);
-            }}
-            .button:active {{
+            }
+            .button:active {
                 transform: translateY(0);
-            }}
-            .logout-button {{
+            }
+            .logout-button {
                 background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%);
                 margin-top: 15px;
-            }}
-            .info {{
+            }
+            .info {
                 background: #e8f5e9;
                 padding: 15px;
                 border-radius: 5px;
                 margin-top: 20px;
                 font-size: 14px;
                 color: #2e7d32;
-            }}
+            }
         </style>
     </head>
     <body>
@@ -305,84 +266,1054 @@ class CaptivePortalHandler(BaseHTTPRequestHandler):
     </body>
     </html>
         """
-        return html
+
+
+class PageTemplate:
+    """
+    Plantilla HTML precodificada.
+    
+    La parte estática se codifica a bytes una sola vez; en cada respuesta
+    solo se codifica e intercala el fragmento dinámico.
+    """
+    
+    def __init__(self, html, placeholder):
+        """
+        Inicializa la plantilla.
+        
+        Args:
+            html: Texto HTML de la página
+            placeholder: Marcador que se sustituye por el fragmento dinámico
+        """
+        prefix, suffix = html.split(placeholder)
+        self.prefix = prefix.encode()
+        self.suffix = suffix.encode()
+    
+    def render(self, fragment=""):
+        """
+        Genera la página con el fragmento indicado.
+        
+        Args:
+            fragment: Fragmento HTML (ya escapado) a intercalar
+            
+        Returns:
+            Bytes UTF-8 de la página
+        """
+        return b"".join((self.prefix, fragment.encode(), self.suffix))
+
+
+LOGIN_TEMPLATE = PageTemplate(LOGIN_PAGE_HTML, "{message}")
+SUCCESS_TEMPLATE = PageTemplate(SUCCESS_PAGE_HTML, "{username}")
+
+# Página de login sin mensaje: idéntica para todos los clientes
+LOGIN_PAGE = LOGIN_TEMPLATE.render()
+
+# Versión HTTP con la que responde el portal
+PROTOCOL_VERSION = 'HTTP/1.1'
+
+# Respuesta precalculada en sus dos variantes: para conexión persistente
+# y con "Connection: close" para la última petición de la conexión
+RawResponse = namedtuple('RawResponse', ['status_code', 'keep_alive', 'close'])
+
+
+def build_raw_response(status_code, content_type=None, body=b"", extra_headers=()):
+    """
+    Construye una respuesta HTTP completa como bytes.
+    
+    Args:
+        status_code: Código de estado HTTP
+        content_type: Tipo de contenido MIME, o None si no hay cuerpo
+        body: Bytes del cuerpo
+        extra_headers: Pares (nombre, valor) de cabeceras adicionales
+        
+    Returns:
+        RawResponse con los bytes de la línea de estado, cabeceras y cuerpo
+    """
+    reason = BaseHTTPRequestHandler.responses[status_code][0]
+    lines = [f"{PROTOCOL_VERSION} {status_code} {reason}"]
+    if content_type:
+        lines.append(f"Content-Type: {content_type}")
+    if status_code != 204:
+        # Una respuesta 204 no puede llevar Content-Length
+        lines.append(f"Content-Length: {len(body)}")
+    lines.append("Cache-Control: no-cache, no-store, must-revalidate")
+    lines.extend(f"{name}: {value}" for name, value in extra_headers)
+    head = "\r\n".join(lines) + "\r\n"
+    return RawResponse(
+        status_code,
+        (head + "\r\n").encode('latin-1') + body,
+        (head + "Connection: close\r\n\r\n").encode('latin-1') + body
+    )
+
+
+# Respuestas "con conexión" que espera cada sistema operativo en sus
+# sondeos de portal cautivo. Se envían a los clientes ya autenticados
+# para que dejen de sondear.
+PROBE_RESPONSES = {
+    # Android / ChromeOS
+    '/generate_204': build_raw_response(204),
+    '/gen_204': build_raw_response(204),
+    # Apple
+    '/hotspot-detect.html': build_raw_response(
+        200, 'text/html',
+        b"<HTML><HEAD><TITLE>Success</TITLE></HEAD><BODY>Success</BODY></HTML>"),
+    '/library/test/success.html': build_raw_response(
+        200, 'text/html',
+        b"<HTML><HEAD><TITLE>Success</TITLE></HEAD><BODY>Success</BODY></HTML>"),
+    # Windows
+    '/connecttest.txt': build_raw_response(200, 'text/plain', b"Microsoft Connect Test"),
+    '/ncsi.txt': build_raw_response(200, 'text/plain', b"Microsoft NCSI"),
+    # Firefox
+    '/success.txt': build_raw_response(200, 'text/plain', b"success\n"),
+}
+
+# Rutas con etiqueta propia en las métricas; el resto cuenta como "other"
+# para que los clientes no puedan crear series sin límite
+METRIC_PATHS = frozenset(['/', '/login', '/logout', *PROBE_RESPONSES])
+
+
+def instrumented(method):
+    """
+    Decora un método do_* para registrar su duración en server.metrics.
+    
+    Args:
+        method: Método manejador de peticiones
+        
+    Returns:
+        Método envuelto
+    """
+    @functools.wraps(method)
+    def wrapper(self):
+        started = self.request_started = time.perf_counter()
+        try:
+            return method(self)
+        finally:
+            metrics = self.server.metrics
+            if metrics is not None:
+                path = self.path.split('?', 1)[0]
+                metrics.observe_request(self.command,
+                                        path if path in METRIC_PATHS else 'other',
+                                        time.perf_counter() - started)
+    return wrapper
+
+# Rechazos precalculados: se envían sin analizar ni autenticar nada
+TOO_MANY_REQUESTS = build_raw_response(
+    429, 'text/plain', b"Demasiadas peticiones\n", extra_headers=[('Retry-After', '1')])
+PAYLOAD_TOO_LARGE = build_raw_response(413, 'text/plain', b"Cuerpo demasiado grande\n")
+BAD_REQUEST = build_raw_response(400, 'text/plain', b"Peticion incorrecta\n")
+TOO_MANY_CONNECTIONS = build_raw_response(
+    503, 'text/plain', b"Demasiadas conexiones\n", extra_headers=[('Retry-After', '1')])
+
+
+def admit_connection(server, conn, client_address):
+    """
+    Comprueba el límite de conexiones simultáneas de una conexión nueva.
+    
+    Si se rechaza, envía un 503 precalculado sin esperar al cliente (en
+    un puerto TLS solo se cierra: aún no hay sesión TLS en la que enviarlo).
+    
+    Args:
+        server: Servidor con atributo connection_limiter
+        conn: Socket de la conexión aceptada
+        client_address: Tupla (ip, puerto) del cliente
+        
+    Returns:
+        True si la conexión se admite
+    """
+    limiter = server.connection_limiter
+    if limiter is None or limiter.acquire(client_address[0]):
+        return True
+    if server.ssl_context is None:
+        try:
+            conn.send(TOO_MANY_CONNECTIONS.close)
+        except OSError:
+            pass
+    return False
+
+
+def release_connection(server, client_address):
+    """Libera la reserva de una conexión admitida por admit_connection()."""
+    if server.connection_limiter is not None:
+        server.connection_limiter.release(client_address[0])
+
+
+def create_tls_context(cert_file, key_file, session_tickets=True,
+                       alpn_protocols=('http/1.1',)):
+    """
+    Crea el contexto TLS del portal, con el certificado ya cargado.
+    
+    El contexto se crea una sola vez y lo comparten todas las conexiones:
+    el certificado y la clave no se vuelven a leer, y la caché de sesiones
+    y la clave de los tickets de sesión son del contexto, así que solo un
+    contexto compartido permite reanudar sesiones.
+    
+    Args:
+        cert_file: Ruta del certificado (con la cadena intermedia)
+        key_file: Ruta de la clave privada
+        session_tickets: Si se emiten tickets para reanudar sesiones
+        alpn_protocols: Protocolos ofrecidos por ALPN (el portal solo
+            habla HTTP/1.1)
+        
+    Returns:
+        ssl.SSLContext de servidor
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert_file, key_file)
+    context.set_alpn_protocols(list(alpn_protocols))
+    if not session_tickets:
+        context.options |= ssl.OP_NO_TICKET
+        context.num_tickets = 0
+    return context
+
+
+def observe_tls_handshake(server, result, started):
+    """Registra en server.metrics una negociación TLS iniciada en started."""
+    if server.metrics is not None:
+        server.metrics.observe_tls_handshake(result, time.perf_counter() - started)
+
+
+def tls_handshake(server, conn, client_address):
+    """
+    Completa la negociación TLS de una conexión en modo bloqueante.
+    
+    Args:
+        server: Servidor que aceptó la conexión
+        conn: ssl.SSLSocket creado con do_handshake_on_connect=False
+        client_address: Tupla (ip, puerto) del cliente
+        
+    Returns:
+        True si la negociación terminó bien
+    """
+    started = time.perf_counter()
+    try:
+        conn.do_handshake()
+    except (ssl.SSLError, OSError) as e:
+        # Habitual con clientes que rechazan el certificado: no es un error
+        # del portal
+        logging.debug(f"Negociación TLS fallida con {client_address[0]}: {e}")
+        observe_tls_handshake(server, 'failed', started)
+        return False
+    observe_tls_handshake(server, 'resumed' if conn.session_reused else 'full', started)
+    return True
+
+
+class CaptivePortalHandler(BaseHTTPRequestHandler):
+    """Manejador de peticiones HTTP para el portal cautivo."""
+    
+    protocol_version = PROTOCOL_VERSION
+    
+    # Evita el retardo de Nagle entre cabeceras y cuerpo en conexiones persistentes
+    disable_nagle_algorithm = True
+    
+    # Segundos que un login espera la relectura de la tabla de vecinos si
+    # la MAC del cliente aún no está en ella, antes de rechazarlo
+    neighbor_wait = 1.0
+    
+    def setup(self):
+        """Prepara la conexión e inicializa el contador de peticiones."""
+        super().setup()
+        self.requests_served = 0
+        self.command = None
+        self.path = None
+    
+    def handle(self):
+        """Atiende peticiones mientras la conexión siga siendo persistente."""
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            # Entre peticiones se aplica el timeout de inactividad
+            self.connection.settimeout(self.server.keepalive_timeout)
+            self.handle_one_request()
+    
+    def parse_request(self):
+        """
+        Analiza la petición y decide si la conexión continúa abierta.
+        
+        Returns:
+            True si la petición es válida, False en caso contrario
+        """
+        # Restaurar el timeout de lectura tras la espera de inactividad
+        self.connection.settimeout(self.server.request_timeout)
+        self.request_started = None
+        # Un error de análisis se registra antes de que exista la ruta: no
+        # debe heredar la de la petición anterior de la conexión
+        self.path = None
+        if not super().parse_request():
+            return False
+        
+        self.requests_served += 1
+        if self.request_version != 'HTTP/1.1':
+            # Los clientes HTTP/1.0 siempre cierran la conexión
+            self.close_connection = True
+        elif self.requests_served >= self.server.max_keepalive_requests:
+            self.close_connection = True
+        return True
+    
+    def has_pending_request(self, wait=0):
+        """
+        Comprueba si ya hay otra petición recibida (pipelining).
+        
+        Args:
+            wait: Segundos que se espera a que el cliente envíe algo si
+                todavía no hay datos
+        
+        Returns:
+            True si hay datos pendientes de leer en la conexión
+        """
+        timeout = self.connection.gettimeout()
+        self.connection.settimeout(0)
+        try:
+            if self.rfile.peek(1):
+                return True
+        except OSError:
+            pass
+        finally:
+            self.connection.settimeout(timeout)
+        if wait <= 0:
+            return False
+        # select() en lugar de una lectura con timeout: un timeout en rfile
+        # lo deja inutilizable para las lecturas siguientes
+        try:
+            readable, _, _ = select.select([self.connection], [], [], wait)
+        except (OSError, ValueError):
+            return False
+        return bool(readable)
+    
+    def log_message(self, format, *args):
+        """Sobrescribe el método de logging por defecto."""
+        logging.info(f"{self.address_string()} - {format % args}")
+    
+    def log_request(self, code='-', size='-'):
+        """
+        Registra la petición atendida.
+        
+        Con registro de accesos solo se encola el evento; el formateo y la
+        escritura ocurren en su propio hilo.
+        """
+        access_log = self.server.access_log
+        if access_log is None:
+            super().log_request(code, size)
+            return
+        started = getattr(self, 'request_started', None)
+        # Sin línea de petición válida (400, 414) el registro va sin ruta
+        path = getattr(self, 'path', None)
+        access_log.access(
+            self.client_address[0], getattr(self, 'command', None) or None,
+            path.split('?', 1)[0] if path else None,
+            code.value if hasattr(code, 'value') else code,
+            time.perf_counter() - started if started is not None else None
+        )
+    
+    def _log_auth(self, event, client_ip, username=None, reason=None, message=None,
+                  level=logging.INFO):
+        """
+        Registra un evento de autenticación.
+        
+        Args:
+            event: Tipo de evento para el registro de accesos
+            client_ip: Dirección IP del cliente
+            username: Usuario implicado
+            reason: Motivo de un rechazo
+            message: Texto para el log general si no hay registro de accesos
+            level: Nivel del mensaje en el log general
+        """
+        access_log = self.server.access_log
+        if access_log is not None:
+            access_log.auth(event, client_ip, username, reason)
+        elif message:
+            logging.log(level, message)
+    
+    def _set_headers(self, content_type='text/html', status_code=200,
+                     content_length=None):
+        """
+        Establece las cabeceras HTTP de la respuesta.
+        
+        Args:
+            content_type: Tipo de contenido MIME
+            status_code: Código de estado HTTP
+            content_length: Longitud del cuerpo en bytes, si se conoce
+        """
+        self.send_response(status_code)
+        self.send_header('Content-type', content_type)
+        if content_length is not None:
+            self.send_header('Content-Length', str(content_length))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+        self.send_header('Pragma', 'no-cache')
+        self.send_header('Expires', '0')
+        self.end_headers()
+    
+    def _send_page(self, body, status_code=200):
+        """
+        Envía una página HTML ya codificada.
+        
+        Args:
+            body: Bytes del cuerpo de la respuesta
+            status_code: Código de estado HTTP
+        """
+        self._set_headers('text/html; charset=utf-8', status_code, len(body))
+        self.wfile.write(body)
     
+    def _send_raw(self, response):
+        """
+        Envía una respuesta HTTP precalculada.
+        
+        Args:
+            response: RawResponse a enviar
+        """
+        self.log_request(response.status_code)
+        self.wfile.write(response.close if self.close_connection else response.keep_alive)
+    
+    def _get_client_ip(self):
+        """
+        Obtiene la dirección IP del cliente.
+        
+        Returns:
+            Dirección IP del cliente
+        """
+        return self.client_address[0]
+    
+    def _get_client_mac(self, client_ip, wait=0.0):
+        """
+        Obtiene la MAC del cliente desde la caché de vecinos.
+        
+        Args:
+            client_ip: Dirección IP del cliente
+            wait: Segundos que esperar a la relectura de la tabla si la IP
+                aún no está en ella
+            
+        Returns:
+            MAC del cliente, o None si no hay vinculación o no se conoce
+        """
+        neighbor_cache = self.server.neighbor_cache
+        if neighbor_cache is None:
+            return None
+        return neighbor_cache.lookup(client_ip, timeout=wait)
+    
+    def _is_authenticated(self, client_ip):
+        """
+        Comprueba si el dispositivo del cliente tiene sesión.
+        
+        Un dispositivo con sesión que aparece en otra IP la conserva: la
+        sesión se traslada sin volver a pedir credenciales.
+        
+        Args:
+            client_ip: Dirección IP del cliente
+            
+        Returns:
+            True si el cliente está autenticado
+        """
+        mac_address = self._get_client_mac(client_ip)
+        if self.server.session_manager.is_authenticated(client_ip, mac_address):
+            return True
+        session_roaming = self.server.session_roaming
+        return (mac_address is not None and session_roaming is not None
+                and session_roaming.roam(client_ip, mac_address))
+    
+    def _end_session(self, client_ip):
+        """
+        Termina la sesión de una IP y contabiliza su tráfico pendiente.
+        
+        Debe llamarse antes de retirar la regla de la IP: su contador
+        desaparece con ella.
+        
+        Args:
+            client_ip: Dirección IP de la sesión
+            
+        Returns:
+            La sesión terminada, o None si no había
+        """
+        session = self.server.session_manager.end_session(client_ip)
+        accountant = self.server.traffic_accountant
+        if session is not None and accountant is not None:
+            accountant.settle({client_ip: session.username})
+        return session
+    
+    def _update_firewall(self, action, client_ip, wait=True, mac_address=None):
+        """
+        Solicita un cambio de firewall para la IP del cliente.
+        
+        Con cola de firewall la operación se encola y, si se pide, se
+        espera como máximo firewall_wait_timeout segundos a que se aplique.
+        
+        Args:
+            action: 'allow', 'block' o 'unbind' (retirar solo el vínculo
+                de una MAC)
+            client_ip: Dirección IP del cliente
+            wait: Si se debe esperar a que la regla quede aplicada
+            mac_address: MAC vinculada a la IP, si la hay
+            
+        Returns:
+            True si se aplicó, False si falló, None si sigue pendiente
+        """
+        firewall_queue = self.server.firewall_queue
+        if firewall_queue is None:
+            firewall_manager = self.server.firewall_manager
+            if action == 'allow':
+                return firewall_manager.allow_ip(client_ip, mac_address)
+            if action == 'block':
+                return firewall_manager.block_ip(client_ip, mac_address)
+            return firewall_manager.apply_batch([(action, client_ip, mac_address)])
+        
+        future = firewall_queue.submit(action, client_ip, mac_address)
+        timeout = self.server.firewall_wait_timeout
+        if not wait or not timeout:
+            return None
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            logging.warning(f"Regla de firewall para {client_ip} aún pendiente tras {timeout}s")
+            return None
+    
+    def _get_login_page(self, message=""):
+        """
+        Obtiene la página HTML de login.
+        
+        Args:
+            message: Mensaje a mostrar al usuario
+            
+        Returns:
+            Bytes UTF-8 de la página de login
+        """
+        if not message:
+            return LOGIN_PAGE
+        return LOGIN_TEMPLATE.render(f"<div class='message error'>{escape(message)}</div>")
+    
+    def _get_success_page(self, username):
+        """
+        Obtiene la página HTML de éxito tras el login.
+        
+        Args:
+            username: Nombre del usuario autenticado
+            
+        Returns:
+            Bytes UTF-8 de la página de éxito
+        """
+        return SUCCESS_TEMPLATE.render(escape(username))
+    
+    def _observe_login(self, result):
+        """Registra el resultado de un intento de login en las métricas."""
+        metrics = self.server.metrics
+        if metrics is not None:
+            metrics.observe_login(result)
+    
+    @instrumented
     def do_GET(self):
         """Maneja las peticiones HTTP GET."""
         client_ip = self._get_client_ip()
         
-        # Obtener referencias a los managers desde el servidor
-        session_manager = self.server.session_manager
+        # Sondeos de conectividad del sistema operativo: respuesta mínima
+        probe = PROBE_RESPONSES.get(self.path.split('?', 1)[0])
+        if probe is not None:
+            if self._is_authenticated(client_ip):
+                self._send_raw(probe)
+            else:
+                self._send_raw(self.server.probe_redirect)
+            return
         
         # Verificar si ya está autenticado
-        if session_manager.is_authenticated(client_ip):
-            username = session_manager.get_username_by_ip(client_ip)
-            self._set_headers()
-            self.wfile.write(self._get_success_page(username).encode())
+        if self._is_authenticated(client_ip):
+            username = self.server.session_manager.get_username_by_ip(client_ip)
+            self._send_page(self._get_success_page(username))
         else:
             # Mostrar página de login
-            self._set_headers()
-            self.wfile.write(self._get_login_page().encode())
+            self._send_page(self._get_login_page())
     
+    def _reject(self, response):
+        """
+        Responde con un rechazo precalculado y cierra la conexión.
+        
+        El cuerpo de la petición no se lee, así que la conexión no puede
+        reutilizarse.
+        """
+        self.close_connection = True
+        self._send_raw(response)
+    
+    @instrumented
     def do_POST(self):
         """Maneja las peticiones HTTP POST."""
         client_ip = self._get_client_ip()
         parsed_path = urlparse(self.path)
+        
+        # Límite de peticiones por IP antes de leer el cuerpo
+        ip_limiter = self.server.ip_rate_limiter
+        if ip_limiter is not None and not ip_limiter.consume(client_ip):
+            self._reject(TOO_MANY_REQUESTS)
+            return
+        
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self._reject(BAD_REQUEST)
+            return
+        if content_length < 0:
+            self._reject(BAD_REQUEST)
+            return
+        if content_length > self.server.max_body_size:
+            self._reject(PAYLOAD_TOO_LARGE)
+            return
+        
+        # Leer siempre el cuerpo completo: en una conexión persistente los
+        # bytes sin leer se interpretarían como la siguiente petición
+        post_data = self.rfile.read(content_length).decode('utf-8', 'replace')
     
     # Manejar logout
         if parsed_path.path == '/logout':
             # Terminar sesión
-            self.server.session_manager.end_session(client_ip)
+            session = self._end_session(client_ip)
             
-            # Bloquear IP en el firewall
-            self.server.firewall_manager.block_ip(client_ip)
+            # Bloquear IP en el firewall (sin esperar a que se aplique)
+            self._update_firewall('block', client_ip, wait=False,
+                                  mac_address=session.mac if session else None)
             
             # Redirigir a página de login con mensaje
-            self._set_headers()
-            self.wfile.write(self._get_login_page("Sesión cerrada correctamente").encode())
-            logging.info(f"Usuario desconectado desde {client_ip}")
+            self._send_page(self._get_login_page("Sesión cerrada correctamente"))
+            username = session.username if session else None
+            self._log_auth('logout', client_ip, username,
+                           message=f"Usuario '{username}' desconectado desde {client_ip}")
             return
         
-        # Leer el contenido del POST
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length).decode('utf-8')
+        # Analizar el contenido del POST
         params = parse_qs(post_data)
         
         # Obtener credenciales
         username = params.get('username', [''])[0]
         password = params.get('password', [''])[0]
         
+        # Límite de intentos por usuario, aunque lleguen desde muchas IPs
+        username_limiter = self.server.username_rate_limiter
+        if username_limiter is not None and not username_limiter.consume(username):
+            self._observe_login('rate_limited')
+            self._log_auth('login_rejected', client_ip, username, 'rate_limit')
+            self._send_raw(TOO_MANY_REQUESTS)
+            return
+        
         # Obtener referencias a los managers desde el servidor
         user_manager = self.server.user_manager
         session_manager = self.server.session_manager
-        firewall_manager = self.server.firewall_manager
         
         # Autenticar usuario
-        if user_manager.authenticate(username, password):
+        started = time.perf_counter()
+        authenticated = user_manager.authenticate(username, password)
+        if self.server.metrics is not None:
+            self.server.metrics.observe_authenticate(time.perf_counter() - started)
+        
+        if authenticated:
+            # Sin acceso si ya agotó su cuota de tráfico
+            accountant = self.server.traffic_accountant
+            if accountant is not None and accountant.is_over_quota(username):
+                self._observe_login('over_quota')
+                self._log_auth('login_rejected', client_ip, username, 'quota',
+                               f"Login de '{username}' rechazado desde {client_ip}: cuota agotada",
+                               logging.WARNING)
+                self._send_page(self._get_login_page("Cuota de tráfico agotada"), 403)
+                return
+            
+            # Con vinculación, la sesión pertenece al dispositivo (IP, MAC).
+            # Un dispositivo recién llegado puede no estar aún en la caché
+            mac_address = self._get_client_mac(client_ip, wait=self.neighbor_wait)
+            if mac_address is None and self.server.neighbor_cache is not None:
+                self._observe_login('unidentified')
+                self._log_auth('login_rejected', client_ip, username, 'no_mac',
+                               f"Login de '{username}' rechazado desde {client_ip}: "
+                               f"MAC desconocida", logging.WARNING)
+                self._send_page(self._get_login_page("No se pudo identificar el dispositivo"), 403)
+                return
+            previous_mac = session_manager.get_mac_by_ip(client_ip)
+            previous_ip = session_manager.find_ip_by_mac(mac_address) if mac_address else None
+            
             # Crear sesión
-            session_manager.create_session(client_ip, username)
+            session_manager.create_session(client_ip, username, mac_address)
+            self._observe_login('success')
+            
+            # Un dispositivo tiene como mucho una sesión, y la IP deja de
+            # valer para el dispositivo que la tenía antes
+            if previous_ip is not None and previous_ip != client_ip:
+                if self._end_session(previous_ip) is not None:
+                    self._update_firewall('block', previous_ip, wait=False,
+                                          mac_address=mac_address)
+            if previous_mac is not None and previous_mac != mac_address:
+                self._update_firewall('unbind', client_ip, wait=False, mac_address=previous_mac)
             
             # Permitir acceso en el firewall
-            firewall_manager.allow_ip(client_ip)
+            self._update_firewall('allow', client_ip, mac_address=mac_address)
             
-            logging.info(f"Usuario '{username}' autenticado desde {client_ip}")
+            self._log_auth('login', client_ip, username,
+                           message=f"Usuario '{username}' autenticado desde {client_ip}")
             
             # Mostrar página de éxito
-            self._set_headers()
-            self.wfile.write(self._get_success_page(username).encode())
+            self._send_page(self._get_success_page(username))
         else:
             # Autenticación fallida
-            logging.warning(f"Intento de login fallido desde {client_ip} con usuario '{username}'")
+            self._observe_login('failure')
+            self._log_auth('login_failed', client_ip, username,
+                           message=f"Intento de login fallido desde {client_ip} "
+                                   f"con usuario '{username}'",
+                           level=logging.WARNING)
             
-            self._set_headers()
-            self.wfile.write(self._get_login_page("Usuario o contraseña incorrectos").encode())
+            self._send_page(self._get_login_page("Usuario o contraseña incorrectos"))
+
+
+class PortalRedirectHandler(CaptivePortalHandler):
+    """
+    Manejador del puerto HTTP cuando el portal se sirve por HTTPS.
+    
+    Solo contesta los sondeos de conectividad de los clientes autenticados;
+    cualquier otra petición recibe la redirección precalculada al portal
+    HTTPS, sin leer cuerpos ni generar páginas.
+    """
+    
+    @instrumented
+    def do_GET(self):
+        """Responde el sondeo de un cliente autenticado o redirige al portal."""
+        probe = PROBE_RESPONSES.get(self.path.split('?', 1)[0])
+        if probe is not None and self._is_authenticated(self._get_client_ip()):
+            self._send_raw(probe)
+        else:
+            self._send_raw(self.server.probe_redirect)
+    
+    @instrumented
+    def do_POST(self):
+        """Redirige al portal sin leer el cuerpo (las credenciales solo por HTTPS)."""
+        self._reject(self.server.probe_redirect)
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """
+    Servidor HTTP que atiende cada conexión en un pool acotado de hilos.
+    
+    Cuando todos los workers están ocupados el hilo de aceptación se
+    bloquea, y las conexiones nuevas esperan en el backlog del kernel en
+    lugar de crear hilos sin límite.
+    """
+    
+    # Conexiones persistentes: segundos de inactividad y peticiones máximas
+    keepalive_timeout = 5
+    max_keepalive_requests = 100
+    
+    # ConnectionLimiter opcional aplicado al aceptar cada conexión
+    connection_limiter = None
+    
+    def __init__(self, server_address, handler_class, max_workers=32,
+                 backlog=128, request_timeout=10, ssl_context=None):
+        """
+        Inicializa el servidor con pool de hilos.
+        
+        Args:
+            server_address: Tupla (host, puerto) en la que escuchar
+            handler_class: Clase manejadora de peticiones
+            max_workers: Número máximo de conexiones atendidas a la vez
+            backlog: Tamaño de la cola de conexiones pendientes del socket
+            request_timeout: Segundos máximos de espera en lecturas del cliente
+            ssl_context: Contexto TLS opcional (ver create_tls_context)
+        """
+        self.request_queue_size = backlog
+        self.request_timeout = request_timeout
+        self.ssl_context = ssl_context
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='portal-http')
+        self._slots = BoundedSemaphore(max_workers)
+        super().__init__(server_address, handler_class)
+    
+    def get_request(self):
+        """Acepta una conexión y le aplica el timeout de lectura."""
+        request, client_address = super().get_request()
+        request.settimeout(self.request_timeout)
+        return request, client_address
+    
+    def process_request(self, request, client_address):
+        """Encola la conexión en el pool, esperando si está lleno."""
+        # Un mismo cliente no puede acaparar los workers con conexiones lentas
+        if not admit_connection(self, request, client_address):
+            self.shutdown_request(request)
+            return
+        
+        self._slots.acquire()
+        try:
+            self.executor.submit(self._process_request_worker, request, client_address)
+        except RuntimeError:
+            # El pool ya se cerró durante el apagado
+            self._slots.release()
+            release_connection(self, client_address)
+            self.shutdown_request(request)
+    
+    def _process_request_worker(self, request, client_address):
+        """Atiende una conexión dentro de un hilo del pool."""
+        try:
+            # La negociación TLS ocurre en el worker, no en el hilo de aceptación
+            if self.ssl_context is not None:
+                request = self.ssl_context.wrap_socket(request, server_side=True,
+                                                       do_handshake_on_connect=False)
+                if not tls_handshake(self, request, client_address):
+                    return
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+            release_connection(self, client_address)
+    
+    def server_close(self):
+        """Cierra el socket de escucha y el pool de hilos."""
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+class AsyncioHTTPServer:
+    """
+    Servidor HTTP basado en asyncio.
+    
+    El bucle de eventos acepta conexiones y espera el primer byte de cada
+    cliente sin ocupar hilos, de modo que los clientes lentos o inactivos
+    no consumen workers. La petición ya recibida se procesa con el mismo
+    manejador síncrono en un pool acotado de hilos. En conexiones
+    persistentes la espera entre peticiones vuelve al bucle de eventos.
+    """
+    
+    # Conexiones persistentes: segundos de inactividad y peticiones máximas
+    keepalive_timeout = 5
+    max_keepalive_requests = 100
+    
+    # Segundos que el worker espera la siguiente petición antes de devolver
+    # la conexión al bucle de eventos. Un cliente activo no paga así el paso
+    # por el bucle (dos cambios de hilo) en cada petición; uno inactivo
+    # retiene el worker como mucho este tiempo
+    keepalive_linger = 0.005
+    
+    # ConnectionLimiter opcional aplicado al aceptar cada conexión
+    connection_limiter = None
+    
+    def __init__(self, server_address, handler_class, max_workers=32,
+                 backlog=128, request_timeout=10, ssl_context=None):
+        """
+        Inicializa el servidor asyncio.
+        
+        Args:
+            server_address: Tupla (host, puerto) en la que escuchar
+            handler_class: Clase manejadora de peticiones
+            max_workers: Número máximo de peticiones procesadas a la vez
+            backlog: Tamaño de la cola de conexiones pendientes del socket
+            request_timeout: Segundos máximos de espera en lecturas del cliente
+            ssl_context: Contexto TLS opcional (ver create_tls_context)
+        """
+        self.RequestHandlerClass = handler_class
+        self.max_workers = max_workers
+        self.request_timeout = request_timeout
+        self.ssl_context = ssl_context
+        self.socket = socket.create_server(server_address, backlog=backlog)
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()[:2]
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='portal-aio')
+        self._loop = None
+        self._stop_event = None
+        self._started = Event()
+        self._stopped = Event()
+    
+    def serve_forever(self):
+        """Ejecuta el bucle de eventos hasta que se llame a shutdown()."""
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete(self._serve())
+        finally:
+            self._loop.close()
+            self._stopped.set()
+    
+    def shutdown(self):
+        """Detiene el bucle de eventos y espera a que termine."""
+        self._started.wait()
+        self._loop.call_soon_threadsafe(self._stop_event.set)
+        self._stopped.wait()
+    
+    def server_close(self):
+        """Cierra el socket de escucha y el pool de hilos."""
+        self.socket.close()
+        self.executor.shutdown(wait=False)
+    
+    async def _serve(self):
+        """Acepta conexiones hasta recibir la señal de parada."""
+        self._stop_event = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_workers)
+        self._started.set()
+        
+        connections = set()
+        accept_task = asyncio.ensure_future(self._accept_loop(connections))
+        await self._stop_event.wait()
+        
+        accept_task.cancel()
+        for task in list(connections):
+            task.cancel()
+        await asyncio.gather(accept_task, *connections, return_exceptions=True)
+    
+    async def _accept_loop(self, connections):
+        """Bucle de aceptación de conexiones."""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                conn, client_address = await loop.sock_accept(self.socket)
+            except OSError as e:
+                logging.error(f"Error aceptando conexión: {e}")
+                continue
+            if not admit_connection(self, conn, client_address):
+                conn.close()
+                continue
+            task = asyncio.ensure_future(self._handle_connection(conn, client_address))
+            connections.add(task)
+            task.add_done_callback(connections.discard)
+    
+    async def _wait_readable(self, conn, timeout, writable=False):
+        """Espera sin bloquear a que el cliente envíe datos (o admita escrituras)."""
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = conn.fileno()
+        add, remove = ((loop.add_writer, loop.remove_writer) if writable
+                       else (loop.add_reader, loop.remove_reader))
+        add(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await asyncio.wait_for(ready, timeout)
+        finally:
+            remove(fd)
+    
+    async def _tls_handshake(self, conn, client_address):
+        """
+        Negocia TLS en el bucle de eventos, sin ocupar un worker.
+        
+        Returns:
+            True si la negociación terminó bien
+        """
+        started = time.perf_counter()
+        deadline = time.monotonic() + self.request_timeout
+        try:
+            while True:
+                try:
+                    conn.do_handshake()
+                    break
+                except ssl.SSLWantReadError:
+                    writable = False
+                except ssl.SSLWantWriteError:
+                    writable = True
+                await self._wait_readable(conn, deadline - time.monotonic(), writable)
+        except (ssl.SSLError, OSError, asyncio.TimeoutError) as e:
+            logging.debug(f"Negociación TLS fallida con {client_address[0]}: {e}")
+            observe_tls_handshake(self, 'failed', started)
+            return False
+        observe_tls_handshake(self, 'resumed' if conn.session_reused else 'full', started)
+        return True
+    
+    async def _handle_connection(self, conn, client_address):
+        """Espera cada petición del cliente y la despacha al pool de hilos."""
+        loop = asyncio.get_running_loop()
+        handler = None
+        timeout = self.request_timeout
+        try:
+            if self.ssl_context is not None:
+                conn = self.ssl_context.wrap_socket(conn, server_side=True,
+                                                    do_handshake_on_connect=False)
+                if not await self._tls_handshake(conn, client_address):
+                    return
+            while True:
+                # Con TLS la petición puede estar ya descifrada en el buffer
+                # de la conexión, sin nada pendiente en el socket
+                pending = self.ssl_context is not None and conn.pending()
+                try:
+                    if not pending:
+                        await self._wait_readable(conn, timeout)
+                except asyncio.TimeoutError:
+                    break
+                
+                async with self._slots:
+                    if handler is None:
+                        conn.setblocking(True)
+                        conn.settimeout(self.request_timeout)
+                        handler = self._create_handler(conn, client_address)
+                    future = loop.run_in_executor(
+                        self.executor, self._process_requests, handler)
+                    try:
+                        keep_alive = await asyncio.shield(future)
+                    except asyncio.CancelledError:
+                        # Apagado: no cerrar el socket mientras un worker
+                        # todavía escribe en él
+                        await asyncio.wait([future])
+                        raise
+                if not keep_alive:
+                    break
+                timeout = self.keepalive_timeout
+        finally:
+            self._close_connection(handler, conn)
+            release_connection(self, client_address)
+    
+    def _create_handler(self, conn, client_address):
+        """
+        Crea el manejador de la conexión sin ejecutar su bucle handle().
+        
+        El manejador se reutiliza entre peticiones para conservar los datos
+        ya leídos en su buffer.
+        """
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.request = conn
+        handler.client_address = client_address
+        handler.server = self
+        handler.setup()
+        return handler
+    
+    def _process_requests(self, handler):
+        """
+        Atiende las peticiones ya recibidas en la conexión.
+        
+        Returns:
+            True si la conexión debe seguir abierta
+        """
+        try:
+            handler.close_connection = True
+            handler.handle_one_request()
+            while (not handler.close_connection
+                   and handler.has_pending_request(self.keepalive_linger)):
+                handler.handle_one_request()
+            return not handler.close_connection
+        except Exception as e:
+            logging.error(f"Error atendiendo a {handler.client_address[0]}: {e}")
+            return False
+    
+    def _close_connection(self, handler, conn):
+        """Libera el manejador y cierra el socket del cliente."""
+        try:
+            if handler is not None:
+                handler.finish()
+            conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        conn.close()
+
+
+# Motores de servicio disponibles para CaptivePortalServer
+SERVER_ENGINES = {
+    'threadpool': ThreadPoolHTTPServer,
+    'asyncio': AsyncioHTTPServer,
+}
 
 
 class CaptivePortalServer:
-    """Servidor HTTP del portal cautivo con soporte multihilo."""
+    """
+    Servidor HTTP del portal cautivo con soporte multihilo.
+    
+    Con tls_port el portal se sirve por HTTPS y el puerto HTTP queda como
+    redirector: solo contesta sondeos y redirige al portal HTTPS.
+    """
     
     def __init__(self, host='0.0.0.0', port=80, user_manager=None, 
-                 session_manager=None, firewall_manager=None):
+                 session_manager=None, firewall_manager=None,
+                 engine='threadpool', max_workers=32, backlog=128,
+                 request_timeout=10, keepalive_timeout=5,
+                 max_keepalive_requests=100, firewall_queue=None,
+                 firewall_wait_timeout=2.0, portal_url=None,
+                 ip_rate=1.0, ip_burst=10, username_rate=1.0, username_burst=20,
+                 max_body_size=4096, max_connections=1024,
+                 max_connections_per_ip=8, traffic_accountant=None, metrics=None,
+                 access_log=None, neighbor_cache=None, session_roaming=None,
+                 tls_port=None, tls_cert_file=None, tls_key_file=None,
+                 tls_session_tickets=True):
         """
         Inicializa el servidor del portal cautivo.
         
@@ -392,34 +1323,154 @@ class CaptivePortalServer:
             user_manager: Instancia de UserManager
             session_manager: Instancia de SessionManager
             firewall_manager: Instancia de FirewallManager
+            engine: Motor de servicio ('threadpool' o 'asyncio')
+            max_workers: Número máximo de peticiones atendidas a la vez
+            backlog: Tamaño de la cola de conexiones pendientes
+            request_timeout: Segundos máximos de espera en lecturas del cliente
+            keepalive_timeout: Segundos de inactividad antes de cerrar una
+                conexión persistente
+            max_keepalive_requests: Peticiones máximas por conexión
+            firewall_queue: Instancia opcional de FirewallWorkQueue
+            firewall_wait_timeout: Segundos que un login espera a que se
+                aplique su regla de firewall (0 para no esperar)
+            portal_url: URL del portal a la que se redirigen los sondeos de
+                clientes no autenticados (por defecto se deriva de host y port)
+            ip_rate: POST por segundo admitidos por IP (None para no limitar)
+            ip_burst: POST seguidos admitidos por IP
+            username_rate: Intentos de login por segundo por usuario (None
+                para no limitar)
+            username_burst: Intentos de login seguidos por usuario, p. ej.
+                desde varios dispositivos del mismo usuario
+            max_body_size: Tamaño máximo del cuerpo de un POST en bytes
+            max_connections: Conexiones abiertas máximas en total
+            max_connections_per_ip: Conexiones abiertas máximas por IP
+            traffic_accountant: TrafficAccountant opcional; los usuarios con
+                la cuota agotada no pueden iniciar sesión
+            metrics: PortalMetrics opcional donde registrar peticiones y logins
+            access_log: AccessLog opcional; sustituye al log general para
+                accesos y eventos de autenticación
+            neighbor_cache: NeighborCache opcional; con ella cada sesión se
+                vincula a la MAC del cliente y no se admiten logins sin MAC
+            session_roaming: SessionRoaming opcional que traslada la sesión
+                de un dispositivo que cambia de IP
+            tls_port: Puerto HTTPS del portal (None para servir solo HTTP)
+            tls_cert_file: Certificado del portal, válido para el nombre de
+                portal_url
+            tls_key_file: Clave privada del certificado
+            tls_session_tickets: Si se emiten tickets de sesión TLS
         """
+        if engine not in SERVER_ENGINES:
+            raise ValueError(f"Motor de servicio desconocido: {engine}")
+        
         self.host = host
         self.port = port
         self.user_manager = user_manager
         self.session_manager = session_manager
         self.firewall_manager = firewall_manager
+        self.firewall_queue = firewall_queue
+        self.firewall_wait_timeout = firewall_wait_timeout
+        self.engine = engine
+        self.max_workers = max_workers
+        self.backlog = backlog
+        self.request_timeout = request_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.max_keepalive_requests = max_keepalive_requests
+        self.portal_url = portal_url
+        self.max_body_size = max_body_size
+        self.ip_rate_limiter = TokenBucketTable(ip_rate, ip_burst) if ip_rate else None
+        self.username_rate_limiter = (TokenBucketTable(username_rate, username_burst)
+                                      if username_rate else None)
+        self.connection_limiter = ConnectionLimiter(max_connections, max_connections_per_ip)
+        self.traffic_accountant = traffic_accountant
+        self.metrics = metrics
+        self.access_log = access_log
+        self.neighbor_cache = neighbor_cache
+        self.session_roaming = session_roaming
+        self.tls_port = tls_port
+        # El certificado se carga una vez, al crear el servidor
+        self.tls_context = None
+        if tls_port is not None:
+            self.tls_context = create_tls_context(tls_cert_file, tls_key_file,
+                                                  session_tickets=tls_session_tickets)
         self.server = None
         self.server_thread = None
+        self.tls_server = None
+        self.tls_server_thread = None
     
-    def start(self):
-        """Inicia el servidor HTTP."""
-        self.server = HTTPServer((self.host, self.port), CaptivePortalHandler)
+    def _create_server(self, port, handler_class, ssl_context=None):
+        """Crea un servidor del motor configurado con los managers adjuntos."""
+        server_class = SERVER_ENGINES[self.engine]
+        server = server_class(
+            (self.host, port),
+            handler_class,
+            max_workers=self.max_workers,
+            backlog=self.backlog,
+            request_timeout=self.request_timeout,
+            ssl_context=ssl_context
+        )
         
         # Adjuntar los managers al servidor para que el handler pueda acceder
-        self.server.user_manager = self.user_manager
-        self.server.session_manager = self.session_manager
-        self.server.firewall_manager = self.firewall_manager
+        server.user_manager = self.user_manager
+        server.session_manager = self.session_manager
+        server.firewall_manager = self.firewall_manager
+        server.firewall_queue = self.firewall_queue
+        server.firewall_wait_timeout = self.firewall_wait_timeout
+        server.keepalive_timeout = self.keepalive_timeout
+        server.max_keepalive_requests = self.max_keepalive_requests
+        
+        # Límites de peticiones y conexiones (compartidos entre HTTP y HTTPS)
+        server.ip_rate_limiter = self.ip_rate_limiter
+        server.username_rate_limiter = self.username_rate_limiter
+        server.max_body_size = self.max_body_size
+        server.connection_limiter = self.connection_limiter
+        server.traffic_accountant = self.traffic_accountant
+        server.metrics = self.metrics
+        server.access_log = self.access_log
+        server.neighbor_cache = self.neighbor_cache
+        server.session_roaming = self.session_roaming
+        return server
+    
+    def start(self):
+        """Inicia el servidor HTTP y, si se configuró, el HTTPS."""
+        if self.tls_context is None:
+            self.server = self._create_server(self.port, CaptivePortalHandler)
+            scheme, default_port, portal_server = "http", 80, self.server
+        else:
+            self.tls_server = self._create_server(self.tls_port, CaptivePortalHandler,
+                                                  self.tls_context)
+            self.server = self._create_server(self.port, PortalRedirectHandler)
+            scheme, default_port, portal_server = "https", 443, self.tls_server
+        
+        # Redirección precalculada al portal para sondeos de clientes no
+        # autenticados y, con HTTPS, para todo el puerto HTTP
+        portal_url = self.portal_url
+        if portal_url is None:
+            port = portal_server.server_address[1]
+            portal_url = (f"{scheme}://{self.host}/" if port == default_port
+                          else f"{scheme}://{self.host}:{port}/")
+        probe_redirect = build_raw_response(302, extra_headers=[('Location', portal_url)])
+        self.server.probe_redirect = probe_redirect
         
         # Ejecutar en un hilo separado
         self.server_thread = Thread(target=self.server.serve_forever, daemon=True)
         self.server_thread.start()
+        logging.info(f"Servidor HTTP ({self.engine}) iniciado en {self.host}:{self.port}")
         
-        logging.info(f"Servidor HTTP iniciado en {self.host}:{self.port}")
+        if self.tls_server is not None:
+            self.tls_server.probe_redirect = probe_redirect
+            self.tls_server_thread = Thread(target=self.tls_server.serve_forever, daemon=True)
+            self.tls_server_thread.start()
+            logging.info(f"Servidor HTTPS ({self.engine}) iniciado en "
+                         f"{self.host}:{self.tls_port}")
     
     def stop(self):
-        """Detiene el servidor HTTP."""
+        """Detiene los servidores HTTP y HTTPS."""
         if self.server:
             self.server.shutdown()
             self.server.server_close()
             logging.info("Servidor HTTP detenido")
+        if self.tls_server:
+            self.tls_server.shutdown()
+            self.tls_server.server_close()
+            logging.info("Servidor HTTPS detenido")
 
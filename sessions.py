@@ -1,105 +1,528 @@
+import heapq
+import socket
+import sys
 import time
-from threading import Lock
-from datetime import datetime, timedelta
+from collections import namedtuple
+from threading import Condition, Lock
+from datetime import datetime
 
+
+def format_timestamp(timestamp):
+
+    # Solo se formatea al presentar los datos, nunca al almacenarlos
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def pack_ip(ip_address):
+
+    # IPv4 como entero de 32 bits: 32 bytes frente a unos 57 de la cadena
+    try:
+        return int.from_bytes(socket.inet_aton(ip_address), 'big')
+    except (OSError, TypeError):
+        raise ValueError(f"Dirección IPv4 no válida: {ip_address!r}")
+
+
+def unpack_ip(packed):
+
+    return socket.inet_ntoa(packed.to_bytes(4, 'big'))
+
+
+def pack_mac(mac_address):
+
+    # MAC "aa:bb:cc:dd:ee:ff" como entero de 48 bits, o None
+    if mac_address is None:
+        return None
+    return int(mac_address.replace(':', ''), 16)
+
+
+def unpack_mac(packed):
+
+    if packed is None:
+        return None
+    digits = f"{packed:012x}"
+    return ':'.join(digits[i:i + 2] for i in range(0, 12, 2))
+
+
+# Registro compacto de una sesión. Con __slots__ no hay diccionario por
+# instancia, los nombres de usuario se internan para que todas las
+# sesiones de un mismo usuario compartan la cadena y la MAC se guarda
+# empaquetada; la propiedad mac la devuelve en texto.
+class Session:
+
+    __slots__ = ('username', 'login_time', 'last_activity', 'scheduled_deadline', 'packed_mac')
+
+    def __init__(self, username, login_time, last_activity=None, mac=None):
+
+        self.username = sys.intern(username)
+        self.login_time = login_time
+        self.last_activity = login_time if last_activity is None else last_activity
+        # MAC del dispositivo que abrió la sesión, si se vincula
+        self.packed_mac = pack_mac(mac)
+        # Vencimiento de la entrada de esta sesión en el heap, si la tiene
+        self.scheduled_deadline = None
+
+    @property
+    def mac(self):
+
+        return unpack_mac(self.packed_mac)
+
+
+# Vista inmutable de una sesión devuelta por get_all_sessions()
+SessionInfo = namedtuple('SessionInfo', ['username', 'login_time', 'last_activity', 'mac'],
+                         defaults=(None,))
+
+
+# Almacén de sesiones. Internamente las IPs son enteros (ver pack_ip) y
+# las MACs también; la interfaz pública usa siempre texto.
+#
+# Medido con tracemalloc, 100k sesiones ocupan unos 28 MB, y 36 MB si se
+# vinculan a una MAC: el registro (72 bytes), las entradas del diccionario
+# y del índice de MACs, la del heap (88 bytes con su vencimiento) y las
+# claves empaquetadas. Con un objeto por sesión no se baja de ese orden;
+# unos pocos MB exigirían columnas en arrays sin índice hash, con
+# búsquedas O(log n) en cada petición.
 class SessionManager:
-     
-    
-    def __init__(self, session_timeout=3600):
-         
-        self.sessions = {}  # {ip_address: {'username': str, 'login_time': float, 'last_activity': float}}
-        self.lock = Lock()
+
+
+    def __init__(self, session_timeout=3600, activity_resolution=1.0,
+                 journal=None, shaper=None, metrics=None, replicator=None):
+
         self.session_timeout = session_timeout
-    
-    def create_session(self, ip_address, username):
-         
+        # Journal opcional donde se anotan altas y bajas (ver journal.py)
+        self.journal = journal
+        # Limitador de ancho de banda opcional notificado de altas y bajas
+        # (ver shaping.py)
+        self.shaper = shaper
+        # PortalMetrics opcional para el retraso de vencimiento (ver metrics.py)
+        self.metrics = metrics
+        # SessionReplicator opcional que envía los eventos a otros nodos
+        # (ver cluster.py)
+        self.replicator = replicator
+
+        # Un único lock para escrituras y recorridos: las lecturas por IP no
+        # lo toman, y con el GIL repartir la tabla en varios locks no mejora
+        # el rendimiento con ningún número de hilos (ver benchmark.py sessions)
+        self.sessions = {}  # {ip empaquetada: Session}
+        self.lock = Lock()
+
+        # Índice de vencimientos: min-heap de (vencimiento, ip) con
+        # invalidación perezosa. La actividad no toca el heap; al llegar una
+        # entrada se recalcula el vencimiento real y se reprograma si hace falta.
+        # Las entradas que no coinciden con Session.scheduled_deadline están obsoletas.
+        self.expiry_heap = []
+
+        # Versión (instante, nodo) del último evento replicado de cada IP,
+        # también de las IPs cuya sesión terminó, para ordenar los eventos
+        # de otros nodos (ver apply_replicated)
+        self.versions = {}
+
+        # La última actividad solo se reescribe si cambió al menos esta
+        # cantidad de segundos, no en cada petición
+        self.activity_resolution = activity_resolution
+
+        # Despierta al hilo de limpieza cuando se programa un vencimiento
+        self.expiry_condition = Condition()
+
+        # Índice {mac: ip}, ambas empaquetadas, de las sesiones vinculadas a
+        # un dispositivo. Se modifica con self.lock tomado y se lee sin él
+        self.mac_index = {}
+
+    def _find(self, ip_address):
+
+        # Sesión de una IP en texto, o None (también si la IP no es válida)
+        try:
+            return self.sessions.get(pack_ip(ip_address))
+        except ValueError:
+            return None
+
+    def _schedule(self, key, session, deadline):
+
+        session.scheduled_deadline = deadline
+        heapq.heappush(self.expiry_heap, (deadline, key))
+
+    def _bind_mac(self, key, session, previous=None):
+
+        # Llamar con self.lock tomado
+        if previous is not None and previous.packed_mac is not None:
+            if self.mac_index.get(previous.packed_mac) == key:
+                del self.mac_index[previous.packed_mac]
+        if session is not None and session.packed_mac is not None:
+            self.mac_index[session.packed_mac] = key
+
+    def _replicate(self, op, key, ip_address, session, timestamp):
+
+        # Llamar con self.lock tomado, igual que el journal, para que los
+        # demás nodos reciban los eventos de cada IP en orden
+        if self.replicator is None:
+            return
+        version = (timestamp, self.replicator.node_id)
+        self.versions[key] = version
+        self.replicator.publish(self._replication_event(op, ip_address, version, session))
+
+    def _replication_event(self, op, ip_address, version, session):
+
+        event = {'op': op, 'ip': ip_address, 't': version[0], 'n': version[1]}
+        if op == 'c':
+            event.update(u=session.username, l=session.login_time,
+                         a=session.last_activity, m=session.mac)
+        elif op == 'x':
+            event['a'] = session.last_activity
+        return event
+
+    def create_session(self, ip_address, username, mac_address=None):
+
+        key = pack_ip(ip_address)
         with self.lock:
             current_time = time.time()
-            self.sessions[ip_address] = {
-                'username': username,
-                'login_time': current_time,
-                'last_activity': current_time
-            }
-            return True
-    
-    def is_authenticated(self, ip_address):
-         
+            session = Session(username, current_time, mac=mac_address)
+            previous = self.sessions.get(key)
+            self.sessions[key] = session
+            self._bind_mac(key, session, previous)
+
+            # Si la IP ya tiene entrada en el heap se reprogramará al vencer.
+            # El nuevo vencimiento es posterior a todos los existentes, así que
+            # solo hay que despertar al hilo de limpieza si el heap estaba vacío
+            was_empty = not self.expiry_heap
+            if previous is not None and previous.scheduled_deadline is not None:
+                session.scheduled_deadline = previous.scheduled_deadline
+            else:
+                self._schedule(key, session, current_time + self.session_timeout)
+
+            # Se anota bajo el lock para que el journal conserve el orden
+            # real de los eventos de cada IP
+            if self.journal:
+                self.journal.record_create(ip_address, session.username,
+                                           current_time, current_time, mac_address)
+            if self.shaper:
+                self.shaper.session_started(ip_address, session.username)
+            self._replicate('c', key, ip_address, session, current_time)
+
+        # Notificar fuera del lock para no invertir el orden de locks
+        if was_empty:
+            self.wake_expiry_waiters()
+        return True
+
+    def move_session(self, old_ip, new_ip, mac_address):
+
+        # Traslada la sesión del dispositivo mac_address a su nueva IP. Si la
+        # IP nueva tenía sesión, era de un dispositivo que ya no la usa y se
+        # sustituye
+        old_key = pack_ip(old_ip)
+        new_key = pack_ip(new_ip)
         with self.lock:
-            if ip_address not in self.sessions:
+            session = self.sessions.get(old_key)
+            if session is None or session.packed_mac != pack_mac(mac_address):
                 return False
-            
-            session = self.sessions[ip_address]
+            del self.sessions[old_key]
+            self._bind_mac(old_key, None, session)
+            if self.journal:
+                self.journal.record_end([old_ip])
+            if self.shaper:
+                self.shaper.session_ended([old_ip])
+            self._replicate('e', old_key, old_ip, session, time.time())
+
+            # Reaparecer en otra IP cuenta como actividad
             current_time = time.time()
-            
-            # Verificar si la sesión ha expirado
-            if current_time - session['last_activity'] > self.session_timeout:
-                del self.sessions[ip_address]
-                return False
-            
-            # Actualizar última actividad
-            session['last_activity'] = current_time
-            return True
-    
+            session.last_activity = current_time
+            previous = self.sessions.get(new_key)
+            self.sessions[new_key] = session
+            self._bind_mac(new_key, session, previous)
+            was_empty = not self.expiry_heap
+            # La entrada del heap de la IP anterior queda obsoleta
+            self._schedule(new_key, session, current_time + self.session_timeout)
+            if self.journal:
+                self.journal.record_create(new_ip, session.username, session.login_time,
+                                           current_time, mac_address)
+            if self.shaper:
+                self.shaper.session_started(new_ip, session.username)
+            self._replicate('c', new_key, new_ip, session, current_time)
+
+        if was_empty:
+            self.wake_expiry_waiters()
+        return True
+
+    def is_authenticated(self, ip_address, mac_address=None):
+
+        # Lectura sin lock: la consulta y la actualización de un elemento de
+        # diccionario son atómicas, y la actividad se escribe como mucho una
+        # vez por activity_resolution segundos
+        session = self._find(ip_address)
+        if session is None:
+            return False
+
+        # Una IP reasignada a otro dispositivo no hereda la sesión
+        if (mac_address is not None and session.packed_mac is not None
+                and session.mac != mac_address):
+            return False
+
+        current_time = time.time()
+        last_activity = session.last_activity
+
+        # Verificar si la sesión ha expirado (la elimina cleanup_expired_sessions
+        # para que también se revoque en el firewall)
+        if current_time - last_activity > self.session_timeout:
+            return False
+
+        # Actualizar última actividad
+        if current_time - last_activity >= self.activity_resolution:
+            session.last_activity = current_time
+        return True
+
+    def record_activity(self, ip_addresses, timestamp):
+
+        # Actividad de red observada fuera del portal (ver activity.py). Todo
+        # el lote se aplica con una sola toma del lock; la última actividad
+        # nunca retrocede. Devuelve las sesiones actualizadas
+        refreshed = 0
+        with self.lock:
+            for ip_address in ip_addresses:
+                session = self._find(ip_address)
+                if session is not None and session.last_activity < timestamp:
+                    session.last_activity = timestamp
+                    refreshed += 1
+        return refreshed
+
     def get_session_info(self, ip_address):
-         
+
         with self.lock:
-            if ip_address not in self.sessions:
+            session = self._find(ip_address)
+            if session is None:
                 return None
-            
-            session = self.sessions[ip_address]
+
             return {
-                'username': session['username'],
-                'login_time': datetime.fromtimestamp(session['login_time']).strftime('%Y-%m-%d %H:%M:%S'),
-                'last_activity': datetime.fromtimestamp(session['last_activity']).strftime('%Y-%m-%d %H:%M:%S'),
-                'active': time.time() - session['last_activity'] <= self.session_timeout
+                'username': session.username,
+                'login_time': session.login_time,
+                'last_activity': session.last_activity,
+                'mac': session.mac,
+                'active': time.time() - session.last_activity <= self.session_timeout
             }
-    
+
     def end_session(self, ip_address):
-         
+
+        # Devuelve la sesión terminada (p. ej. para conocer su MAC) o None
+        try:
+            key = pack_ip(ip_address)
+        except ValueError:
+            return None
         with self.lock:
-            if ip_address in self.sessions:
-                del self.sessions[ip_address]
-                return True
-            return False
-    
+            session = self.sessions.pop(key, None)
+            if session is not None:
+                self._bind_mac(key, None, session)
+                if self.journal:
+                    self.journal.record_end([ip_address])
+                if self.shaper:
+                    self.shaper.session_ended([ip_address])
+                self._replicate('e', key, ip_address, session, time.time())
+            return session
+
+    def restore_sessions(self, records):
+
+        # Carga masiva desde el journal; las sesiones ya vencidas se descartan.
+        # Devuelve {ip: mac} de las sesiones restauradas para reaplicarlas
+        # en el firewall
+        current_time = time.time()
+        restored = {}
+        with self.lock:
+            for ip_address, (username, login_time, last_activity, mac) in records.items():
+                deadline = last_activity + self.session_timeout
+                if deadline <= current_time:
+                    continue
+                key = pack_ip(ip_address)
+                session = Session(username, login_time, last_activity, mac)
+                previous = self.sessions.get(key)
+                self.sessions[key] = session
+                self._bind_mac(key, session, previous)
+                self._schedule(key, session, deadline)
+                if self.shaper:
+                    self.shaper.session_started(ip_address, session.username)
+                # El journal no guarda versiones: la última actividad es
+                # posterior a cualquier evento que creara la sesión
+                if self.replicator is not None:
+                    self.versions[key] = (last_activity, self.replicator.node_id)
+                restored[ip_address] = mac
+
+        self.wake_expiry_waiters()
+        return restored
+
     def get_all_sessions(self):
-         
+
+        # Instantánea coherente: se copia con el lock tomado, sin formatear
+        # nada, y las fechas se devuelven como timestamps (ver
+        # format_timestamp()). Las IPs y MACs se desempaquetan fuera del lock
+        current_time = time.time()
         with self.lock:
-            result = {}
-            current_time = time.time()
-            
-            # Crear copia de las sesiones para no mantener el lock demasiado tiempo
-            for ip, session in list(self.sessions.items()):
-                if current_time - session['last_activity'] <= self.session_timeout:
-                    result[ip] = {
-                        'username': session['username'],
-                        'login_time': datetime.fromtimestamp(session['login_time']).strftime('%Y-%m-%d %H:%M:%S'),
-                        'last_activity': datetime.fromtimestamp(session['last_activity']).strftime('%Y-%m-%d %H:%M:%S')
-                    }
-            
-            return result
-    
+            rows = [(key, session.username, session.login_time, session.last_activity,
+                     session.packed_mac)
+                    for key, session in self.sessions.items()
+                    if current_time - session.last_activity <= self.session_timeout]
+        return {unpack_ip(key): SessionInfo(username, login_time, last_activity,
+                                            unpack_mac(packed_mac))
+                for key, username, login_time, last_activity, packed_mac in rows}
+
+    def get_session_ips(self):
+
+        with self.lock:
+            keys = list(self.sessions)
+        return [unpack_ip(key) for key in keys]
+
+    def get_session_bindings(self):
+
+        # {ip: mac} de todas las sesiones; mac es None si no se vinculó
+        with self.lock:
+            packed = [(key, session.packed_mac) for key, session in self.sessions.items()]
+        return {unpack_ip(key): unpack_mac(packed_mac) for key, packed_mac in packed}
+
     def cleanup_expired_sessions(self):
-         
+
+        # Devuelve {ip: sesión} de las sesiones eliminadas
+        current_time = time.time()
+        expired_ips = {}
+
         with self.lock:
-            current_time = time.time()
-            expired_ips = []
-            
-            for ip, session in list(self.sessions.items()):
-                if current_time - session['last_activity'] > self.session_timeout:
-                    expired_ips.append(ip)
-                    del self.sessions[ip]
-            
-            return expired_ips
-    
-    def get_session_count(self):
-         
+            # Solo se visitan las entradas del heap que ya han vencido
+            heap = self.expiry_heap
+            while heap and heap[0][0] <= current_time:
+                deadline, key = heapq.heappop(heap)
+                session = self.sessions.get(key)
+                if session is None or session.scheduled_deadline != deadline:
+                    continue
+
+                real_deadline = session.last_activity + self.session_timeout
+                if real_deadline > current_time:
+                    # Hubo actividad desde que se programó: reprogramar
+                    self._schedule(key, session, real_deadline)
+                else:
+                    ip = unpack_ip(key)
+                    del self.sessions[key]
+                    self._bind_mac(key, None, session)
+                    expired_ips[ip] = session
+                    if self.metrics is not None:
+                        self.metrics.observe_expiry_lag(current_time - real_deadline)
+                    self._replicate('x', key, ip, session, current_time)
+
+            if expired_ips and self.journal:
+                self.journal.record_end(list(expired_ips))
+            if expired_ips and self.shaper:
+                self.shaper.session_ended(list(expired_ips))
+
+        return expired_ips
+
+    def apply_replicated(self, event):
+
+        # Aplica un evento de otro nodo si su versión es posterior a la
+        # conocida para la IP (gana la última escritura; los relojes de los
+        # nodos deben estar sincronizados). Devuelve (ip, sesión anterior,
+        # sesión actual) si la tabla cambió, o None
+        ip_address = event['ip']
+        key = pack_ip(ip_address)
+        version = (event['t'], event['n'])
         with self.lock:
-            return len(self.sessions)
-    
-    def get_username_by_ip(self, ip_address):
-         
+            known = self.versions.get(key)
+            if known is not None and version <= known:
+                return None
+            previous = self.sessions.get(key)
+
+            if event['op'] == 'x' and previous is not None:
+                # El otro nodo dejó de ver al cliente, pero aquí ha tenido
+                # actividad después: la sesión sigue viva y se vuelve a anunciar
+                if previous.last_activity > event['a'] + self.activity_resolution:
+                    self._replicate('c', key, ip_address, previous,
+                                    max(time.time(), event['t'] + 1e-6))
+                    return None
+
+            self.versions[key] = version
+            if event['op'] != 'c':
+                if previous is None:
+                    return None
+                del self.sessions[key]
+                self._bind_mac(key, None, previous)
+                if self.journal:
+                    self.journal.record_end([ip_address])
+                if self.shaper:
+                    self.shaper.session_ended([ip_address])
+                return ip_address, previous, None
+
+            session = Session(event['u'], event['l'], event['a'], event.get('m'))
+            self.sessions[key] = session
+            self._bind_mac(key, session, previous)
+            was_empty = not self.expiry_heap
+            self._schedule(key, session, session.last_activity + self.session_timeout)
+            if self.journal:
+                self.journal.record_create(ip_address, session.username, session.login_time,
+                                           session.last_activity, session.mac)
+            if self.shaper:
+                self.shaper.session_started(ip_address, session.username)
+
+        if was_empty:
+            self.wake_expiry_waiters()
+        return ip_address, previous, session
+
+    def replication_snapshot(self):
+
+        # Eventos que reconstruyen en otro nodo la tabla completa, incluidas
+        # las bajas aún recordadas, para un nodo que (re)conecta
+        with self.lock:
+            return [self._replication_event('c' if key in self.sessions else 'e',
+                                            unpack_ip(key), version, self.sessions.get(key))
+                    for key, version in self.versions.items()]
+
+    def prune_tombstones(self, max_age):
+
+        # Olvida las versiones de IPs sin sesión con más de max_age segundos
+        limit = time.time() - max_age
         with self.lock:
-            if ip_address in self.sessions:
-                return self.sessions[ip_address]['username']
-            return None
\ No newline at end of file
+            stale = [key for key, (timestamp, _) in self.versions.items()
+                     if timestamp < limit and key not in self.sessions]
+            for key in stale:
+                del self.versions[key]
+        return len(stale)
+
+    def next_expiry(self):
+
+        with self.lock:
+            return self.expiry_heap[0][0] if self.expiry_heap else None
+
+    def wait_for_expiry(self, timeout=None):
+
+        # Bloquea hasta el próximo vencimiento programado, hasta que se
+        # programe uno nuevo o hasta que se llame a wake_expiry_waiters()
+        with self.expiry_condition:
+            next_deadline = self.next_expiry()
+            if next_deadline is not None:
+                remaining = next_deadline - time.time()
+                if remaining <= 0:
+                    return
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            self.expiry_condition.wait(timeout)
+
+    def wake_expiry_waiters(self):
+
+        with self.expiry_condition:
+            self.expiry_condition.notify_all()
+
+    def get_session_count(self):
+
+        # len() de un diccionario es atómico; no hace falta bloquear
+        return len(self.sessions)
+
+    def get_username_by_ip(self, ip_address):
+
+        session = self._find(ip_address)
+        if session is not None:
+            return session.username
+        return None
+
+    def get_mac_by_ip(self, ip_address):
+
+        session = self._find(ip_address)
+        if session is not None:
+            return session.mac
+        return None
+
+    def find_ip_by_mac(self, mac_address):
+
+        try:
+            key = self.mac_index.get(pack_mac(mac_address))
+        except ValueError:
+            return None
+        return None if key is None else unpack_ip(key)
@@ -0,0 +1,223 @@
+"""
+Módulo de control de ancho de banda del portal cautivo.
+Asigna a cada cliente autenticado una clase HTB con cola fq_codel en la
+interfaz de la red local, con límites por usuario o por nivel.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from threading import Condition, Thread
+
+from firewall import run_subprocess
+
+
+class TrafficShaper:
+    """
+    Limitación de bajada por cliente con HTB y fq_codel.
+
+    El tráfico hacia cada IP autenticada se clasifica con un filtro u32 en
+    su propia clase HTB (tasa garantizada y techo según el nivel del
+    usuario) con una cola fq_codel. Lo que no pertenece a ningún cliente
+    va a una clase por defecto.
+
+    SessionManager notifica altas y bajas de sesión; los cambios se
+    acumulan y un hilo los aplica en lotes con una única invocación de
+    "tc -batch". La subida no se limita aquí: tras el MASQUERADE ya no se
+    distingue la IP del cliente.
+    """
+
+    # Clase raíz, clase por defecto y rango de clases de cliente. El minor
+    # de la clase es también el nodo del filtro u32, limitado a 12 bits
+    ROOT_MINOR = 0x1
+    DEFAULT_MINOR = 0xfff
+    FIRST_CLIENT_MINOR = 0x2
+
+    def __init__(self, interface="wlan0", uplink_rate="100mbit", tiers=None,
+                 default_tier="default", user_tiers=None, command_runner=None):
+        """
+        Inicializa el limitador.
+
+        Args:
+            interface: Interfaz de la red local por la que sale la bajada
+            uplink_rate: Capacidad total a repartir entre los clientes
+            tiers: Diccionario {nivel: (tasa, techo)} en unidades de tc
+            default_tier: Nivel de los usuarios sin nivel asignado
+            user_tiers: Diccionario {usuario: nivel}
+            command_runner: Función que ejecuta tc (sustituible en pruebas)
+        """
+        self.interface = interface
+        self.uplink_rate = uplink_rate
+        self.tiers = tiers or {"default": ("2mbit", "10mbit")}
+        if default_tier not in self.tiers:
+            raise ValueError(f"Nivel de ancho de banda desconocido: {default_tier}")
+        self.default_tier = default_tier
+        self.user_tiers = user_tiers or {}
+        self.command_runner = command_runner or run_subprocess
+        self.condition = Condition()
+        self.pending = OrderedDict()  # {ip: usuario, o None para retirarla}
+        self.classes = {}  # {ip: minor} de las clases aplicadas
+        self.free_minors = list(range(self.DEFAULT_MINOR - 1, self.FIRST_CLIENT_MINOR - 1, -1))
+        self.running = False
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+        # Métricas
+        self.batches = 0
+        self.failed_batches = 0
+        self.last_apply_latency = 0.0
+
+    def setup(self):
+        """Crea la jerarquía HTB en la interfaz."""
+        dev = f"dev {self.interface}"
+        self._run_batch([
+            f"qdisc replace {dev} root handle 1: htb default {self.DEFAULT_MINOR:x}",
+            f"class replace {dev} parent 1: classid 1:{self.ROOT_MINOR:x} "
+            f"htb rate {self.uplink_rate}",
+            f"class replace {dev} parent 1:{self.ROOT_MINOR:x} "
+            f"classid 1:{self.DEFAULT_MINOR:x} htb rate {self.uplink_rate}",
+            f"qdisc replace {dev} parent 1:{self.DEFAULT_MINOR:x} fq_codel",
+        ])
+        self.logger.info(f"Control de ancho de banda configurado en {self.interface}")
+
+    def teardown(self):
+        """Elimina la jerarquía HTB y todas las clases de clientes."""
+        self._run_batch([f"qdisc del dev {self.interface} root"])
+        with self.condition:
+            self.classes.clear()
+            self.free_minors = list(range(self.DEFAULT_MINOR - 1,
+                                          self.FIRST_CLIENT_MINOR - 1, -1))
+
+    def start(self):
+        """Inicia el hilo que aplica los cambios pendientes."""
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = Thread(target=self._apply_loop, name="traffic-shaper", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Aplica los cambios pendientes y detiene el hilo."""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def session_started(self, ip_address, username):
+        """Programa la clase de una sesión nueva (llamado por SessionManager)."""
+        with self.condition:
+            self.pending[ip_address] = username
+            self.pending.move_to_end(ip_address)
+            self.condition.notify()
+
+    def session_ended(self, ip_addresses):
+        """Programa la retirada de las clases de sesiones terminadas."""
+        with self.condition:
+            for ip_address in ip_addresses:
+                self.pending[ip_address] = None
+                self.pending.move_to_end(ip_address)
+            self.condition.notify()
+
+    def tier_for(self, username):
+        """Devuelve (tasa, techo) del nivel de un usuario."""
+        tier = self.user_tiers.get(username, self.default_tier)
+        return self.tiers.get(tier, self.tiers[self.default_tier])
+
+    def flush(self):
+        """
+        Aplica de inmediato los cambios pendientes en un único lote.
+
+        Returns:
+            True si tc aplicó el lote correctamente
+        """
+        with self.condition:
+            changes = self.pending
+            self.pending = OrderedDict()
+        if not changes:
+            return True
+
+        dev = f"dev {self.interface}"
+        lines = []
+        with self.condition:
+            for ip_address, username in changes.items():
+                minor = self.classes.get(ip_address)
+                if username is None:
+                    if minor is None:
+                        continue
+                    # El filtro primero, para que nada se clasifique en una
+                    # clase ya borrada; borrar la clase elimina su fq_codel
+                    lines.append(f"filter del {dev} parent 1: protocol ip prio 1 "
+                                 f"handle 800::{minor:x} u32")
+                    lines.append(f"class del {dev} classid 1:{minor:x}")
+                    del self.classes[ip_address]
+                    self.free_minors.append(minor)
+                    continue
+
+                rate, ceil = self.tier_for(username)
+                new_class = minor is None
+                if new_class:
+                    if not self.free_minors:
+                        self.logger.warning(f"Sin clases libres para limitar {ip_address}")
+                        continue
+                    minor = self.free_minors.pop()
+                    self.classes[ip_address] = minor
+                # Una sesión existente solo cambia de tasa (p. ej. otro usuario)
+                lines.append(f"class replace {dev} parent 1:{self.ROOT_MINOR:x} "
+                             f"classid 1:{minor:x} htb rate {rate} ceil {ceil}")
+                if new_class:
+                    lines.append(f"qdisc replace {dev} parent 1:{minor:x} "
+                                 f"handle {minor:x}: fq_codel")
+                    lines.append(f"filter replace {dev} parent 1: protocol ip prio 1 "
+                                 f"handle 800::{minor:x} u32 match ip dst {ip_address}/32 "
+                                 f"flowid 1:{minor:x}")
+        return self._run_batch(lines)
+
+    def metrics(self):
+        """Devuelve las métricas del limitador."""
+        with self.condition:
+            return {
+                'classes': len(self.classes),
+                'free_classes': len(self.free_minors),
+                'pending': len(self.pending),
+                'batches': self.batches,
+                'failed_batches': self.failed_batches,
+                'last_apply_latency': self.last_apply_latency,
+            }
+
+    def _run_batch(self, lines):
+        """Ejecuta las órdenes de tc en una única invocación."""
+        if not lines:
+            return True
+        started = time.monotonic()
+        try:
+            # -force continúa tras un error para no dejar el lote a medias
+            result = self.command_runner(["tc", "-force", "-batch", "-"],
+                                         input="\n".join(lines) + "\n")
+            success = result.returncode == 0
+            if not success:
+                self.logger.error(f"Error aplicando lote de tc: {result.stderr}")
+        except Exception as e:
+            self.logger.error(f"Excepción al ejecutar tc: {e}")
+            success = False
+        with self.condition:
+            self.batches += 1
+            if not success:
+                self.failed_batches += 1
+            self.last_apply_latency = time.monotonic() - started
+        return success
+
+    def _apply_loop(self):
+        """Aplica los cambios acumulados mientras el limitador esté activo."""
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running and not self.pending:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error(f"Error aplicando el control de ancho de banda: {e}")
@@ -0,0 +1,9 @@
+"""
+Configuración común de las pruebas del portal cautivo.
+Los módulos del portal están en la raíz del repositorio.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,51 @@
+"""
+Actividad de red a partir de las lecturas de contadores de la contabilidad.
+"""
+
+from accounting import TrafficAccountant
+from activity import ActivityTracker
+from sessions import SessionManager
+
+
+class CountingFirewall:
+    """Devuelve lecturas de contadores preparadas y cuenta las consultas."""
+
+    def __init__(self, *snapshots):
+        self.snapshots = list(snapshots)
+        self.reads = 0
+
+    def read_counters(self):
+        self.reads += 1
+        return self.snapshots.pop(0)
+
+
+def test_tracker_reuses_accountant_counters():
+    sessions = SessionManager()
+    sessions.create_session("10.0.0.2", "ana")
+    sessions.create_session("10.0.0.3", "luis")
+    firewall = CountingFirewall(
+        {"10.0.0.2": 100, "10.0.0.3": 50},
+        {"10.0.0.2": 400, "10.0.0.3": 50},
+    )
+    accountant = TrafficAccountant(firewall, sessions)
+    tracker = ActivityTracker(sessions, source="counters", traffic_accountant=accountant)
+    tracker.start()
+    tracker.start()
+    assert accountant.listeners == [tracker.record_snapshot]
+
+    # La primera lectura solo sirve de referencia para la actividad
+    accountant.poll()
+    assert tracker.metrics()["active_ips"] == 0
+    before = {ip: sessions.get_session_info(ip)["last_activity"]
+              for ip in ("10.0.0.2", "10.0.0.3")}
+
+    accountant.poll()
+    tracker.stop()
+    # Una sola consulta al firewall por pasada, compartida por ambos
+    assert firewall.reads == 2
+    assert tracker.thread is None
+    assert tracker.metrics()["polls"] == 2
+    assert tracker.metrics()["refreshed_sessions"] == 1
+    assert accountant.get_usage("ana") == 400
+    assert sessions.get_session_info("10.0.0.2")["last_activity"] > before["10.0.0.2"]
+    assert sessions.get_session_info("10.0.0.3")["last_activity"] == before["10.0.0.3"]
@@ -0,0 +1,144 @@
+"""
+Replicación de sesiones entre dos nodos reales sobre loopback. El
+firewall de cada nodo es un command_runner que anota los lotes.
+"""
+
+import socket
+import subprocess
+import time
+
+import pytest
+
+from cluster import SessionReplicator
+from firewall import FirewallManager
+from sessions import SessionManager
+
+
+class RecordingRunner:
+    """Anota los scripts de "ipset restore" que aplicaría el nodo."""
+
+    def __init__(self):
+        self.scripts = []
+
+    def __call__(self, command, input=None):
+        if command[:2] == ["ipset", "restore"]:
+            self.scripts.append(input)
+        return subprocess.CompletedProcess(command, 0, "", "")
+
+    def lines(self):
+        return [line for script in self.scripts for line in script.splitlines()]
+
+
+class Node:
+    """Un portal del clúster: replicador, tabla de sesiones y firewall."""
+
+    def __init__(self, node_id, port, peer_port):
+        self.runner = RecordingRunner()
+        self.replicator = SessionReplicator(
+            node_id, "clave-compartida", "127.0.0.1", port,
+            peers=[("127.0.0.1", peer_port)],
+            firewall_manager=FirewallManager(command_runner=self.runner, bind_macs=True),
+            reconnect_interval=0.05,
+        )
+        self.sessions = SessionManager(replicator=self.replicator)
+
+    def start(self):
+        self.replicator.start(self.sessions)
+
+    def stop(self):
+        self.replicator.stop()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def connected(*nodes):
+    return all(node.replicator.metrics()["connected_peers"] == 1 for node in nodes)
+
+
+@pytest.fixture
+def cluster():
+    port_a, port_b = free_port(), free_port()
+    nodes = Node("a", port_a, port_b), Node("b", port_b, port_a)
+    yield nodes
+    for node in nodes:
+        node.stop()
+
+
+def test_snapshot_on_connect(cluster):
+    a, b = cluster
+    a.start()
+    # Sesiones creadas mientras el otro nodo aún no escucha
+    a.sessions.create_session("10.0.0.2", "ana", "aa:bb:cc:dd:ee:01")
+    a.sessions.create_session("10.0.0.3", "luis")
+    a.sessions.create_session("10.0.0.4", "eva")
+    a.sessions.end_session("10.0.0.4")
+    b.start()
+
+    assert wait_until(lambda: b.sessions.get_session_count() == 2)
+    assert b.sessions.get_session_bindings() == {
+        "10.0.0.2": "aa:bb:cc:dd:ee:01",
+        "10.0.0.3": None,
+    }
+    assert b.sessions.get_username_by_ip("10.0.0.2") == "ana"
+    assert sorted(b.runner.lines()) == [
+        "add portal_allowed 10.0.0.2",
+        "add portal_allowed 10.0.0.3",
+        "add portal_allowed_mac 10.0.0.2,aa:bb:cc:dd:ee:01",
+    ]
+
+
+def test_create_and_end_are_replicated(cluster):
+    a, b = cluster
+    a.start()
+    b.start()
+    assert wait_until(lambda: connected(a, b))
+
+    a.sessions.create_session("10.0.0.2", "ana", "aa:bb:cc:dd:ee:01")
+    assert wait_until(lambda: b.sessions.is_authenticated("10.0.0.2", "aa:bb:cc:dd:ee:01"))
+    assert "add portal_allowed 10.0.0.2" in b.runner.lines()
+
+    # La baja viaja en el otro sentido
+    b.sessions.end_session("10.0.0.2")
+    assert wait_until(lambda: a.sessions.get_session_count() == 0)
+    assert a.runner.lines()[-2:] == [
+        "del portal_allowed_mac 10.0.0.2,aa:bb:cc:dd:ee:01",
+        "del portal_allowed 10.0.0.2",
+    ]
+    assert a.replicator.metrics()["applied_events"] == 1
+
+
+def test_replayed_and_forged_messages_are_rejected(cluster):
+    a, b = cluster
+    b.start()
+    a.sessions.create_session("10.0.0.2", "ana")
+    message = a.replicator.encode(a.sessions.replication_snapshot())
+
+    with socket.create_connection(("127.0.0.1", b.replicator.port)) as conn:
+        conn.sendall(message)
+        assert wait_until(lambda: b.sessions.get_session_count() == 1)
+    b.sessions.end_session("10.0.0.2")
+
+    # El mismo mensaje, íntegro y firmado, no vuelve a dar acceso
+    with socket.create_connection(("127.0.0.1", b.replicator.port)) as conn:
+        conn.sendall(message)
+        assert wait_until(lambda: b.replicator.metrics()["rejected_messages"] == 1)
+    forged = message.replace(b'"ana"', b'"eva"')
+    with socket.create_connection(("127.0.0.1", b.replicator.port)) as conn:
+        conn.sendall(forged)
+        assert wait_until(lambda: b.replicator.metrics()["rejected_messages"] == 2)
+
+    assert b.sessions.get_session_count() == 0
+    assert b.replicator.metrics()["received_events"] == 1
@@ -0,0 +1,239 @@
+"""
+Pruebas del firewall sin root: los comandos se ejecutan contra un
+kernel simulado mediante command_runner.
+"""
+
+import json
+import subprocess
+
+from firewall import (FirewallManager, FirewallReconciler, FirewallWorkQueue,
+                      IpsetBackend, IptablesBackend, NftablesBackend)
+from sessions import SessionManager
+
+
+class FakeIpset:
+    """Simula "ipset restore -exist" y "ipset list -o save" sobre sets en memoria."""
+
+    def __init__(self):
+        self.sets = {}  # {nombre del set: conjunto de elementos}
+        self.commands = []
+
+    def __call__(self, command, input=None):
+        self.commands.append((command, input))
+        if command[:2] == ["ipset", "restore"]:
+            for line in (input or "").splitlines():
+                parts = line.split()
+                if not parts:
+                    continue
+                members = self.sets.setdefault(parts[1], set())
+                if parts[0] == "add":
+                    members.add(parts[2])
+                elif parts[0] == "del":
+                    members.discard(parts[2])
+            return subprocess.CompletedProcess(command, 0, "", "")
+        if command[:2] == ["ipset", "list"]:
+            lines = [f"add {name} {member}"
+                     for name, members in self.sets.items() for member in sorted(members)]
+            return subprocess.CompletedProcess(command, 0, "\n".join(lines) + "\n", "")
+        return subprocess.CompletedProcess(command, 0, "", "")
+
+
+class FakeManager:
+    """FirewallManager mínimo para el reconciliador: estado fijo y lotes anotados."""
+
+    def __init__(self, allowed, bind_macs=False):
+        self.allowed = allowed
+        self.bind_macs = bind_macs
+        self.batches = []
+
+    def read_allowed_state(self):
+        return self.allowed
+
+    def apply_batch(self, operations):
+        self.batches.append(operations)
+        return True
+
+
+def drain(queue):
+    """Aplica todo lo pendiente en la cola y la deja parada."""
+    queue.start()
+    queue.stop()
+
+
+def test_queue_allow_allow_block_leaves_ip_blocked():
+    kernel = FakeIpset()
+    queue = FirewallWorkQueue(FirewallManager(command_runner=kernel))
+
+    first = queue.allow_ip("10.0.0.5")
+    drain(queue)
+    assert first.result(timeout=1) is True
+    assert "10.0.0.5" in kernel.sets["portal_allowed"]
+
+    # Segunda alta aún pendiente cuando llega el bloqueo
+    second = queue.allow_ip("10.0.0.5")
+    block = queue.block_ip("10.0.0.5")
+    drain(queue)
+
+    assert second.result(timeout=1) is True
+    assert block.result(timeout=1) is True
+    assert "10.0.0.5" not in kernel.sets["portal_allowed"]
+    assert "del portal_allowed 10.0.0.5" in kernel.commands[-1][1]
+
+
+IPTABLES_SAVE = """\
+# Generated by iptables-save v1.8.7
+*filter
+:FORWARD DROP [0:0]
+[10:600] -A FORWARD -m state --state ESTABLISHED,RELATED -j ACCEPT
+[3:180] -A FORWARD -s 10.0.0.2/32 -j ACCEPT
+[1:60] -A FORWARD -s 10.0.0.2/32 -j ACCEPT
+[5:300] -A FORWARD -s 10.0.0.3/32 -m mac --mac-source AA:BB:CC:DD:EE:FF -j ACCEPT
+[0:0] -A FORWARD -s 10.0.0.0/24 -d 10.0.1.1/32 -j ACCEPT
+COMMIT
+"""
+
+
+def test_iptables_parsers():
+    backend = IptablesBackend("eth0")
+    plain = "\n".join(line.partition("] ")[2] for line in IPTABLES_SAVE.splitlines())
+
+    assert backend.parse_allowed(plain) == {
+        ("10.0.0.2", None): 2,
+        ("10.0.0.3", "aa:bb:cc:dd:ee:ff"): 1,
+    }
+    assert backend.parse_counters(IPTABLES_SAVE) == {"10.0.0.2": 240, "10.0.0.3": 300}
+
+
+IPSET_SAVE = """\
+create portal_allowed hash:ip family inet hashsize 1024 maxelem 65536 counters
+add portal_allowed 10.0.0.2 packets 4 bytes 1200
+add portal_allowed 10.0.0.3 packets 0 bytes 0
+create portal_allowed_mac hash:ip,mac family inet hashsize 1024 maxelem 65536
+add portal_allowed_mac 10.0.0.2,AA:BB:CC:DD:EE:FF
+add portal_allowed_mac 10.0.0.9,11:22:33:44:55:66
+"""
+
+
+def test_ipset_parsers():
+    backend = IpsetBackend("eth0", bind_macs=True)
+
+    # La IP sin vínculo queda como (ip, None) y el vínculo sin IP se ignora
+    assert backend.parse_allowed(IPSET_SAVE) == {
+        ("10.0.0.2", "aa:bb:cc:dd:ee:ff"): 1,
+        ("10.0.0.3", None): 1,
+    }
+    assert backend.parse_counters(IPSET_SAVE) == {"10.0.0.2": 1200, "10.0.0.3": 0}
+    assert IpsetBackend("eth0").parse_allowed(IPSET_SAVE) == {
+        ("10.0.0.2", None): 1,
+        ("10.0.0.3", None): 1,
+    }
+
+
+NFT_JSON = json.dumps({"nftables": [
+    {"metainfo": {"json_schema_version": 1}},
+    {"table": {"family": "inet", "name": "captive_portal"}},
+    {"set": {"family": "inet", "table": "captive_portal", "name": "allowed",
+             "type": "ipv4_addr", "elem": [
+                 {"elem": {"val": "10.0.0.2", "counter": {"packets": 4, "bytes": 1200}}},
+                 "10.0.0.3",
+             ]}},
+    {"set": {"family": "inet", "table": "captive_portal", "name": "allowed_mac",
+             "type": ["ipv4_addr", "ether_addr"], "elem": [
+                 {"concat": ["10.0.0.2", "AA:BB:CC:DD:EE:FF"]},
+             ]}},
+]})
+
+
+def test_nftables_parsers():
+    backend = NftablesBackend("eth0", bind_macs=True)
+
+    assert backend.parse_allowed(NFT_JSON) == {
+        ("10.0.0.2", "aa:bb:cc:dd:ee:ff"): 1,
+        ("10.0.0.3", None): 1,
+    }
+    assert backend.parse_counters(NFT_JSON) == {"10.0.0.2": 1200, "10.0.0.3": 0}
+
+
+def test_queue_coalesces_pending_operations_into_one_batch():
+    kernel = FakeIpset()
+    queue = FirewallWorkQueue(FirewallManager(command_runner=kernel))
+
+    futures = [queue.allow_ip("10.0.0.2"), queue.allow_ip("10.0.0.2"),
+               queue.allow_ip("10.0.0.3"), queue.block_ip("10.0.0.4")]
+    assert queue.depth() == 3
+    assert queue.pending_ips() == {"10.0.0.2", "10.0.0.3", "10.0.0.4"}
+    drain(queue)
+
+    assert all(future.result(timeout=1) for future in futures)
+    assert [command for command, _ in kernel.commands] == [["ipset", "restore", "-exist"]]
+    # Las retiradas se aplican antes que las altas
+    assert kernel.commands[0][1].splitlines() == [
+        "del portal_allowed 10.0.0.4",
+        "add portal_allowed 10.0.0.2",
+        "add portal_allowed 10.0.0.3",
+    ]
+    metrics = queue.metrics()
+    assert (metrics["submitted"], metrics["coalesced"], metrics["applied"]) == (4, 1, 3)
+    assert metrics["batches"] == 1 and metrics["depth"] == 0
+
+
+def test_queue_keeps_macs_apart_only_when_bound():
+    kernel = FakeIpset()
+    queue = FirewallWorkQueue(FirewallManager(command_runner=kernel, bind_macs=True))
+    queue.unbind_ip("10.0.0.2", "aa:aa:aa:aa:aa:aa")
+    queue.allow_ip("10.0.0.2", "bb:bb:bb:bb:bb:bb")
+    assert queue.depth() == 2
+
+    queue = FirewallWorkQueue(FirewallManager(command_runner=kernel))
+    queue.allow_ip("10.0.0.2", "aa:aa:aa:aa:aa:aa")
+    queue.block_ip("10.0.0.2", "bb:bb:bb:bb:bb:bb")
+    assert queue.depth() == 1
+
+
+def test_reconciler_diff():
+    manager = FakeManager({
+        ("10.0.0.2", None): 1,  # en orden
+        ("10.0.0.3", None): 3,  # duplicada
+        ("10.0.0.4", None): 2,  # sin sesión
+        ("10.0.0.6", None): 1,  # sin sesión pero con operación en cola
+    })
+    sessions = SessionManager()
+    for ip in ("10.0.0.2", "10.0.0.3", "10.0.0.5"):
+        sessions.create_session(ip, "ana")
+    queue = FirewallWorkQueue(manager)
+    queue.block_ip("10.0.0.6")
+    reconciler = FirewallReconciler(manager, sessions, firewall_queue=queue)
+
+    preview = reconciler.reconcile(dry_run=True)
+    assert manager.batches == []
+    assert reconciler.metrics()["passes"] == 0
+
+    report = reconciler.reconcile()
+    assert sorted(manager.batches[0]) == [
+        ("allow", "10.0.0.5", None),
+        ("block", "10.0.0.3", None),
+        ("block", "10.0.0.3", None),
+        ("block", "10.0.0.4", None),
+        ("block", "10.0.0.4", None),
+    ]
+    for result in (preview, report):
+        assert (result["missing"], result["stale"], result["duplicates"],
+                result["operations"]) == (1, 1, 2, 5)
+    assert report["success"] is True and preview["success"] is None
+    assert reconciler.metrics()["last_report"] == report
+
+
+def test_reconciler_unbinds_rule_of_previous_mac():
+    manager = FakeManager({
+        ("10.0.0.2", "aa:aa:aa:aa:aa:aa"): 1,
+        ("10.0.0.3", "cc:cc:cc:cc:cc:cc"): 1,
+    }, bind_macs=True)
+    sessions = SessionManager()
+    sessions.create_session("10.0.0.2", "ana", "bb:bb:bb:bb:bb:bb")
+    sessions.create_session("10.0.0.3", "luis", "cc:cc:cc:cc:cc:cc")
+
+    FirewallReconciler(manager, sessions).reconcile()
+    assert sorted(manager.batches[0]) == [
+        ("allow", "10.0.0.2", "bb:bb:bb:bb:bb:bb"),
+        ("unbind", "10.0.0.2", "aa:aa:aa:aa:aa:aa"),
+    ]
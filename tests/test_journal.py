@@ -0,0 +1,47 @@
+"""
+Recuperación del journal de sesiones tras un error de escritura.
+"""
+
+from journal import SessionJournal
+
+
+class BrokenFile:
+    """Fichero que escribe a medias y luego falla, como un disco lleno."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, data):
+        with open(self.path, 'a') as f:
+            f.write(data[:len(data) // 2])
+        raise OSError(28, "No space left on device")
+
+    def close(self):
+        pass
+
+
+def test_failed_flush_requeues_lines_and_compaction_repairs_file(tmp_path):
+    journal = SessionJournal(journal_file=str(tmp_path / "sessions.journal"))
+    # Abre el fichero como start(), sin hilo escritor
+    journal.snapshot_source = lambda: {}
+    journal._compact()
+
+    journal.record_create("10.0.0.2", "ana", 1.0, 1.0)
+    journal.record_create("10.0.0.3", "luis", 2.0, 2.0, "aa:bb:cc:dd:ee:ff")
+    journal.file.close()
+    journal.file = BrokenFile(journal.journal_file)
+    journal._flush()
+
+    assert journal.failed_flushes == 1
+    assert journal.file is None
+    assert len(journal.buffer) == 2
+
+    # Nuevos eventos quedan detrás de los reencolados
+    journal.record_end(["10.0.0.2"])
+    journal._flush()
+    assert len(journal.buffer) == 3
+
+    journal._compact()
+    assert journal.buffer == []
+    assert journal.replay() == {"10.0.0.3": ("luis", 2.0, 2.0, "aa:bb:cc:dd:ee:ff")}
+    journal.stop()
@@ -0,0 +1,68 @@
+"""
+Consultas de la caché de vecinos sobre una tabla ARP en un fichero temporal.
+"""
+
+import time
+
+import pytest
+
+from neighbors import NeighborCache
+
+
+ARP_HEADER = "IP address       HW type     Flags       HW address            Mask     Device\n"
+
+
+def write_arp(path, entries):
+    lines = [f"{ip} 0x1 0x2 {mac} * wlan0\n" for ip, mac in entries.items()]
+    path.write_text(ARP_HEADER + "".join(lines))
+
+
+@pytest.fixture
+def arp_file(tmp_path):
+    path = tmp_path / "arp"
+    write_arp(path, {"10.0.0.2": "AA:BB:CC:DD:EE:01"})
+    return path
+
+
+@pytest.fixture
+def cache(arp_file):
+    cache = NeighborCache(arp_file=str(arp_file), monitor=False, refresh_interval=60.0,
+                          miss_refresh_interval=0.2)
+    cache.start()
+    yield cache
+    cache.stop()
+
+
+def test_miss_is_answered_from_the_table_and_refreshed_in_background(cache, arp_file):
+    assert cache.lookup("10.0.0.2") == "aa:bb:cc:dd:ee:01"
+    write_arp(arp_file, {"10.0.0.2": "aa:bb:cc:dd:ee:01", "10.0.0.3": "aa:bb:cc:dd:ee:02"})
+
+    started = time.monotonic()
+    assert cache.lookup("10.0.0.3") is None
+    assert time.monotonic() - started < 0.05
+    assert cache.metrics()["refreshes"] == 1
+
+    deadline = time.monotonic() + 2
+    while cache.table.get("10.0.0.3") is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert cache.lookup("10.0.0.3") == "aa:bb:cc:dd:ee:02"
+    assert cache.metrics()["refreshes"] == 2
+
+
+def test_lookup_waits_for_the_requested_refresh(cache, arp_file):
+    write_arp(arp_file, {"10.0.0.3": "aa:bb:cc:dd:ee:02"})
+    assert cache.lookup("10.0.0.3", timeout=2) == "aa:bb:cc:dd:ee:02"
+
+    # La IP sigue sin aparecer: se espera como mucho a una relectura
+    started = time.monotonic()
+    assert cache.lookup("10.0.0.9", timeout=2) is None
+    assert time.monotonic() - started < 1
+    assert cache.metrics()["misses"] == 2
+
+
+def test_misses_do_not_chain_refreshes(cache):
+    for _ in range(50):
+        cache.lookup("10.0.0.9")
+    time.sleep(0.5)
+    # Una relectura al arrancar y como mucho una cada miss_refresh_interval
+    assert cache.metrics()["refreshes"] <= 4
@@ -0,0 +1,71 @@
+"""
+Pruebas del servidor HTTP del portal con el firewall simulado.
+"""
+
+import json
+import os
+import socket
+import subprocess
+
+import pytest
+
+from accesslog import AccessLog
+from firewall import FirewallManager
+from server import CaptivePortalServer
+from sessions import SessionManager
+from users import UserManager
+
+
+def fake_command_runner(command, input=None):
+    """Ejecuta con éxito cualquier comando de firewall sin tocar el kernel."""
+    return subprocess.CompletedProcess(command, 0, "", "")
+
+
+@pytest.fixture(params=["threadpool", "asyncio"])
+def portal(request, tmp_path):
+    """Portal en un puerto libre de localhost con registro de accesos."""
+    access_log = AccessLog(log_file=str(tmp_path / "access.log"), flush_interval=0.05)
+    access_log.start()
+    server = CaptivePortalServer(
+        host='127.0.0.1',
+        port=0,
+        user_manager=UserManager(users_file=str(tmp_path / "users.json"),
+                                 database_file=str(tmp_path / "users.db")),
+        session_manager=SessionManager(),
+        firewall_manager=FirewallManager(command_runner=fake_command_runner),
+        access_log=access_log,
+        engine=request.param
+    )
+    server.start()
+    yield server, server.server.server_address[1]
+    server.stop()
+    access_log.stop()
+
+
+def access_records(server):
+    """Registros escritos en el registro de accesos del portal."""
+    server.access_log.stop()
+    with open(server.access_log.log_file) as f:
+        return [json.loads(line) for line in f]
+
+
+def send_raw(port, data):
+    """Envía bytes sin procesar y devuelve la primera línea de la respuesta."""
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as conn:
+        conn.sendall(data)
+        return conn.recv(4096).split(b"\r\n", 1)[0]
+
+
+@pytest.mark.parametrize("request_line, status", [
+    (b"GET / FOO/1.0\r\n\r\n", 400),
+    (b"GET /" + b"a" * 70000 + b" HTTP/1.1\r\n\r\n", 414),
+], ids=["bad-version", "uri-too-long"])
+def test_malformed_request_is_answered_and_logged_without_path(portal, request_line, status):
+    server, port = portal
+    response = send_raw(port, request_line)
+    # Antes del arreglo el cliente recibía una respuesta vacía
+    assert response
+
+    records = [r for r in access_records(server) if r["type"] == "access"]
+    assert records[-1]["status"] == status
+    assert "path" not in records[-1]
@@ -0,0 +1,113 @@
+"""
+Pruebas del script de "tc -batch" que genera TrafficShaper, con un
+command_runner que anota cada invocación en lugar de ejecutar tc.
+"""
+
+import subprocess
+
+from shaping import TrafficShaper
+
+
+class RecordingRunner:
+    """Anota (comando, líneas del script) y responde con el código indicado."""
+
+    def __init__(self, returncode=0):
+        self.returncode = returncode
+        self.calls = []
+
+    def __call__(self, command, input=None):
+        self.calls.append((command, (input or "").splitlines()))
+        return subprocess.CompletedProcess(command, self.returncode, "", "error")
+
+
+def make_shaper(runner):
+    return TrafficShaper(
+        interface="wlan0",
+        uplink_rate="50mbit",
+        tiers={"default": ("1mbit", "5mbit"), "premium": ("4mbit", "20mbit")},
+        user_tiers={"ana": "premium"},
+        command_runner=runner,
+    )
+
+
+def test_setup_script():
+    runner = RecordingRunner()
+    make_shaper(runner).setup()
+
+    assert runner.calls == [(["tc", "-force", "-batch", "-"], [
+        "qdisc replace dev wlan0 root handle 1: htb default fff",
+        "class replace dev wlan0 parent 1: classid 1:1 htb rate 50mbit",
+        "class replace dev wlan0 parent 1:1 classid 1:fff htb rate 50mbit",
+        "qdisc replace dev wlan0 parent 1:fff fq_codel",
+    ])]
+
+
+def test_session_changes_are_applied_in_one_batch():
+    runner = RecordingRunner()
+    shaper = make_shaper(runner)
+    shaper.session_started("10.0.0.2", "ana")
+    shaper.session_started("10.0.0.3", "luis")
+    assert shaper.flush() is True
+
+    assert len(runner.calls) == 1
+    assert runner.calls[0][1] == [
+        "class replace dev wlan0 parent 1:1 classid 1:2 htb rate 4mbit ceil 20mbit",
+        "qdisc replace dev wlan0 parent 1:2 handle 2: fq_codel",
+        "filter replace dev wlan0 parent 1: protocol ip prio 1 handle 800::2 u32 "
+        "match ip dst 10.0.0.2/32 flowid 1:2",
+        "class replace dev wlan0 parent 1:1 classid 1:3 htb rate 1mbit ceil 5mbit",
+        "qdisc replace dev wlan0 parent 1:3 handle 3: fq_codel",
+        "filter replace dev wlan0 parent 1: protocol ip prio 1 handle 800::3 u32 "
+        "match ip dst 10.0.0.3/32 flowid 1:3",
+    ]
+
+    # Otro usuario en la misma IP solo cambia la tasa; el fin de sesión
+    # borra el filtro antes que la clase y libera su minor
+    shaper.session_started("10.0.0.3", "ana")
+    shaper.session_ended(["10.0.0.2", "10.0.0.9"])
+    assert shaper.flush() is True
+    assert runner.calls[1][1] == [
+        "class replace dev wlan0 parent 1:1 classid 1:3 htb rate 4mbit ceil 20mbit",
+        "filter del dev wlan0 parent 1: protocol ip prio 1 handle 800::2 u32",
+        "class del dev wlan0 classid 1:2",
+    ]
+    assert shaper.classes == {"10.0.0.3": 3}
+
+    shaper.session_started("10.0.0.4", "luis")
+    shaper.flush()
+    assert shaper.classes["10.0.0.4"] == 2
+    assert shaper.metrics()["batches"] == 3
+
+
+def test_pending_changes_coalesce_and_empty_batches_skip_tc():
+    runner = RecordingRunner()
+    shaper = make_shaper(runner)
+    shaper.session_started("10.0.0.2", "ana")
+    shaper.session_ended(["10.0.0.2"])
+
+    # La sesión terminó antes de aplicarse: no hay nada que enviar a tc
+    assert shaper.flush() is True
+    assert runner.calls == []
+    assert shaper.metrics()["batches"] == 0
+
+
+def test_failed_batch_is_counted():
+    runner = RecordingRunner(returncode=1)
+    shaper = make_shaper(runner)
+    shaper.session_started("10.0.0.2", "ana")
+
+    assert shaper.flush() is False
+    metrics = shaper.metrics()
+    assert (metrics["batches"], metrics["failed_batches"]) == (1, 1)
+
+
+def test_stop_applies_pending_changes():
+    runner = RecordingRunner()
+    shaper = make_shaper(runner)
+    shaper.session_started("10.0.0.2", "luis")
+    shaper.start()
+    shaper.stop()
+
+    assert runner.calls[-1][1][0] == (
+        "class replace dev wlan0 parent 1:1 classid 1:2 htb rate 1mbit ceil 5mbit")
+    assert shaper.metrics()["pending"] == 0
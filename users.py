@@ -1,122 +1,671 @@
-"""
-Módulo de gestión de usuarios del portal cautivo.
-Maneja la definición de cuentas y autenticación.
-"""
-
-import json
-import hashlib
-import os
-from threading import Lock
-
-
-class UserManager:
-    """Gestiona las cuentas de usuario del portal cautivo."""
-    
-    def __init__(self, users_file="users.json"):
-        """
-        Inicializa el gestor de usuarios.
-        
-        Args:
-            users_file: Ruta al archivo JSON con los usuarios
-        """
-        self.users_file = users_file
-        self.lock = Lock()
-        self._load_users()
-    
-    def _load_users(self):
-        """Carga los usuarios desde el archivo JSON."""
-        if os.path.exists(self.users_file):
-            with open(self.users_file, 'r') as f:
-                self.users = json.load(f)
-        else:
-            # Usuarios por defecto si no existe el archivo
-            self.users = {
-                "admin": self._hash_password("admin123"),
-                "usuario1": self._hash_password("pass1234"),
-                "usuario2": self._hash_password("pass5678")
-            }
-            self._save_users()
-    
-    def _save_users(self):
-        """Guarda los usuarios en el archivo JSON."""
-        with open(self.users_file, 'w') as f:
-            json.dump(self.users, f, indent=2)
-    
-    def _hash_password(self, password):
-        """
-        Genera un hash SHA-256 de la contraseña.
-        
-        Args:
-            password: Contraseña en texto plano
-            
-        Returns:
-            Hash hexadecimal de la contraseña
-        """
-        return hashlib.sha256(password.encode()).hexdigest()
-    
-    def authenticate(self, username, password):
-        """
-        Autentica un usuario con sus credenciales.
-        
-        Args:
-            username: Nombre de usuario
-            password: Contraseña en texto plano
-            
-        Returns:
-            True si las credenciales son válidas, False en caso contrario
-        """
-        with self.lock:
-            if username not in self.users:
-                return False
-            
-            password_hash = self._hash_password(password)
-            return self.users[username] == password_hash
-    
-    def add_user(self, username, password):
-        """
-        Añade un nuevo usuario.
-        
-        Args:
-            username: Nombre de usuario
-            password: Contraseña en texto plano
-            
-        Returns:
-            True si se añadió exitosamente, False si el usuario ya existe
-        """
-        with self.lock:
-            if username in self.users:
-                return False
-            
-            self.users[username] = self._hash_password(password)
-            self._save_users()
-            return True
-    
-    def remove_user(self, username):
-        """
-        Elimina un usuario.
-        
-        Args:
-            username: Nombre de usuario a eliminar
-            
-        Returns:
-            True si se eliminó exitosamente, False si no existe
-        """
-        with self.lock:
-            if username not in self.users:
-                return False
-            
-            del self.users[username]
-            self._save_users()
-            return True
-    
-    def list_users(self):
-        """
-        Lista todos los usuarios registrados.
-        
-        Returns:
-            Lista de nombres de usuario
-        """
-        with self.lock:
-            return list(self.users.keys())
-        
-
+"""
+Módulo de gestión de usuarios del portal cautivo.
+Maneja la definición de cuentas y autenticación.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import math
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+
+class PasswordHasher:
+    """
+    Hash de contraseñas con sal y formato versionado.
+    
+    Formatos almacenados:
+        scrypt$<n>$<r>$<p>$<sal>$<hash>
+        pbkdf2_sha256$<iteraciones>$<sal>$<hash>
+        <64 caracteres hex>  (SHA-256 sin sal heredado, solo verificación)
+    
+    Los cálculos se ejecutan en un pool de hilos dimensionado a los núcleos:
+    hashlib libera el GIL durante scrypt y PBKDF2, y el pool limita cuántos
+    hashes costosos se calculan a la vez.
+    """
+    
+    # Coste por defecto de cada esquema (n de scrypt, iteraciones de PBKDF2)
+    DEFAULT_COSTS = {
+        'scrypt': 2 ** 14,
+        'pbkdf2_sha256': 600000,
+    }
+    
+    def __init__(self, scheme='scrypt', cost=None, workers=None):
+        """
+        Inicializa el hasher.
+        
+        Args:
+            scheme: Esquema para los hashes nuevos ('scrypt' o 'pbkdf2_sha256')
+            cost: Parámetro de coste del esquema (por defecto DEFAULT_COSTS)
+            workers: Hilos del pool de verificación (por defecto, los núcleos)
+        """
+        if scheme not in self.DEFAULT_COSTS:
+            raise ValueError(f"Esquema de hash desconocido: {scheme}")
+        
+        self.scheme = scheme
+        self.cost = cost or self.DEFAULT_COSTS[scheme]
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                                           thread_name_prefix='password-hash')
+    
+    @staticmethod
+    def _b64(data):
+        """Codifica bytes en base64 sin relleno."""
+        return base64.b64encode(data).decode().rstrip('=')
+    
+    @staticmethod
+    def _unb64(text):
+        """Decodifica base64 sin relleno."""
+        return base64.b64decode(text + '=' * (-len(text) % 4))
+    
+    def hash(self, password):
+        """
+        Genera el hash de una contraseña con el esquema y coste actuales.
+        
+        Args:
+            password: Contraseña en texto plano
+            
+        Returns:
+            Hash en formato versionado
+        """
+        salt = os.urandom(16)
+        if self.scheme == 'scrypt':
+            digest = hashlib.scrypt(password.encode(), salt=salt, n=self.cost,
+                                    r=8, p=1, maxmem=256 * self.cost * 8 + 2 ** 20,
+                                    dklen=32)
+            return f"scrypt${self.cost}$8$1${self._b64(salt)}${self._b64(digest)}"
+        
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, self.cost)
+        return f"pbkdf2_sha256${self.cost}${self._b64(salt)}${self._b64(digest)}"
+    
+    def verify(self, password, stored_hash):
+        """
+        Comprueba una contraseña contra un hash almacenado.
+        
+        Args:
+            password: Contraseña en texto plano
+            stored_hash: Hash almacenado en cualquiera de los formatos
+            
+        Returns:
+            True si la contraseña coincide
+        """
+        parts = stored_hash.split('$')
+        try:
+            if parts[0] == 'scrypt':
+                n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+                expected = self._unb64(parts[5])
+                digest = hashlib.scrypt(password.encode(), salt=self._unb64(parts[4]),
+                                        n=n, r=r, p=p, maxmem=256 * n * r + 2 ** 20,
+                                        dklen=len(expected))
+            elif parts[0] == 'pbkdf2_sha256':
+                expected = self._unb64(parts[3])
+                digest = hashlib.pbkdf2_hmac('sha256', password.encode(),
+                                             self._unb64(parts[2]), int(parts[1]))
+            elif len(parts) == 1:
+                # Formato heredado: SHA-256 sin sal
+                expected = stored_hash.encode()
+                digest = hashlib.sha256(password.encode()).hexdigest().encode()
+            else:
+                return False
+        except (IndexError, ValueError):
+            return False
+        return hmac.compare_digest(digest, expected)
+    
+    def needs_rehash(self, stored_hash):
+        """
+        Indica si un hash debe regenerarse con el esquema o coste actuales.
+        
+        Args:
+            stored_hash: Hash almacenado
+            
+        Returns:
+            True si es heredado, de otro esquema o de otro coste
+        """
+        parts = stored_hash.split('$')
+        return parts[0] != self.scheme or parts[1] != str(self.cost)
+    
+    def submit_verify(self, password, stored_hash):
+        """Encola una verificación en el pool y devuelve su Future."""
+        return self.executor.submit(self.verify, password, stored_hash)
+    
+    def submit_hash(self, password):
+        """Encola el cálculo de un hash en el pool y devuelve su Future."""
+        return self.executor.submit(self.hash, password)
+    
+    def hash_many(self, passwords):
+        """
+        Calcula los hashes de muchas contraseñas en paralelo.
+        
+        Args:
+            passwords: Iterable de contraseñas en texto plano
+            
+        Returns:
+            Lista de hashes en el mismo orden
+        """
+        return list(self.executor.map(self.hash, passwords))
+
+
+
+class AuthCache:
+    """
+    Caché LRU con caducidad de verificaciones de contraseña correctas.
+    
+    La clave es el usuario más un HMAC de la contraseña con una clave
+    aleatoria del proceso: la contraseña nunca se guarda en claro y la
+    entrada no sirve fuera de este proceso. Solo se cachean aciertos.
+    """
+    
+    def __init__(self, max_entries=10000, ttl=300):
+        """
+        Inicializa la caché.
+        
+        Args:
+            max_entries: Número máximo de entradas antes de expulsar la más antigua
+            ttl: Segundos durante los que una verificación sigue siendo válida
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.key = os.urandom(32)
+        self.entries = OrderedDict()  # {(usuario, digest): caducidad}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def _entry_key(self, username, password):
+        """Calcula la clave de caché de unas credenciales."""
+        digest = hmac.new(self.key, f"{username}\0{password}".encode(),
+                          hashlib.sha256).digest()
+        return (username, digest)
+    
+    def lookup(self, username, password):
+        """
+        Comprueba si estas credenciales se verificaron hace poco.
+        
+        Args:
+            username: Nombre de usuario
+            password: Contraseña en texto plano
+            
+        Returns:
+            True si hay una verificación correcta vigente en la caché
+        """
+        if not self.max_entries:
+            return False
+        entry_key = self._entry_key(username, password)
+        with self.lock:
+            expires = self.entries.get(entry_key)
+            if expires is None or expires < time.monotonic():
+                if expires is not None:
+                    del self.entries[entry_key]
+                self.misses += 1
+                return False
+            self.entries.move_to_end(entry_key)
+            self.hits += 1
+            return True
+    
+    def store(self, username, password):
+        """Registra una verificación correcta."""
+        if not self.max_entries:
+            return
+        entry_key = self._entry_key(username, password)
+        with self.lock:
+            self.entries[entry_key] = time.monotonic() + self.ttl
+            self.entries.move_to_end(entry_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def invalidate(self, usernames):
+        """Descarta todas las entradas de los usuarios indicados."""
+        usernames = set(usernames)
+        with self.lock:
+            stale = [entry_key for entry_key in self.entries if entry_key[0] in usernames]
+            for entry_key in stale:
+                del self.entries[entry_key]
+    
+    def clear(self):
+        """Vacía la caché."""
+        with self.lock:
+            self.entries.clear()
+
+
+class UsernameFilter:
+    """
+    Filtro de Bloom de los nombres de usuario registrados.
+    
+    Si el filtro dice que un usuario no existe, seguro que no existe y el
+    login se rechaza sin consultar el almacén. Los falsos positivos solo
+    cuestan una consulta. Un filtro de Bloom no admite borrados: los
+    usuarios eliminados siguen dando positivo, lo que es seguro, y el
+    filtro se reconstruye al crecer por encima de su capacidad.
+    """
+    
+    def __init__(self, usernames=(), capacity=1024, error_rate=0.01):
+        """
+        Inicializa el filtro.
+        
+        Args:
+            usernames: Iterable de nombres de usuario iniciales; se recorre
+                una sola vez, sin guardarlo
+            capacity: Elementos previstos para la tasa de error indicada
+            error_rate: Tasa de falsos positivos objetivo
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # Tamaño óptimo: m = -n ln(p) / ln(2)^2, k = m/n ln(2)
+        self.bit_count = max(64, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.bit_count / self.capacity * math.log(2)))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+        for username in usernames:
+            self.add(username)
+    
+    def _positions(self, username):
+        """Posiciones de bit de un nombre (doble hashing sobre BLAKE2b)."""
+        digest = hashlib.blake2b(username.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bit_count for i in range(self.hash_count)]
+    
+    def add(self, username):
+        """Añade un nombre de usuario al filtro."""
+        for position in self._positions(username):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+    
+    def might_contain(self, username):
+        """Devuelve False solo si el usuario seguro que no está registrado."""
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(username))
+    
+    def is_full(self):
+        """Indica si se superó la capacidad y conviene reconstruirlo."""
+        return self.count > self.capacity
+
+
+class JsonUserStore:
+    """
+    Almacén de usuarios en un fichero JSON {usuario: hash}.
+    
+    Carga el fichero completo en memoria y lo reescribe en cada cambio.
+    Se mantiene por compatibilidad y para migrar instalaciones existentes.
+    """
+    
+    def __init__(self, users_file="users.json"):
+        """
+        Inicializa el almacén JSON.
+        
+        Args:
+            users_file: Ruta al archivo JSON con los usuarios
+        """
+        self.users_file = users_file
+        self.users = None
+        if os.path.exists(self.users_file):
+            with open(self.users_file, 'r') as f:
+                self.users = json.load(f)
+    
+    def is_empty(self):
+        """Indica si el almacén no tiene usuarios."""
+        return not self.users
+    
+    def _save(self):
+        """Guarda los usuarios en el archivo JSON."""
+        with open(self.users_file, 'w') as f:
+            json.dump(self.users, f, indent=2)
+    
+    def get_hash(self, username):
+        """Devuelve el hash almacenado del usuario o None si no existe."""
+        return self.users.get(username) if self.users else None
+    
+    def add(self, username, password_hash):
+        """Añade un usuario; devuelve False si ya existe."""
+        if self.users is None:
+            self.users = {}
+        if username in self.users:
+            return False
+        self.users[username] = password_hash
+        self._save()
+        return True
+    
+    def update_hash(self, username, password_hash):
+        """Sustituye el hash de un usuario existente."""
+        if self.users and username in self.users:
+            self.users[username] = password_hash
+            self._save()
+    
+    def remove(self, username):
+        """Elimina un usuario; devuelve False si no existe."""
+        if not self.users or username not in self.users:
+            return False
+        del self.users[username]
+        self._save()
+        return True
+    
+    def bulk_import(self, items):
+        """Añade muchos usuarios con una única reescritura del fichero."""
+        if self.users is None:
+            self.users = {}
+        added = 0
+        for username, password_hash in items:
+            if username not in self.users:
+                self.users[username] = password_hash
+                added += 1
+        self._save()
+        return added
+    
+    def list_usernames(self):
+        """Lista los nombres de usuario."""
+        return list(self.users.keys()) if self.users else []
+    
+    def iter_usernames(self):
+        """Recorre los nombres de usuario sin copiarlos."""
+        return iter(self.users or ())
+    
+    def count(self):
+        """Número de usuarios registrados."""
+        return len(self.users) if self.users else 0
+
+
+class SqliteUserStore:
+    """
+    Almacén de usuarios en SQLite en modo WAL.
+    
+    Cada alta o baja es una única escritura indexada, y en el arranque no
+    se carga nada: las consultas van directamente a la base de datos.
+    """
+    
+    def __init__(self, database_file="users.db"):
+        """
+        Inicializa el almacén SQLite.
+        
+        Args:
+            database_file: Ruta a la base de datos
+        """
+        self.database_file = database_file
+        # El acceso se serializa con el lock de UserManager
+        self.connection = sqlite3.connect(database_file, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "username TEXT PRIMARY KEY, password_hash TEXT NOT NULL)"
+        )
+        self.connection.commit()
+    
+    def is_empty(self):
+        """Indica si el almacén no tiene usuarios."""
+        return self.connection.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None
+    
+    def get_hash(self, username):
+        """Devuelve el hash almacenado del usuario o None si no existe."""
+        row = self.connection.execute(
+            "SELECT password_hash FROM users WHERE username = ?", (username,)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def add(self, username, password_hash):
+        """Añade un usuario; devuelve False si ya existe."""
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)",
+                (username, password_hash)
+            )
+        return cursor.rowcount == 1
+    
+    def update_hash(self, username, password_hash):
+        """Sustituye el hash de un usuario existente."""
+        with self.connection:
+            self.connection.execute(
+                "UPDATE users SET password_hash = ? WHERE username = ?",
+                (password_hash, username)
+            )
+    
+    def remove(self, username):
+        """Elimina un usuario; devuelve False si no existe."""
+        with self.connection:
+            cursor = self.connection.execute(
+                "DELETE FROM users WHERE username = ?", (username,)
+            )
+        return cursor.rowcount == 1
+    
+    def bulk_import(self, items):
+        """Añade muchos usuarios en una única transacción."""
+        before = self.connection.total_changes
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)",
+                items
+            )
+        return self.connection.total_changes - before
+    
+    def list_usernames(self):
+        """Lista los nombres de usuario."""
+        return [row[0] for row in self.connection.execute(
+            "SELECT username FROM users ORDER BY username")]
+    
+    def iter_usernames(self, batch_size=1000):
+        """Recorre los nombres de usuario por bloques, sin cargarlos todos."""
+        cursor = self.connection.execute("SELECT username FROM users")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row[0]
+    
+    def count(self):
+        """Número de usuarios registrados."""
+        return self.connection.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+
+# Almacenes de usuarios disponibles para UserManager
+USER_STORES = {
+    'sqlite': SqliteUserStore,
+    'json': JsonUserStore,
+}
+
+
+class UserManager:
+    """Gestiona las cuentas de usuario del portal cautivo."""
+    
+    def __init__(self, users_file="users.json", backend="sqlite",
+                 database_file="users.db", hasher=None,
+                 auth_cache_size=10000, auth_cache_ttl=300):
+        """
+        Inicializa el gestor de usuarios.
+        
+        Args:
+            users_file: Ruta al archivo JSON con los usuarios (almacén del
+                backend 'json' y origen de la migración para 'sqlite')
+            backend: Almacén de usuarios ('sqlite' o 'json')
+            database_file: Ruta a la base de datos del backend 'sqlite'
+            hasher: Instancia de PasswordHasher (por defecto scrypt)
+            auth_cache_size: Verificaciones correctas cacheadas (0 la desactiva)
+            auth_cache_ttl: Segundos de validez de una verificación cacheada
+        """
+        if backend not in USER_STORES:
+            raise ValueError(f"Backend de usuarios desconocido: {backend}")
+        
+        self.users_file = users_file
+        self.lock = Lock()
+        self.hasher = hasher or PasswordHasher()
+        if backend == 'sqlite':
+            self.store = SqliteUserStore(database_file)
+        else:
+            self.store = JsonUserStore(users_file)
+        self._load_users()
+        
+        # Caché de aciertos y filtro de usuarios desconocidos para que las
+        # tormentas de logins no repitan hashes costosos ni consultas
+        self.auth_cache = AuthCache(auth_cache_size, auth_cache_ttl)
+        self.username_filter = self._build_username_filter()
+    
+    def _load_users(self):
+        """Prepara el almacén, migrando o creando usuarios si está vacío."""
+        if not self.store.is_empty():
+            return
+        
+        if not isinstance(self.store, JsonUserStore) and os.path.exists(self.users_file):
+            # Migración desde el formato JSON original
+            with open(self.users_file, 'r') as f:
+                self.store.bulk_import(json.load(f).items())
+        else:
+            # Usuarios por defecto si no existe el archivo
+            defaults = [("admin", "admin123"), ("usuario1", "pass1234"),
+                        ("usuario2", "pass5678")]
+            hashes = self.hasher.hash_many(password for _, password in defaults)
+            self.store.bulk_import(zip((username for username, _ in defaults), hashes))
+    
+    def _build_username_filter(self):
+        """
+        Crea el filtro de usuarios recorriendo el almacén por bloques.
+        
+        Solo se guardan los bits del filtro (~1,2 bytes por usuario), nunca
+        la lista de nombres: el almacén SQLite sigue sin cargarse en memoria.
+        """
+        capacity = max(1024, 2 * self.store.count())
+        return UsernameFilter(self.store.iter_usernames(), capacity=capacity)
+    
+    def _hash_password(self, password):
+        """
+        Genera un hash con sal de la contraseña.
+        
+        Args:
+            password: Contraseña en texto plano
+            
+        Returns:
+            Hash en formato versionado (ver PasswordHasher)
+        """
+        return self.hasher.hash(password)
+    
+    def authenticate(self, username, password):
+        """
+        Autentica un usuario con sus credenciales.
+        
+        Args:
+            username: Nombre de usuario
+            password: Contraseña en texto plano
+            
+        Returns:
+            True si las credenciales son válidas, False en caso contrario
+        """
+        # Usuario que seguro que no existe: ni consulta ni hash
+        if not self.username_filter.might_contain(username):
+            return False
+        
+        if self.auth_cache.lookup(username, password):
+            return True
+        
+        with self.lock:
+            stored_hash = self.store.get_hash(username)
+        if stored_hash is None:
+            return False
+        
+        # La verificación es deliberadamente lenta: se hace en el pool del
+        # hasher y nunca con el lock de usuarios tomado
+        if not self.hasher.submit_verify(password, stored_hash).result():
+            return False
+        
+        # Actualizar de forma transparente hashes heredados o con otro coste
+        new_hash = None
+        if self.hasher.needs_rehash(stored_hash):
+            new_hash = self.hasher.submit_hash(password).result()
+            with self.lock:
+                # Solo si nadie cambió el hash mientras tanto
+                if self.store.get_hash(username) == stored_hash:
+                    self.store.update_hash(username, new_hash)
+        
+        with self.lock:
+            # Solo si el usuario no cambió ni se eliminó durante la verificación
+            current_hash = self.store.get_hash(username)
+            if current_hash is not None and current_hash in (stored_hash, new_hash):
+                self.auth_cache.store(username, password)
+        return True
+    
+    def add_user(self, username, password):
+        """
+        Añade un nuevo usuario.
+        
+        Args:
+            username: Nombre de usuario
+            password: Contraseña en texto plano
+            
+        Returns:
+            True si se añadió exitosamente, False si el usuario ya existe
+        """
+        password_hash = self.hasher.submit_hash(password).result()
+        with self.lock:
+            if not self.store.add(username, password_hash):
+                return False
+            self._register_usernames([username])
+            return True
+    
+    def import_users(self, credentials):
+        """
+        Añade muchos usuarios en una sola operación del almacén.
+        
+        Args:
+            credentials: Iterable de pares (usuario, contraseña en texto plano)
+            
+        Returns:
+            Número de usuarios añadidos (los existentes se ignoran)
+        """
+        credentials = list(credentials)
+        hashes = self.hasher.hash_many(password for _, password in credentials)
+        hashed = list(zip((username for username, _ in credentials), hashes))
+        with self.lock:
+            added = self.store.bulk_import(hashed)
+            self._register_usernames(username for username, _ in hashed)
+            return added
+    
+    def remove_user(self, username):
+        """
+        Elimina un usuario.
+        
+        Args:
+            username: Nombre de usuario a eliminar
+            
+        Returns:
+            True si se eliminó exitosamente, False si no existe
+        """
+        with self.lock:
+            if not self.store.remove(username):
+                return False
+            self.auth_cache.invalidate([username])
+            return True
+    
+    def _register_usernames(self, usernames):
+        """Añade usuarios al filtro, reconstruyéndolo si se queda pequeño."""
+        usernames = list(usernames)
+        # Un alta puede reutilizar el nombre de un usuario borrado
+        self.auth_cache.invalidate(usernames)
+        for username in usernames:
+            self.username_filter.add(username)
+        if self.username_filter.is_full():
+            self.username_filter = self._build_username_filter()
+    
+    def list_users(self):
+        """
+        Lista todos los usuarios registrados.
+        
+        Returns:
+            Lista de nombres de usuario
+        """
+        with self.lock:
+            return self.store.list_usernames()
+    
+    def count_users(self):
+        """
+        Cuenta los usuarios registrados sin listarlos.
+        
+        Returns:
+            Número de usuarios
+        """
+        with self.lock:
+            return self.store.count()
+        
+